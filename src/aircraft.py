@@ -1,18 +1,48 @@
-import telnetlib
-import xml.etree.ElementTree as ET
-from datetime import datetime
-from ephem import separation
-from numpy import sqrt, sin, cos, array, cross, eye, dot, pi
+import time
+import socket
+import asyncio
+import logging
+from numpy import (sqrt, sin, cos, arcsin, array, dot, tensordot, pi, zeros, full, nan,
+                   isnan, where, concatenate, int8, int64, float32, stack, column_stack,
+                   arange, argmin, clip, newaxis)
 from numpy import arctan2 as atan2
-from scipy.linalg import expm3, norm
-from matplotlib.lines import Line2D
+from modes import ModeSDecoder, parse_timestamp, verify_fields
+from render import SymbolLayer, TrailLayer
+from logs import TRACE
+import metrics
 
-# The AircraftHandler maintains a list of nearby aircraft, from data given by an
+# The AircraftHandler maintains a table of nearby aircraft, from data given by an
 # AircraftListener, and draws the aircraft on the given Axes object when
-# requested.
+# requested. The positions of all aircraft are computed together with NumPy, and they
+# are all drawn with the few artists of one SymbolLayer.
+#
+# The table is only ever changed by the listener's thread. After each batch of messages
+# the listener publishes a new AircraftSnapshot, an immutable copy of the table, by
+# replacing a single reference; draw() takes the latest snapshot, so neither side ever
+# waits for the other. Only the latest data of each aircraft is drawn: an update that is
+# replaced by a newer one before a snapshot containing it has been drawn is counted as
+# coalesced, and one that is older than the stored data is counted as dropped.
+#
+# Each slot of the table also has a ring buffer of the last positions of the aircraft.
+# A constant velocity is fitted to the recent ones (for all aircraft at once), and
+# draw() moves the aircraft along it to the time of the frame, so that they do not
+# freeze between messages. The older positions are drawn as fading trails by a
+# TrailLayer.
+#
+# With a ProximityMonitor, the aircraft near the telescope pointing or the zenith, or
+# predicted to get there within predict_ahead seconds, are drawn in color_warning.
 
-# The AircraftListener listens to the AirNav RadarBox XML stream, parsing and
-# sending the aircraft updates to an AircraftHandler whenever they arrive.
+# The AircraftListener listens to the AirNav RadarBox XML stream, decoding and
+# sending the aircraft updates to an AircraftHandler whenever they arrive. With a
+# Recorder, the received chunks of the stream are also written into its log, and a
+# Replay feeds recorded chunks to the listener in place of the socket. With several
+# receivers (the sources option), there is one listener for each, all in the IOCore
+# thread and all updating the same handler, which keeps the freshest message of each
+# aircraft.
+#
+# The metrics count the received messages, and measure the time from the arrival of new
+# data to the drawing of the aircraft, and the number of aircraft drawn. The messages,
+# dropped messages and lag of each receiver are counted as well.
 
 # Degrees to radians conversion factor
 RAD = pi/180
@@ -20,20 +50,15 @@ KNOTS = 1.94384449 # knots to m/s
 FEET = 3.28084 # feet/s to m/s
 
 
-# The data fields we want to read for each aircraft
-USED_DATA_FIELDS = [
-    "DATETIME", "MODES", "CALLSIGN", "ALTITUDE", "VRATE",
-    "GROUNDSPEED", "TRACK", "LATITUDE","LONGITUDE"
-]
-CRITICAL_FIELDS = ["DATETIME", "ALTITUDE", "LATITUDE", "LONGITUDE"]
+EARTH_RADIUS = 6371.0
 
-def verify_fields(data):
-    for field in CRITICAL_FIELDS:
-        if not field in data:
-            return False
-    return True
+# Status of the slots in the AircraftTable
+FREE = 0
+OK = 1
 
-EARTH_RADIUS = 6371.0
+# Arrays of the AircraftTable copied into the AircraftSnapshot
+SNAPSHOT_FIELDS = ("lat", "lon", "alt", "speed", "heading", "vrate", "timestamp",
+                   "updates", "coalesced", "dropped")
 
 def get_matrix(lat, lon, h):
     """This constructs the matrix needed to rotate aircraft locations into a coordinate
@@ -56,234 +81,575 @@ def get_matrix(lat, lon, h):
     return OBS_MATRIX, OBS_POLE, OBS_COORD_RAD
 
 
-class Aircraft:
-    def __init__(self, ax, config, data, handler):
-        self.last_updated = datetime(year=1903, month=12, day=17)
-        self.ax = ax
-        self.handler = handler
-        self.marker = ax.plot([], [], "D")[0]
-        self.vector = Line2D([], [])
-        self.vector.set_linewidth(2)
-        self.vector.set_alpha(0.5)
+class AircraftTable:
+    """The state of all tracked aircraft, kept in preallocated arrays with one slot per
+    aircraft. Slots of deleted aircraft are reused for new ones, and the table grows
+    when it runs out of free slots, up to max_tracks slots; after that, the aircraft
+    updated longest ago makes room for a new one. Each slot has a ring buffer of the
+    last history positions of the aircraft."""
+
+    def __init__(self, capacity=64, history=16, max_tracks=2000):
+        self.capacity = 0
+        self.history = history
+        self.max_tracks = max_tracks
+        self.evicted = 0
+        self.slots = {} # slot number for each ModeS ID
+        self.free = []
+        self.modes = []
+        self.callsign = []
+        self.lat = zeros(0)       # radians
+        self.lon = zeros(0)       # radians
+        self.alt = zeros(0)       # km
+        self.speed = zeros(0)
+        self.heading = zeros(0)   # radians from north, NaN if unknown
+        self.vrate = zeros(0)
+        self.timestamp = zeros(0) # POSIX time of the last update
+        self.status = zeros(0, dtype=int8)
+        self.updates = zeros(0, dtype=int64)   # updates applied
+        self.coalesced = zeros(0, dtype=int64) # updates replaced before they were drawn
+        self.dropped = zeros(0, dtype=int64)   # updates older than the stored data
+        self.changed = zeros(0, dtype=int64)   # snapshot version of the last update
+        # Ring buffers of the received positions, one row per slot
+        self.track_time = zeros((0, history))
+        self.track_lat = zeros((0, history), dtype=float32)
+        self.track_lon = zeros((0, history), dtype=float32)
+        self.track_alt = zeros((0, history), dtype=float32)
+        self.track_next = zeros(0, dtype=int64)  # column of the next (oldest) position
+        self.track_count = zeros(0, dtype=int64) # positions in the buffer
+        self.grow(min(capacity, max_tracks))
+
+    def grow(self, capacity):
+        """Enlarge the table to the given number of slots."""
+        extra = capacity - self.capacity
+        if extra <= 0:
+            return
+        self.modes += [None] * extra
+        self.callsign += [""] * extra
+        self.lat = concatenate([self.lat, zeros(extra)])
+        self.lon = concatenate([self.lon, zeros(extra)])
+        self.alt = concatenate([self.alt, zeros(extra)])
+        self.speed = concatenate([self.speed, zeros(extra)])
+        self.heading = concatenate([self.heading, full(extra, nan)])
+        self.vrate = concatenate([self.vrate, zeros(extra)])
+        self.timestamp = concatenate([self.timestamp, zeros(extra)])
+        self.status = concatenate([self.status, full(extra, FREE, dtype=int8)])
+        self.updates = concatenate([self.updates, zeros(extra, dtype=int64)])
+        self.coalesced = concatenate([self.coalesced, zeros(extra, dtype=int64)])
+        self.dropped = concatenate([self.dropped, zeros(extra, dtype=int64)])
+        self.changed = concatenate([self.changed, zeros(extra, dtype=int64)])
+        rows = (extra, self.history)
+        self.track_time = concatenate([self.track_time, zeros(rows)])
+        self.track_lat = concatenate([self.track_lat, zeros(rows, dtype=float32)])
+        self.track_lon = concatenate([self.track_lon, zeros(rows, dtype=float32)])
+        self.track_alt = concatenate([self.track_alt, zeros(rows, dtype=float32)])
+        self.track_next = concatenate([self.track_next, zeros(extra, dtype=int64)])
+        self.track_count = concatenate([self.track_count, zeros(extra, dtype=int64)])
+        self.free += range(capacity - 1, self.capacity - 1, -1)
+        self.capacity = capacity
+
+    def insert(self, ID):
+        """Reserve a slot for a new aircraft and return it."""
+        if not self.free:
+            if self.capacity < self.max_tracks:
+                self.grow(min(2 * self.capacity, self.max_tracks))
+            else:
+                index = self.active()
+                self.delete(index[argmin(self.timestamp[index])])
+                self.evicted += 1
+        slot = self.free.pop()
+        self.slots[ID] = slot
+        self.modes[slot] = ID
+        self.callsign[slot] = ""
+        self.heading[slot] = nan
+        self.timestamp[slot] = 0.0
+        self.status[slot] = OK
+        self.updates[slot] = 0
+        self.coalesced[slot] = 0
+        self.dropped[slot] = 0
+        self.changed[slot] = 0
+        self.track_next[slot] = 0
+        self.track_count[slot] = 0
+        return slot
+
+    def delete(self, slot):
+        """Free the slot of an aircraft."""
+        self.slots.pop(self.modes[slot], None)
+        self.modes[slot] = None
+        self.status[slot] = FREE
+        self.free.append(slot)
+
+    def active(self):
+        """Return the slot numbers in use."""
+        return (self.status != FREE).nonzero()[0]
+
+    def update(self, data):
+        """Update aircraft status with received data, adding the aircraft if it is new.
+        Give default values for non-critical parameters, if they are missing from
+        the broadcast. Returns the slot, or None if the data is older than what we have
+        or repeats it (e.g. the same message from another receiver). Raises ValueError
+        if a field can't be converted."""
+        ID = data["MODES"]
+        # Convert everything before storing anything (or taking a slot for a new
+        # aircraft), so a malformed message can't leave the aircraft half-updated.
+        lat = float(data["LATITUDE"]) * RAD
+        lon = float(data["LONGITUDE"]) * RAD
+        alt = float(data["ALTITUDE"]) * 0.0003048 # feet to km
+        vrate = float(data.get("VRATE", 0.0)) / KNOTS
+        speed = float(data.get("GROUNDSPEED", 0.0)) / FEET
+        heading = data.get("TRACK", None)
+        heading = nan if heading is None else float(heading) * RAD
+        update_time = parse_timestamp(data["DATETIME"])
+        slot = self.slots.get(ID)
+        if slot is None:
+            slot = self.insert(ID)
+        if update_time < self.timestamp[slot] or (update_time == self.timestamp[slot]
+                and lat == self.lat[slot] and lon == self.lon[slot]):
+            self.dropped[slot] += 1
+            return None
+        self.updates[slot] += 1
+        self.callsign[slot] = data.get("CALLSIGN", "????")
+        self.vrate[slot] = vrate
+        self.speed[slot] = speed
+        self.timestamp[slot] = update_time
+        self.heading[slot] = heading
+        self.lat[slot] = lat
+        self.lon[slot] = lon
+        self.alt[slot] = alt
+        column = self.track_next[slot]
+        self.track_time[slot, column] = update_time
+        self.track_lat[slot, column] = lat
+        self.track_lon[slot, column] = lon
+        self.track_alt[slot, column] = alt
+        self.track_next[slot] = (column + 1) % self.history
+        self.track_count[slot] = min(self.track_count[slot] + 1, self.history)
+        return slot
+
+
+class AircraftSnapshot:
+    """An immutable copy of the aircraft in an AircraftTable, with one row for each
+    aircraft (not for each slot), to be drawn while the table keeps changing."""
+
+    def __init__(self, table, version=0, received=None):
+        index = table.active()
+        self.version = version
+        # Monotonic time when the oldest data in this snapshot not yet drawn arrived
+        self.received = received
+        self.modes = [table.modes[slot] for slot in index]
+        self.callsign = [table.callsign[slot] for slot in index]
+        for name in SNAPSHOT_FIELDS:
+            # Indexing with an array makes a copy
+            values = getattr(table, name)[index]
+            values.flags.writeable = False
+            setattr(self, name, values)
+        # The ring buffers in order from the oldest position to the newest, with NaN
+        # times in the columns not used yet
+        H = table.history
+        rows = index[:,newaxis]
+        columns = (table.track_next[rows] + arange(H)) % H
+        unused = arange(H) < H - table.track_count[rows]
+        for name in ("track_time", "track_lat", "track_lon", "track_alt"):
+            values = getattr(table, name)[rows, columns]
+            if name == "track_time":
+                values[unused] = nan
+            values.flags.writeable = False
+            setattr(self, name, values)
+
+    def __len__(self):
+        return len(self.modes)
+
+    def counts(self):
+        """Return the numbers of applied, coalesced and dropped updates of each
+        aircraft, keyed by ModeS ID."""
+        return {ID: {"updates": int(self.updates[k]), "coalesced": int(self.coalesced[k]),
+                     "dropped": int(self.dropped[k])} for k, ID in enumerate(self.modes)}
+
+
+class AircraftHandler:
+    def __init__(self, ax, config, clock=time.time):
         self.config = config
+        self.log = logging.getLogger("skycam.AircraftHandler")
+        self.log.info("Initializing...")
+        self.ax = ax
         self.color = config["aircraft"]["color"]
         self.color_warn = config["aircraft"]["color_warning"]
         self.timeout = config["aircraft"]["data_timeout"]
-        self.DEBUG = config["main"]["debug_level"]
         self.max_distance = config["aircraft"]["max_distance"]
         self.max_zenith = pi/2 - config["aircraft"]["min_altitude"] * RAD
-        self.callsign = ""
-        self.marker.set_alpha(1.0)
-        ax.add_line(self.vector)
-        self.ok = True
-        self.update(data)
-        self.label = ax.text(0.0, 1000.0, self.callsign)
-        self.label.set_size("small")
-        
-        
-    def update(self, data):
-        """Update aircraft status with received data.
-        Give default values for non-critical parameters, if they are missing from
-        the broadcast. For critital parameters, mark the aircraft as not 'ok'."""
-        update_time = datetime.strptime(data["DATETIME"], "%Y%m%d%H%M%S")
-        if update_time < self.last_updated:
-            return
-        self.ok = True
-        self.modes = data["MODES"]
-        self.callsign = data.get("CALLSIGN", "????")
-        self.vrate = float(data.get("VRATE", 0.0)) / KNOTS
-        self.speed = float(data.get("GROUNDSPEED", 0.0)) / FEET
-        self.last_updated = update_time
-        self.heading = data.get("TRACK", None) 
-        if not self.heading is None:
-            self.heading = float(self.heading) * RAD
-        self.lat = float(data["LATITUDE"]) * RAD
-        self.lon = float(data["LONGITUDE"]) * RAD
-        self.alt = float(data["ALTITUDE"]) * 0.0003048 # feet to km
-        self.alt, self.az, self.valt, self.vaz = self.sky_position()
-            
-    def distance(self):
-        """Return ground distance from Metsähovi in km."""
-        sep = float(separation(self.handler.coord_rad, (self.lon, self.lat)))
-        return sep * EARTH_RADIUS
-    
-    def velocity(self):
-        """Return velocity vector in airplace-centric system where X is east."""
-        if self.heading is None:
-            return (0.0, 0.0, 0.0)
-        # heading is 0 for north
-        vx = sin(self.heading) * self.speed
-        vy = cos(self.heading) * self.speed
-        return 0.002 * array([vx, vy, self.vrate])
-    
-    def cartesian(self): 
-        """Return position in a Metsähovi-centric cartesian system. 
-        In the coordinate system X is east, Y is north, and Z is up."""
+        self.show_vectors = config["aircraft"]["show_vectors"]
+        self.warn_nearby = config["aircraft"]["warn_nearby"]
+        self.nearby_distance = config["aircraft"]["nearby_distance"]
+        self.fit_window = config["aircraft"].get("fit_window", 30)
+        self.dead_reckoning = config["aircraft"].get("dead_reckoning", self.timeout)
+        self.trail_length = config["aircraft"].get("trail_length", 60)
+        self.trail_alpha = config["aircraft"].get("trail_alpha", 0.6)
+        self.predict_ahead = config["aircraft"].get("predict_ahead", 30)
+        self.predict_step = config["aircraft"].get("predict_step", 5)
+        self.clock = clock
+        lat = config["location"]["latitude"]
+        lon = config["location"]["longitude"]
+        elevation = config["location"]["elevation"]
+        self.matrix, self.pole, self.coord_rad = get_matrix(lat, lon, elevation)
+        self.table = AircraftTable(history=config["aircraft"].get("history", 16),
+                                   max_tracks=config["aircraft"].get("max_tracks", 2000))
+        self.layer = None
+        self.trails = None
+        self.proximity = None
+        self.malformed = 0
+        self.coalesced = 0
+        self.dropped = 0
+        # Written only by the listener's thread
+        self.version = 0
+        self.received = None
+        self.expired = 0.0
+        self.snapshot = AircraftSnapshot(self.table)
+        # Written only by the drawing thread: the version of the last snapshot drawn
+        self.drawn = 0
+
+    def update(self, messages):
+        """Receive a list of decoded messages from the Listener and update the aircraft
+        table, making new aircraft as necessary, then publish a new snapshot of the table.
+        Malformed messages are counted and skipped without affecting the rest. Must
+        always be called from the same thread. Returns the numbers of messages applied
+        and dropped, and the newest time of the applied ones (None if there are none)."""
+        self.log.log(TRACE, "Received data update.")
+        verbose = self.log.isEnabledFor(logging.DEBUG)
+        metrics.add("aircraft.messages", len(messages))
+        T = self.table
+        version = self.version + 1
+        drawn = self.drawn
+        if drawn >= self.version:
+            # Everything so far has been drawn, this is the oldest data not drawn
+            self.received = time.monotonic()
+        coalesced = dropped = applied = 0
+        newest = None
+        for data in messages:
+            if not verify_fields(data):
+                self.malformed += 1
+                continue
+            ID = data["MODES"]
+            if verbose and ID not in T.slots:
+                self.log.debug("Creating aircraft %s.", ID)
+            try:
+                slot = T.update(data)
+            except (ValueError, KeyError):
+                self.malformed += 1
+                self.log.log(TRACE, "Malformed message for %s.", ID)
+                continue
+            if slot is None:
+                dropped += 1
+                continue
+            if T.changed[slot] > drawn:
+                # The previous update of this aircraft was never drawn
+                T.coalesced[slot] += 1
+                coalesced += 1
+            T.changed[slot] = version
+            applied += 1
+            if newest is None or T.timestamp[slot] > newest:
+                newest = T.timestamp[slot]
+        now = time.monotonic()
+        if now - self.expired > 1.0:
+            self.expire()
+            self.expired = now
+        self.coalesced += coalesced
+        self.dropped += dropped
+        if coalesced:
+            metrics.add("aircraft.coalesced", coalesced)
+        if dropped:
+            metrics.add("aircraft.dropped", dropped)
+        self.snapshot = AircraftSnapshot(T, version, self.received)
+        self.version = version
+        return applied, dropped, newest
+
+    def expire(self):
+        """Delete the aircraft that have not been updated for 3*data_timeout seconds."""
+        T = self.table
+        index = T.active()
+        for slot in index[self.clock() - T.timestamp[index] > 3*self.timeout]:
+            self.log.log(TRACE, "Deleting aircraft %s.", T.modes[slot])
+            T.delete(slot)
+
+    def counts(self):
+        """Return the numbers of applied, coalesced and dropped updates of each aircraft
+        in the latest snapshot, keyed by ModeS ID."""
+        return self.snapshot.counts()
+
+    def motion(self, S):
+        """Fit a constant velocity to the positions of each aircraft of a snapshot
+        received in the last fit_window seconds. Returns the mean time of the positions
+        and the position then, and the rates of change of latitude, longitude and
+        altitude, as arrays with one value per aircraft. The rates are zero for aircraft
+        with only one position in the window."""
+        t = S.track_time
+        used = ~isnan(t) & (t >= S.timestamp[:,newaxis] - self.fit_window)
+        n = used.sum(axis=1)
+        w = used / where(n > 0, n, 1)[:,newaxis]
+        t = where(used, t - S.timestamp[:,newaxis], 0.0)
+        t0 = (w * t).sum(axis=1)
+        dt = where(used, t - t0[:,newaxis], 0.0)
+        spread = (w * dt**2).sum(axis=1)
+        moving = spread > 0
+        position = []
+        rate = []
+        for values in (S.track_lat, S.track_lon, S.track_alt):
+            mean = (w * values).sum(axis=1)
+            slope = (w * dt * (values - mean[:,newaxis])).sum(axis=1)
+            position.append(where(n > 0, mean, 0.0))
+            rate.append(where(moving, slope / where(moving, spread, 1.0), 0.0))
+        # Aircraft without positions in the window stay where they were last seen
+        for k, values in enumerate((S.lat, S.lon, S.alt)):
+            position[k] = where(n > 0, position[k], values)
+        return (S.timestamp + t0,) + tuple(position) + tuple(rate)
+
+    def extrapolate(self, motion, t):
+        """Return the latitudes, longitudes and altitudes of the aircraft at the times
+        t (one per aircraft, or one row of times per aircraft) from their motion."""
+        t0, lat, lon, alt, vlat, vlon, valt = motion
+        if t.ndim > 1:
+            t0, lat, lon, alt, vlat, vlon, valt = (values[:,newaxis] for values in motion)
+        dt = t - t0
+        return lat + vlat*dt, lon + vlon*dt, alt + valt*dt
+
+    def local(self, lat, lon, alt):
+        """Position in a Metsähovi-centric cartesian system where X is east, Y is north
+        and Z is up, for arrays of any shape."""
         R = array([
-            sin(self.lon)*cos(self.lat),
-            cos(self.lon)*cos(self.lat),
-            sin(self.lat)
-        ]) * (EARTH_RADIUS + self.alt)
-        return dot(self.handler.matrix, R) - self.handler.pole 
-    
-    def sky_position(self):
-        R = self.cartesian()
+            sin(lon)*cos(lat),
+            cos(lon)*cos(lat),
+            sin(lat)
+        ]) * (EARTH_RADIUS + alt)
+        return tensordot(self.matrix, R, 1) - self.pole.reshape((3,) + (1,)*(R.ndim - 1))
+
+    def sky_positions(self, S, lat=None, lon=None, alt=None):
+        """Compute the zenith angle and azimuth of the aircraft of a snapshot, and of the
+        tip of their velocity vectors, as well as their ground distance from Metsähovi
+        in km. The positions of the snapshot can be replaced by the given ones."""
+        if lat is None:
+            lat, lon, alt = S.lat, S.lon, S.alt
+        R = self.local(lat, lon, alt)
+        # Velocity in an airplane-centric system where X is east; heading is 0 for north
+        heading = S.heading
+        known = ~isnan(heading)
+        V = 0.002 * array([
+            where(known, sin(heading) * S.speed, 0.0),
+            where(known, cos(heading) * S.speed, 0.0),
+            where(known, S.vrate, 0.0)
+        ])
+        V += R
         alt = atan2(R[2], sqrt(R[0]**2 + R[1]**2))
         az = atan2(R[0], -R[1])
-        
-        V = R + self.velocity()
         valt = atan2(V[2], sqrt(V[0]**2 + V[1]**2))
         vaz = atan2(V[0], -V[1])
-        return pi/2-alt, az, pi/2-valt, vaz
-    
+        # Great circle distance (haversine formula)
+        lon0, lat0 = self.coord_rad
+        h = sin((lat - lat0)/2)**2 + cos(lat)*cos(lat0)*sin((lon - lon0)/2)**2
+        distance = 2 * arcsin(sqrt(h)) * EARTH_RADIUS
+        return pi/2-alt, az, pi/2-valt, vaz, distance
+
+    def horizontal(self, lat, lon, alt):
+        """Return the zenith angles and azimuths of the given positions."""
+        R = self.local(lat, lon, alt)
+        return pi/2 - atan2(R[2], sqrt(R[0]**2 + R[1]**2)), atan2(R[0], -R[1])
+
+    def predict(self, motion, index, now):
+        """Predict the sky positions of the given aircraft every predict_step seconds
+        up to predict_ahead seconds from now. Returns the seconds ahead and the zenith
+        angles and azimuths, with one row per aircraft."""
+        ahead = arange(self.predict_step, self.predict_ahead + 1e-9, self.predict_step)
+        t = full((len(index), len(ahead)), now) + ahead
+        lat, lon, alt = self.extrapolate(tuple(values[index] for values in motion), t)
+        return (ahead,) + self.horizontal(lat, lon, alt)
+
+    def draw_trails(self, S, index, zenith, az, colors, now):
+        """Draw the positions received in the last trail_length seconds behind the given
+        aircraft, from their current zenith angles and azimuths (in degrees and
+        radians), fading with age."""
+        t = S.track_time[index]
+        tz, taz = self.horizontal(S.track_lat[index], S.track_lon[index],
+                                  S.track_alt[index])
+        # The trail ends at the drawn position
+        t = column_stack([t, full(len(index), now)])
+        tz = column_stack([tz/RAD, zenith])
+        taz = column_stack([taz, az])
+        recent = ~isnan(t) & (now - t <= self.trail_length)
+        used = recent[:,:-1] & recent[:,1:]
+        # Go the short way round in azimuth
+        az0 = taz[:,:-1]
+        az1 = az0 + (taz[:,1:] - az0 + pi) % (2*pi) - pi
+        segments = stack([stack([az0, tz[:,:-1]], axis=-1),
+                          stack([az1, tz[:,1:]], axis=-1)], axis=2)
+        alpha = self.trail_alpha * clip(1 - (now - t[:,:-1]) / self.trail_length, 0, 1)
+        rows = used.nonzero()[0]
+        self.trails.set_trails(segments[used], [colors[k] for k in rows], alpha[used])
+
     def draw(self):
-        """Update the marker for this aircraft."""
-        now = datetime.now()
-        delta = now - self.last_updated
-        if delta.seconds > self.timeout:
-            self.ok = False
-        if delta.seconds > 3*self.timeout:
-            return False
-        if self.distance() > self.max_distance or self.alt > self.max_zenith:
-            self.marker.set_data([],[])
-            self.label.set_text("")
-            self.vector.set_data([],[])
-            return True
-        if not self.ok:
-            self.marker.set_color("gray")
-            self.vector.set_color("gray")
-            self.label.set_color("gray")
-        elif (self.config["aircraft"]["warn_nearby"]
-                and self.distance() < self.config["aircraft"]["nearby_distance"]):
-            self.marker.set_color(self.color_warn)
-            self.vector.set_color(self.color_warn)
-            self.label.set_color(self.color_warn)
+        """Draw the aircraft of the latest snapshot onto the Axes, graying out the ones
+        not updated for data_timeout seconds. Returns the artists that were changed."""
+        self.log.log(TRACE, "Drawing aircraft.")
+        if self.layer is None:
+            self.layer = SymbolLayer(self.ax, marker="D", size=6, linewidth=2,
+                                     line_alpha=0.5, fontsize="small")
+            if self.trail_length > 0:
+                self.trails = TrailLayer(self.ax)
+        # Only this reference is shared with the listener
+        S = self.snapshot
+        if S.version != self.drawn:
+            if S.received is not None:
+                metrics.observe("aircraft.lag", time.monotonic() - S.received)
+            self.drawn = S.version
+        now = self.clock()
+        age = now - S.timestamp
+        motion = self.motion(S)
+        if self.dead_reckoning > 0:
+            # Move the aircraft on to the current time, for a while after their last
+            # update
+            t = clip(full(len(S), now), S.timestamp, S.timestamp + self.dead_reckoning)
+            lat, lon, alt = self.extrapolate(motion, t)
         else:
-            self.marker.set_color(self.color)
-            self.vector.set_color(self.color)
-            self.label.set_color(self.color)
-        self.marker.set_data([self.az], [self.alt/RAD])
-        if self.config["aircraft"]["show_vectors"]:
-            self.vector.set_xdata([self.az, self.vaz])
-            self.vector.set_ydata([self.alt/RAD, self.valt/RAD])
-        self.label.set_text(self.callsign)
-        self.label.set_position((self.az, self.alt/RAD))
-        return True
-    
-    def clear(self):
-        """Clear the marker for this aircraft. Used when it's deleted from the list."""
-        self.marker.remove()
-        self.vector.remove()
-        self.label.remove()
-    
+            lat, lon, alt = S.lat, S.lon, S.alt
+        zenith, az, vzenith, vaz, distance = self.sky_positions(S, lat, lon, alt)
+        shown = ((distance <= self.max_distance) & (zenith <= self.max_zenith)
+                 & (age <= 3*self.timeout))
+        index = shown.nonzero()[0]
+        zenith, az, vzenith, vaz = zenith[index], az[index], vzenith[index], vaz[index]
+        ok = age[index] <= self.timeout
+        warn = ok & self.warn_nearby & (distance[index] < self.nearby_distance)
+        if self.proximity is not None:
+            ids = [S.modes[k] for k in index]
+            if self.predict_ahead > 0:
+                # Warn about the aircraft that will enter the beam or the zenith region
+                ahead, pzenith, paz = self.predict(motion, index, now)
+                warn |= self.proximity.check("aircraft", ids, zenith, az, pzenith, paz,
+                                             ahead)
+            else:
+                warn |= self.proximity.check("aircraft", ids, zenith, az, vzenith, vaz)
+        zenith, vzenith = zenith/RAD, vzenith/RAD
+        colors = [self.color_warn if w else self.color if o else "gray"
+                  for o, w in zip(ok, warn)]
+        callsigns = [S.callsign[k] for k in index]
+        metrics.observe("aircraft.count", len(index), unit="")
+        self.layer.set_points(az, zenith, colors)
+        if self.show_vectors:
+            vectors = stack([column_stack([az, zenith]), column_stack([vaz, vzenith])], axis=1)
+            self.layer.set_lines(vectors, colors)
+        self.layer.set_labels(az, zenith, callsigns, colors)
+        if self.trails is None:
+            return self.layer.artists()
+        self.draw_trails(S, index, zenith, az, colors, now)
+        return self.trails.artists() + self.layer.artists()
 
 
-class AircraftHandler:
-    def __init__(self, ax, config, data_lock):
-        self.config = config
-        self.DEBUG = config["main"]["debug_level"]
-        if self.DEBUG >= 1:
-            print("AircraftHandler: Initializing...")
-        self.ax = ax
-        self.color = config["aircraft"]["color"]
-        self.data_lock = data_lock
-        lat = config["location"]["latitude"]
-        lon = config["location"]["longitude"]
-        elevation = config["location"]["elevation"]
-        self.matrix, self.pole, self.coord_rad = get_matrix(lat, lon, elevation)
-        self.aircraft_list = {}
-        self.new_data = {}
-        
-    def update(self, events):
-        """Receive a data update from the Listener and update the aircraft list."""
-        if self.DEBUG >= 3:
-            print("AircraftHandler: Received data update.")
-        for event_type, element in events:
-            if event_type == "start":
-                if element.tag == "MODESMESSAGE":
-                    self.new_data = {}
-                elif element.tag in USED_DATA_FIELDS:
-                    self.new_data[element.tag] = element.text
-            # When the MODESMESSAGE element ends, update the corresponding aircraft in
-            # the list, or make a new one if necessary.
-            elif event_type == "end" and element.tag == "MODESMESSAGE":
-                with self.data_lock:
-                    if not verify_fields(self.new_data):
-                        return
-                    ID = self.new_data["MODES"]
-                    if ID in self.aircraft_list:
-                        ac = self.aircraft_list[ID]
-                        ac.update(self.new_data)
-                    else:
-                        ac = Aircraft(self.ax, self.config, self.new_data, self)
-                        if self.DEBUG >= 2:
-                            print("AircraftHandler: Creating aircraft {}.".format(ID))
-                        self.aircraft_list[ID] = ac
+def aircraft_sources(config):
+    """Return the receivers to listen to, as dicts with a name, an address and a port.
+    Without a list of sources, the address and port of the [aircraft] section are the
+    only source, named "main"."""
+    settings = config["aircraft"]
+    sources = settings.get("sources")
+    if not sources:
+        return [{"name": "main", "address": settings["address"], "port": settings["port"]}]
+    return [{"name": source.get("name", "{}:{}".format(source["address"], source["port"])),
+             "address": source["address"], "port": source["port"]}
+            for source in sources]
 
-    def draw(self):
-        """Draw all of the aircraft onto the Axes, deleting inactive ones."""
-        if self.DEBUG >= 3:
-            print("AircraftHandler: Drawing aircraft.")
-        with self.data_lock:
-            to_delete = []
-            for ID in self.aircraft_list:
-                aircraft = self.aircraft_list[ID]
-                if not aircraft.draw():
-                    aircraft.clear()
-                    to_delete.append(ID)
-            for ID in to_delete:
-                if self.DEBUG >= 3:
-                    print("AircraftHandler: Deleting aircraft {}.".format(ID))
-                self.aircraft_list.pop(ID, None)
-        
 
 class AircraftListener:
     """This object will listen to the XML stream broadcast by the AirnNav RadarBox,
-    parse the XML into a series of element start/end events, and send those to the
-    given handler object."""
+    decode the messages in it, and send those to the given handler object. It is run
+    as a source in the IOCore. The source is one of aircraft_sources(), by default
+    the first."""
     
-    def __init__(self, config, handler, end_signal):
-        self.DEBUG = config["main"]["debug_level"]
+    def __init__(self, config, handler, source=None):
+        if source is None:
+            source = aircraft_sources(config)[0]
+        self.name = source["name"]
+        self.log = logging.getLogger("skycam.AircraftListener." + self.name)
         self.handler = handler
-        self.port = int(config["aircraft"]["port"])
-        self.address = config["aircraft"]["address"]
-        self.parser = ET.XMLPullParser(["start", "end"])
-        self.end_signal = end_signal
+        self.port = int(source["port"])
+        self.address = source["address"]
+        self.timeout = config["aircraft"].get("stream_timeout", 60)
+        self.decoder = ModeSDecoder()
         self.connected = False
+        self.recorder = None
+        # Statistics of this source
+        self.metric = "aircraft.source." + self.name
+        self.messages = 0
+        self.applied = 0
+        self.dropped = 0
 
-    def listen(self):
-        if self.DEBUG >= 1:
-            print("AircraftListener: Initializing...")
+    async def listen(self):
+        """Connect to the stream and pass the decoded messages to the handler until the
+        stream ends or nothing has been received for stream_timeout seconds. Returns
+        True if any data was received."""
+        self.log.info("Connecting to %s:%s...", self.address, self.port)
+        loop = asyncio.get_running_loop()
+        source = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        source.setblocking(False)
+        received = False
         try:
-            source = telnetlib.Telnet(self.address, self.port)
-        except:
-            print("AircraftListener: Error, unable to connect to source.")
+            await asyncio.wait_for(loop.sock_connect(source, (self.address, self.port)),
+                                   self.timeout)
+            self.connected = True
+            self.decoder = ModeSDecoder()
+            while True:
+                # Read directly into the decoder's buffer. The view must be released
+                # before the decoder can resize the buffer.
+                with self.decoder.space() as view:
+                    n = await asyncio.wait_for(loop.sock_recv_into(source, view),
+                                               self.timeout)
+                    if n and self.recorder is not None:
+                        self.recorder.write_source(self.name, view[:n])
+                if n == 0:
+                    self.log.warning("Error: end of stream received.")
+                    break
+                received = True
+                metrics.add("aircraft.bytes", n)
+                metrics.add(self.metric + ".bytes", n)
+                self.decoder.advance(n)
+                self.process()
+        except (OSError, asyncio.TimeoutError) as e:
+            if not received:
+                raise
+            self.log.warning("Error: %s", str(e) or "stream timed out")
+        finally:
+            source.close()
+            self.connected = False
+        return received
+
+    def process(self):
+        """Decode the data in the decoder's buffer and pass the messages to the handler."""
+        messages = self.decoder.decode()
+        if not messages:
             return
-        self.connected = True
-        self.parser.feed("<DATASTREAM>")
-        while(1):
-            # Get data and pass it to the AircraftHandler until the shutdown signal is
-            # received or the data stream ends for some reason.
-            if self.end_signal.is_set():
-                if self.DEBUG >= 1:
-                    print("AircraftListener: Received shutdown signal.")
-                source.close()
-                break
-            data = source.read_until(b"</MODESMESSAGE>")
-            if not data:
-                print("AircraftListener: Error: end of stream received.")
-                source.close()
-                break
-            self.parser.feed(data)
-            self.handler.update(self.parser.read_events())
-        self.parser.feed("</DATASTREAM>")
-        self.connected = False
-        if self.DEBUG >= 1:
-            print("AircraftListener: Shutting down.")
+        applied, dropped, newest = self.handler.update(messages)
+        self.messages += len(messages)
+        self.applied += applied
+        self.dropped += dropped
+        metrics.add(self.metric + ".messages", len(messages))
+        if dropped:
+            metrics.add(self.metric + ".dropped", dropped)
+        if newest is not None:
+            # How far behind the other receivers (and the clock) this one is
+            metrics.observe(self.metric + ".lag", max(0.0, self.handler.clock() - newest))
+
+    def stats(self):
+        """Return the message counts of this source, and the fraction of its messages
+        dropped as older than (or the same as) those of the other sources."""
+        return {"messages": self.messages, "applied": self.applied,
+                "dropped": self.dropped,
+                "drop_rate": self.dropped / self.messages if self.messages else 0.0}
+
+    def feed(self, data):
+        """Decode a chunk of the stream from another source, e.g. a recording."""
+        self.decoder.feed(data)
+        self.process()
 
 if __name__=="__main__":
-    conf = {"aircraft": {"port":7879, "address":"localhost", "max_distance":100}}
+    import toml
+    import logs
+    conf = toml.loads(open("config.toml").read())
+    logs.setup(conf)
     AH = AircraftHandler(None, conf)
-    AL = AircraftListener(conf, AH)
-    AL.listen()
+    listeners = [AircraftListener(conf, AH, source) for source in aircraft_sources(conf)]
+    async def listen_all():
+        await asyncio.gather(*(AL.listen() for AL in listeners))
+    asyncio.run(listen_all())
         
\ No newline at end of file
@@ -1,60 +1,243 @@
+import io
+import os
+import time
+import asyncio
+import logging
 from os import path
 from sys import exit
+from numpy import empty, copyto, asarray, uint8
+from PIL import Image
 import matplotlib.pyplot as plt
 import toml
+import metrics
 
 # The CameraHandler keeps an up-to-date version of the fullsky image and draws it on the 
-# given Axes object when requested.
+# given Axes object when requested. After the first image, the IOCore checks the image
+# file for changes (by modification time and size) and decodes a changed image in a
+# worker thread, optionally downscaled to the display resolution. The image is decoded
+# into one of two preallocated buffers: the one not being shown. Only one AxesImage is
+# ever created, and a new image is swapped into it with set_data.
+#
+# The camera software creates lock.txt in the image directory while it writes the image.
+# The image is only read when there is no lock, and the read is thrown away and tried
+# again if the lock appeared or the file changed while it was being read.
+#
+# With a Recorder, every image that is read is also written into its log (the file is
+# then read into memory first, so the recorded bytes are the decoded ones), and a Replay
+# gives recorded images to replay() instead. The metrics measure how long the images
+# take to decode. With a SkyProjection and mask_altitude, the parts of the image below
+# that altitude are blacked out, through the lookup table of the projection. With a
+# SkyAnalyzer, every new image is also given to it for the analysis of the clouds.
 
 class CameraHandler:
     def __init__(self, ax, config):
-        self.DEBUG = config["main"]["debug_level"]
-        if self.DEBUG >= 1:
-            print("CameraHandler: Initializing...")
+        self.log = logging.getLogger("skycam.CameraHandler")
+        self.log.info("Initializing...")
         self.ax = ax
         self.ax.set_xticks([])
         self.ax.set_yticks([])
         self.interval = config["skycam"]["update_interval"]
+        self.max_size = config["skycam"].get("max_size", 0)
+        self.lock_retry = config["skycam"].get("lock_retry", 1.0)
+        self.lock_timeout = config["skycam"].get("lock_timeout", 60.0)
+        self.mask_altitude = config["skycam"].get("mask_altitude")
         img_path = config["skycam"]["image_path"]
         img_name = config["skycam"]["image_name"]
         img_backup = config["skycam"]["default_image"]
         self.filename = path.join(img_path, img_name)
         self.lockfile = path.join(img_path, "lock.txt")
         self.backup = path.join(img_path, img_backup)
+        self.buffers = [None, None]
+        self.shown = 0 # index of the buffer being shown
+        self.size = None # full size (width, height) of the shown image
+        self.artist = None
         self.has_image = False
-        self.update_image()
-        
+        self.pending = None
+        self.stamp = None
+        self.recorder = None
+        # SkyProjection of the lens, for masking the image below mask_altitude
+        self.projection = None
+        # SkyAnalyzer of the new images
+        self.analyzer = None
+        result = self.read_image()
+        if result is None:
+            self.log.info("Unable to load image. Loading backup image.")
+            result = self.read_backup()
+        if result is not None:
+            self.stamp, self.pending = result
+            self.update_image()
+
+    def set_projection(self, projection):
+        """Use the SkyProjection of the lens, masking the image already shown."""
+        self.projection = projection
+        if self.has_image and self.mask_altitude is not None:
+            buffer = self.buffers[self.shown]
+            projection.lut(buffer.shape, self.size).mask(buffer, self.mask_altitude)
+
+    def set_analyzer(self, analyzer):
+        """Give every new image to the SkyAnalyzer, starting with the one shown."""
+        self.analyzer = analyzer
+        if self.has_image and self.stamp is not None:
+            analyzer.submit(self.buffers[self.shown], self.size, self.stamp)
+
+    def file_stamp(self, filename):
+        """Return the modification time and size of a file, or None if it is missing."""
+        try:
+            info = os.stat(filename)
+        except OSError:
+            return None
+        return (info.st_mtime, info.st_size)
+
+    def decode(self, filename, index):
+        """Decode an image file (a file name or a file object) into the buffer with the
+        given index, downscaling it to at most max_size pixels wide and high. Returns
+        the index and the full size."""
+        start = time.perf_counter()
+        with Image.open(filename) as image:
+            size = image.size
+            scale = 1.0
+            if self.max_size > 0:
+                scale = min(1.0, self.max_size / max(size))
+            target = (max(1, round(size[0]*scale)), max(1, round(size[1]*scale)))
+            if scale < 1.0:
+                # Let the JPEG decoder skip most of the work of downscaling
+                image.draft("RGB", target)
+            image = image.convert("RGB")
+            if image.size != target:
+                image = image.resize(target, Image.BILINEAR)
+            data = asarray(image)
+        buffer = self.buffers[index]
+        if buffer is None or buffer.shape != data.shape:
+            buffer = self.buffers[index] = empty(data.shape, dtype=uint8)
+        copyto(buffer, data)
+        if self.projection is not None and self.mask_altitude is not None:
+            self.projection.lut(buffer.shape, size).mask(buffer, self.mask_altitude)
+        metrics.observe("skycam.decode", time.perf_counter() - start)
+        return index, size
+
+    def read_image(self):
+        """Try once to read the image file, following the lock.txt protocol. Returns the
+        file's stamp and the decoded image, or None if the file is missing or locked, or
+        changed while it was being read."""
+        if path.exists(self.lockfile):
+            return None
+        stamp = self.file_stamp(self.filename)
+        if stamp is None:
+            return None
+        self.log.debug("Updating picture")
+        recorder = self.recorder
+        data = None
+        try:
+            if recorder is not None and recorder.images:
+                with open(self.filename, "rb") as f:
+                    data = f.read()
+                image = self.decode(io.BytesIO(data), 1 - self.shown)
+            else:
+                image = self.decode(self.filename, 1 - self.shown)
+        except (OSError, ValueError) as e:
+            # Most likely the file is still being written
+            self.log.debug("Unable to read image: %s", e)
+            return None
+        if path.exists(self.lockfile) or self.file_stamp(self.filename) != stamp:
+            return None
+        if recorder is not None:
+            recorder.image(self.filename, data)
+        if self.analyzer is not None:
+            self.analyzer.submit(self.buffers[image[0]], image[1], stamp)
+        return stamp, image
+
+    def replay(self, source):
+        """Decode a recorded image (a file name or a file object) as if the image file
+        had just changed. Runs in a worker thread."""
+        # Like watch(), wait until the last image has been taken, as it is in the
+        # buffer that would be decoded into
+        start = time.monotonic()
+        while self.pending is not None:
+            if time.monotonic() - start > self.lock_timeout:
+                self.log.warning("Dropping a recorded image, the last one was not taken.")
+                return
+            time.sleep(0.05)
+        try:
+            pending = self.decode(source, 1 - self.shown)
+        except (OSError, ValueError) as e:
+            self.log.warning("Unable to read recorded image: %s", e)
+            return
+        if self.analyzer is not None:
+            self.analyzer.submit(self.buffers[pending[0]], pending[1])
+        self.pending = pending
+
+    def read_backup(self):
+        try:
+            return None, self.decode(self.backup, 1 - self.shown)
+        except OSError:
+            self.log.info("Unable to load backup image.")
+            return None
+
+    async def watch(self):
+        """Check the image file every update_interval seconds and read it in a thread
+        when it has changed. While the file is locked, try again every lock_retry
+        seconds. Meant to be run as a source of the IOCore."""
+        loop = asyncio.get_running_loop()
+        wait = self.interval
+        locked_since = None
+        if self.recorder is not None:
+            # Read the image again, so that the recording starts with it
+            self.stamp = None
+        while True:
+            await asyncio.sleep(wait)
+            wait = self.interval
+            stamp = self.file_stamp(self.filename)
+            if stamp is None or stamp == self.stamp or self.pending is not None:
+                # Missing, unchanged, or the last image has not been taken yet
+                continue
+            result = await loop.run_in_executor(None, self.read_image)
+            if result is not None:
+                self.stamp, self.pending = result
+                locked_since = None
+                continue
+            # Keep showing the old image and try again soon
+            now = time.monotonic()
+            if locked_since is None:
+                locked_since = now
+            elif now - locked_since > self.lock_timeout:
+                self.log.warning("Image has been locked for %.0f s.", now - locked_since)
+                locked_since = now
+            wait = self.lock_retry
+
     def update_image(self):
-        """Load the image from the file."""
-        if self.DEBUG >= 2:
-            print("CameraHandler: Updating picture")
-        if path.exists(self.filename) and not path.exists(self.lockfile):
-            self.image = plt.imread(self.filename)
-            self.has_image = True
-        elif path.exists(self.backup):
-            if self.DEBUG >= 1:
-                print("CameraHandler: Unable to load image. Loading backup image.")
-            self.image = plt.imread(self.backup)
-            self.has_image = True
-        else:
-            if self.DEBUG >= 1:
-                print("CameraHandler: Unable to load backup image.")
-            self.has_image = False
+        """Take the newest image read in the background, if there is one.
+        Returns True if the image changed."""
+        pending, self.pending = self.pending, None
+        if pending is None:
+            return False
+        self.shown, self.size = pending
+        self.has_image = True
+        return True
     
     def draw_image(self):
         """Draw the stored image onto the axes."""
-        if self.DEBUG >= 2:
-            print("CameraHandler: Drawing image on screen.")
+        self.log.debug("Drawing image on screen.")
         if self.has_image:
-            self.ax.imshow(self.image, aspect="equal", alpha=1.0)
+            # A downscaled image still covers the pixel coordinates of the full image
+            width, height = self.size
+            extent = (-0.5, width - 0.5, height - 0.5, -0.5)
+            image = self.buffers[self.shown]
+            if self.artist is None:
+                self.artist = self.ax.imshow(image, aspect="equal", alpha=1.0,
+                                             extent=extent)
+            else:
+                self.artist.set_data(image)
+                if tuple(self.artist.get_extent()) != extent:
+                    self.artist.set_extent(extent)
         else:
-            if self.DEBUG >= 2:
-                print("CameraHandler: No image, drawing black background.")
-            self.ax.set_axis_bgcolor("black")
+            self.log.debug("No image, drawing black background.")
+            self.ax.set_facecolor("black")
     
 if __name__=="__main__":
+    import logs
     with open("config.toml") as f:
         conf = toml.loads(f.read())
+        logs.setup(conf)
         fig = plt.figure(figsize=(15,10))
         fig.patch.set_facecolor("white")
         ax = fig.add_subplot(111)
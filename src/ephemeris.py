@@ -0,0 +1,121 @@
+# coding: utf8
+from numpy import pi, arange, floor, full, zeros, nan, int64, asarray, ix_, where
+from propagator import unix_time
+
+# The EphemerisCache keeps the recent and upcoming positions of every satellite in the
+# Propagator catalog, sampled on a grid of fixed time steps. The grid is aligned to
+# multiples of the step, so when the time window slides forward only the new samples at
+# its leading edge need to be computed; old samples are overwritten in place. Samples are
+# tracked per satellite, so satellites that are not needed (e.g. below the horizon) are
+# not computed at all. The missing samples can also be computed elsewhere (e.g. in the
+# TracePool) and merged into the cache with merge(). If the clock goes back (e.g. a
+# clock step or a replay seek), the samples of the later time are all discarded.
+
+
+class EphemerisCache:
+    def __init__(self, propagator, step, backward, forward):
+        self.propagator = propagator
+        self.step = float(step)
+        self.backward = int(backward)
+        self.forward = int(forward)
+        # One extra sample beyond the window so the current position can always be
+        # interpolated between two samples.
+        self.size = self.backward + max(self.forward, 1) + 1
+        self.reset()
+
+    def reset(self):
+        """Discard all samples, e.g. after the catalog has been reloaded."""
+        count = len(self.propagator)
+        self.keys = full((count, self.size), -1, dtype=int64)
+        self.alt = full((count, self.size), nan)
+        self.az = full((count, self.size), nan)
+        self.range = full((count, self.size), nan)
+        self.eclipsed = zeros((count, self.size), dtype=bool)
+        self.computed = 0
+        # Changes whenever the catalog changes, so that samples computed elsewhere for an
+        # older catalog can be recognized
+        self.generation = getattr(self, "generation", 0) + 1
+
+    def grid(self, now):
+        """Grid indices of the samples covering the window around the given time."""
+        k = int(floor(unix_time(now)[0] / self.step))
+        return arange(k - self.backward, k + self.size - self.backward, dtype=int64)
+
+    def rows(self, index):
+        """Catalog indices as an array, with None meaning the whole catalog."""
+        if index is None:
+            return arange(len(self.propagator))
+        return asarray(index, dtype=int)
+
+    def missing(self, keys, rows):
+        """Find the samples at the given grid indices that are not in the buffer for the
+        given satellites. Returns the satellites and grid indices of a block covering
+        them (both empty if nothing is missing)."""
+        cached = self.keys[ix_(rows, keys % self.size)]
+        if (cached > keys).any():
+            # The clock went back, so the whole buffer is ahead of it
+            self.reset()
+            cached = self.keys[ix_(rows, keys % self.size)]
+        missing = cached != keys
+        return rows[missing.any(axis=1)], keys[missing.any(axis=0)]
+
+    def store(self, rows, keys, alt, az, rng, eclipsed):
+        """Store a block of samples, replacing whatever is in their buffer slots."""
+        block = ix_(rows, keys % self.size)
+        self.alt[block] = alt
+        self.az[block] = az
+        self.range[block] = rng
+        self.eclipsed[block] = eclipsed
+        self.keys[block] = keys
+        self.computed += alt.size
+
+    def merge(self, rows, keys, alt, az, rng, eclipsed):
+        """Store a block of samples computed elsewhere, which may arrive after newer
+        ones. Samples older than the ones already in their buffer slots are ignored."""
+        block = ix_(rows, keys % self.size)
+        newer = self.keys[block] < keys
+        self.alt[block] = where(newer, alt, self.alt[block])
+        self.az[block] = where(newer, az, self.az[block])
+        self.range[block] = where(newer, rng, self.range[block])
+        self.eclipsed[block] = where(newer, eclipsed, self.eclipsed[block])
+        self.keys[block] = where(newer, keys, self.keys[block])
+        self.computed += newer.sum()
+
+    def fill(self, keys, rows):
+        """Make sure the samples at the given grid indices are in the buffer for the
+        given satellites, computing only the ones that are missing. Returns the buffer
+        slots of the samples."""
+        new_rows, new_keys = self.missing(keys, rows)
+        if len(new_rows):
+            alt, az, rng, eclipsed = self.propagator.compute(new_keys * self.step, new_rows)
+            self.store(new_rows, new_keys, alt, az, rng, eclipsed)
+        return keys % self.size
+
+    def window(self, now, index=None):
+        """Return the sample times and the alt, az, range and eclipsed arrays, of shape
+        (satellites, samples), for the trace window around the given time. The samples
+        run from `backward` steps before the current one to `forward` steps after it."""
+        keys = self.grid(now)[:self.backward + self.forward + 1]
+        rows = self.rows(index)
+        block = ix_(rows, self.fill(keys, rows))
+        return (keys * self.step, self.alt[block], self.az[block], self.range[block],
+                self.eclipsed[block])
+
+    def interpolate(self, now, index=None):
+        """Interpolate the alt, az, range and eclipsed status of the satellites linearly
+        between the two samples bracketing the given time."""
+        t = unix_time(now)[0]
+        k = int(floor(t / self.step))
+        keys = arange(k, k + 2, dtype=int64)
+        rows = self.rows(index)
+        s0, s1 = self.fill(keys, rows)
+        f = t / self.step - k
+        alt0, alt1 = self.alt[rows, s0], self.alt[rows, s1]
+        az0, az1 = self.az[rows, s0], self.az[rows, s1]
+        # Take the short way around when azimuth wraps through north
+        daz = (az1 - az0 + pi) % (2*pi) - pi
+        az = (az0 + f * daz) % (2*pi)
+        alt = alt0 + f * (alt1 - alt0)
+        rng = self.range[rows, s0] + f * (self.range[rows, s1] - self.range[rows, s0])
+        eclipsed = self.eclipsed[rows, s0] if f < 0.5 else self.eclipsed[rows, s1]
+        return alt, az, rng, eclipsed
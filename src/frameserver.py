@@ -0,0 +1,170 @@
+import io
+import logging
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from numpy import array
+from PIL import Image
+from logs import TRACE
+import metrics
+
+# The FrameServer serves the rendered view over HTTP, so that it can be watched on other
+# screens without running the program (and connecting to the data sources) there. In
+# headless mode the main loop renders the view with the Agg backend and calls capture()
+# after every frame, which takes a copy of the frame only if something was drawn. A frame
+# is encoded at most once for each format, when it is first requested, and the same
+# bytes are sent to every viewer.
+#
+#   /             a page showing the stream
+#   /frame.png    the latest frame as PNG
+#   /frame.jpg    the latest frame as JPEG
+#   /stream.mjpg  an MJPEG stream of the frames
+#   /metrics      the metrics of the program as JSON
+
+PAGE = b"""<!DOCTYPE html>
+<html><head><title>Skycam</title></head>
+<body style="margin:0; background:black">
+<img src="/stream.mjpg" style="width:100%">
+</body></html>
+"""
+
+BOUNDARY = "skycamframe"
+
+
+class FrameServer:
+    def __init__(self, canvas, config, blitter=None):
+        self.log = logging.getLogger("skycam.FrameServer")
+        settings = config.get("frameserver", {})
+        self.address = settings.get("address", "127.0.0.1")
+        self.port = settings.get("port", 8080)
+        self.quality = settings.get("jpeg_quality", 80)
+        self.canvas = canvas
+        self.blitter = blitter
+        self.frame = None # RGBA array of the latest frame
+        self.frame_id = 0
+        self.drawn = None
+        self.encoded = {} # format: (frame_id, bytes)
+        self.closed = False
+        self.condition = threading.Condition()
+        self.encode_lock = threading.Lock()
+        self.server = ThreadingHTTPServer((self.address, self.port), self.handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    def start(self):
+        self.log.info("Serving on http://%s:%s/", self.address, self.port)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.server.shutdown()
+        self.server.server_close()
+        if self.thread is not None:
+            self.thread.join()
+
+    def capture(self):
+        """Take the frame that was just drawn on the canvas. With blitting, the frame is
+        only copied if the BlitManager drew something since the last capture."""
+        if self.blitter is not None:
+            drawn = (self.blitter.blits, self.blitter.full_draws)
+            if drawn == self.drawn:
+                return False
+            self.drawn = drawn
+        frame = array(self.canvas.buffer_rgba())
+        with self.condition:
+            self.frame = frame
+            self.frame_id += 1
+            self.condition.notify_all()
+        return True
+
+    def wait(self, last, timeout=None):
+        """Wait until there is a frame newer than the frame id last. Returns the new
+        frame id, or None if the server is closing or the wait timed out."""
+        with self.condition:
+            self.condition.wait_for(lambda: self.closed or
+                                    (self.frame is not None and self.frame_id != last),
+                                    timeout)
+            if self.closed or self.frame is None or self.frame_id == last:
+                return None
+            return self.frame_id
+
+    def encode(self, fmt):
+        """Return the id of the latest frame and the frame encoded in the given format
+        ("png" or "jpeg"), encoding it only if it has not been encoded yet."""
+        with self.encode_lock:
+            with self.condition:
+                frame_id, frame = self.frame_id, self.frame
+            cached = self.encoded.get(fmt)
+            if cached is not None and cached[0] == frame_id:
+                return cached
+            if frame is None:
+                return frame_id, None
+            image = Image.fromarray(frame, "RGBA")
+            buffer = io.BytesIO()
+            if fmt == "jpeg":
+                image.convert("RGB").save(buffer, "JPEG", quality=self.quality)
+            else:
+                image.save(buffer, "PNG", compress_level=1)
+            self.encoded[fmt] = (frame_id, buffer.getvalue())
+            self.log.log(TRACE, "Encoded frame %d as %s (%d bytes).",
+                         frame_id, fmt, len(self.encoded[fmt][1]))
+            return self.encoded[fmt]
+
+    def handler(self):
+        server = self
+
+        class FrameRequestHandler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                server.log.log(TRACE, format, *args)
+
+            def send_data(self, content_type, data):
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.send_header("Cache-Control", "no-cache")
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                path = self.path.split("?")[0]
+                if path == "/":
+                    self.send_data("text/html", PAGE)
+                elif path in ("/frame.png", "/frame.jpg"):
+                    fmt = "png" if path.endswith("png") else "jpeg"
+                    frame_id, data = server.encode(fmt)
+                    if data is None:
+                        self.send_error(503, "No frame rendered yet")
+                    else:
+                        self.send_data("image/" + fmt, data)
+                elif path == "/stream.mjpg":
+                    self.stream()
+                elif path == "/metrics":
+                    metrics.send_metrics(self)
+                else:
+                    self.send_error(404)
+
+            def stream(self):
+                self.send_response(200)
+                self.send_header("Content-Type",
+                                 "multipart/x-mixed-replace; boundary=" + BOUNDARY)
+                self.send_header("Cache-Control", "no-cache")
+                self.end_headers()
+                last = None
+                try:
+                    while True:
+                        if server.wait(last, timeout=10.0) is None:
+                            if server.closed:
+                                break
+                            continue
+                        last, data = server.encode("jpeg")
+                        self.wfile.write("--{}\r\nContent-Type: image/jpeg\r\n"
+                                         "Content-Length: {}\r\n\r\n".format(
+                                             BOUNDARY, len(data)).encode("ascii"))
+                        self.wfile.write(data)
+                        self.wfile.write(b"\r\n")
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+        return FrameRequestHandler
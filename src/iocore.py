@@ -0,0 +1,71 @@
+import asyncio
+import logging
+import threading
+
+# The IOCore runs all communication with the outside world (the aircraft data stream,
+# the telescope control computer, the skycam image file and the orbital element
+# downloads) as asyncio tasks in one background thread. The tasks publish their results
+# as snapshots on the handler objects, which the Animator reads in the drawing thread
+# without waiting for any network or disk access.
+
+class IOCore:
+    def __init__(self, config, end_signal):
+        self.log = logging.getLogger("skycam.IOCore")
+        self.end_signal = end_signal
+        self.sources = []
+        self.thread = None
+
+    def add(self, name, function, reconnect=True):
+        """Add a source, given as a coroutine function. If reconnect is True, the
+        coroutine is restarted with exponential backoff whenever it fails."""
+        self.sources.append((name, function, reconnect))
+
+    def start(self):
+        self.log.info("Starting %d sources...", len(self.sources))
+        self.thread = threading.Thread(target=asyncio.run, args=(self.main(),))
+        self.thread.start()
+
+    def join(self):
+        if self.thread is not None:
+            self.thread.join()
+
+    async def main(self):
+        tasks = []
+        for name, function, reconnect in self.sources:
+            if reconnect:
+                tasks.append(asyncio.create_task(self.retry(name, function)))
+            else:
+                tasks.append(asyncio.create_task(function()))
+        # Wait for the shutdown signal from the main thread
+        while not self.end_signal.is_set():
+            await asyncio.sleep(0.2)
+        self.log.info("Received shutdown signal.")
+        # asyncio.wait_for can swallow a cancellation that arrives at the same time as
+        # the data it waits for, so keep cancelling until all tasks have ended
+        pending = tasks
+        while pending:
+            for task in pending:
+                task.cancel()
+            done, pending = await asyncio.wait(pending, timeout=0.5)
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.log.info("Shutting down.")
+
+    async def retry(self, name, function, min_delay=1.0, max_delay=60.0):
+        """Run the coroutine function again and again, waiting longer after each
+        consecutive failure. A run that got some data through before ending (and so
+        returned True) resets the delay."""
+        log = logging.getLogger("skycam." + name)
+        delay = min_delay
+        while True:
+            try:
+                worked = await function()
+            except asyncio.CancelledError:
+                raise
+            except (OSError, EOFError, asyncio.TimeoutError) as e:
+                log.warning("Error: %s", str(e) or type(e).__name__)
+                worked = False
+            if worked:
+                delay = min_delay
+            log.debug("Reconnecting in %.0f s.", delay)
+            await asyncio.sleep(delay)
+            delay = min(2 * delay, max_delay)
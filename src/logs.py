@@ -0,0 +1,44 @@
+import logging
+
+# The debug output goes through the logging module, with a logger for each class, named
+# after the class under a common "skycam" parent (e.g. "skycam.CameraHandler"), whose
+# level is set from the config; other libraries (e.g. Matplotlib and PIL) only show
+# their warnings. The messages are given with their arguments separately, e.g.
+# log.debug("Loaded %d satellites.", n), so that a message is only formatted when its
+# level is enabled, and the disabled levels cost next to nothing in the drawing loop.
+#
+# The debug_level of the config selects the levels shown:
+#   0  only warnings and errors
+#   1  INFO: starting up and shutting down
+#   2  DEBUG: loading, connecting and other occasional events
+#   3  TRACE: every update and drawing of every layer
+
+TRACE = 5
+LEVELS = [logging.WARNING, logging.INFO, logging.DEBUG, TRACE]
+
+PREFIX = "skycam."
+
+logging.addLevelName(TRACE, "TRACE")
+
+
+def level(debug_level):
+    """Return the logging level of a debug_level."""
+    return LEVELS[max(0, min(debug_level, len(LEVELS) - 1))]
+
+
+def short_name(record):
+    """Give the record the name of its logger without the "skycam." in front."""
+    name = record.name
+    record.short_name = name[len(PREFIX):] if name.startswith(PREFIX) else name
+    return True
+
+
+def setup(config):
+    """Print the messages of the configured debug_level as "Name: message". The
+    summary lines of the metrics are always shown."""
+    logging.basicConfig(format="%(short_name)s: %(message)s", level=logging.WARNING)
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(short_name)
+    debug_level = level(config["main"]["debug_level"])
+    logging.getLogger("skycam").setLevel(debug_level)
+    logging.getLogger("skycam.Metrics").setLevel(min(logging.INFO, debug_level))
@@ -1,24 +1,40 @@
 from satellite import SatelliteHandler
 from scope import TelescopeHandler
 from camera import CameraHandler
-from aircraft import AircraftHandler, AircraftListener
+from aircraft import AircraftHandler, AircraftListener, aircraft_sources
 from spacetrack import SatelliteRetriever
+from iocore import IOCore
+from render import BlitManager
+from frameserver import FrameServer
+from scheduler import FrameScheduler
+from recorder import Recorder, Replay
+from proximity import ProximityMonitor
+from projection import SkyProjection, set_projection, align_overlay
+from skyanalysis import SkyAnalyzer
+from metrics import MetricsServer
+import metrics
+import logs
 
-from numpy import pi
+from numpy import pi, linspace, full
 import matplotlib as mpl
 from matplotlib.animation import FuncAnimation
-from matplotlib.patches import Circle
 from matplotlib import pyplot as plt
 
 import toml
+import time
+import logging
 import threading
+import itertools
 from sys import argv, exit
 
 # Remove bottom toolbar from Matplotlib window
 mpl.rcParams["toolbar"] = "None"
 
+log = logging.getLogger("skycam.Main")
+
 class Animator:
-    def __init__(self, config, Aircraft, Camera, Sat, Scope):
+    def __init__(self, config, Aircraft, Camera, Sat, Scope, blitter=None,
+                 proximity=None):
         self.show_skycam = config["main"]["show_skycam"]
         self.show_aircraft = config["main"]["show_aircraft"]
         self.show_satellites = config["main"]["show_satellites"]
@@ -28,35 +44,111 @@ class Animator:
         self.Camera = Camera
         self.Satellites = Sat
         self.Telescope = Scope
+        self.blitter = blitter
+        self.proximity = proximity
+        self.new_image = False
+        # Each layer is updated on its own period by the scheduler
         interval = config["main"]["update_interval"]
-        self.trace_interval = int(config["satellite"]["trace_interval"] / interval)
-        self.skycam_interval = int(config["skycam"]["update_interval"] / interval)
-    def __call__(self, i):
+        self.scheduler = FrameScheduler(config)
+        S = self.scheduler
+        S.add("elements", self.reload_elements, interval, expensive=True,
+              ready=self.Satellites.reload.is_set)
+        S.add("passes", self.Satellites.extend_passes, expensive=True,
+              ready=self.Satellites.passes_due)
         if self.show_aircraft:
-            self.Aircraft.draw()
-        if self.show_skycam and (i % self.skycam_interval == 0):
-            self.Camera.update_image()
-            self.Camera.draw_image()
+            S.add("aircraft", self.Aircraft.draw)
+        if self.show_skycam:
+            S.add("skycam", self.update_image, interval, expensive=True,
+                  ready=lambda: self.Camera.pending is not None)
+        if self.show_satellites:
+            S.add("satellites", self.Satellites.draw)
+        if self.show_satellite_traces:
+            S.add("traces", self.Satellites.draw_traces, config["satellite"]["trace_interval"],
+                  budget=config["satellite"].get("trace_budget", interval / 4),
+                  expensive=True, degradable=True)
+            S.add("trace results", self.Satellites.update_traces,
+                  ready=self.Satellites.traces_ready)
+        if self.show_scope:
+            S.add("scope", self.draw_scope)
+        summary_interval = config.get("metrics", {}).get("summary_interval", 0)
+        if summary_interval > 0 and metrics.enabled():
+            S.add("metrics", metrics.log_summary, summary_interval)
+    def reload_elements(self):
+        self.Satellites.reload.clear()
+        self.Satellites.update()
+        # The satellites drawn earlier in the frame have been cleared
         if self.show_satellites:
-            self.Satellites.draw()
-        if self.show_satellite_traces and (i % self.trace_interval == 0):
-            self.Satellites.draw_traces()
+            return self.Satellites.draw()
+        return []
+    def update_image(self):
+        if self.Camera.update_image():
+            self.Camera.draw_image()
+            self.new_image = True
+        return []
+    def update_scope(self):
+        """Estimate the telescope pointing before anything is drawn, so that the
+        proximity warnings of this frame use it."""
         if self.show_scope:
             self.Telescope.update_position()
-            self.Telescope.draw()
+        if self.proximity is not None:
+            visible = self.show_scope and self.Telescope.visible
+            self.proximity.set_scope(self.Telescope.position if visible else None)
+    def draw_scope(self):
+        if self.proximity is not None:
+            self.Telescope.warn = self.proximity.scope_warning()
+        return self.Telescope.draw()
+    def __call__(self, i):
+        """Draw frame i. Returns the moving artists that changed."""
+        start = time.perf_counter()
+        self.new_image = False
+        self.update_scope()
+        changed = self.scheduler.run()
+        if self.blitter is not None:
+            if self.new_image:
+                # The skycam image is in the background, which must be drawn again
+                self.blitter.add(changed)
+                self.blitter.refresh()
+            else:
+                self.blitter.update(changed)
+        metrics.observe("frame", time.perf_counter() - start)
+        return changed
     def init(self):
         if self.show_skycam:
             self.Camera.draw_image()
+        return []
+
+def run_headless(config, fig, animator, blitter):
+    """Render the view every update_interval without a window, serving the frames over
+    HTTP until interrupted."""
+    server = FrameServer(fig.canvas, config, blitter)
+    server.start()
+    interval = config["main"]["update_interval"]
+    animator.init()
+    fig.canvas.draw()
+    try:
+        for i in itertools.count():
+            start = time.monotonic()
+            animator(i)
+            if blitter is None:
+                fig.canvas.draw()
+            server.capture()
+            time.sleep(max(0.0, interval - (time.monotonic() - start)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
 
 def main(config_filename):
     config = toml.loads(open(config_filename).read())
+    logs.setup(config)
+    metrics.configure(config)
     
-    # Prettier debug lines with this closure
-    def DEBUG(level, message):
-        if config["main"]["debug_level"] >= level:
-            print(message)
+    headless = config["main"].get("headless", False)
+    if headless:
+        # Render into memory only, for the FrameServer
+        plt.switch_backend("Agg")
     
-    DEBUG(1, "Main: Greating graphics window...")
+    log.info("Greating graphics window...")
     width = config["main"]["window_width"]
     fig = plt.figure(figsize=(width, 9/16*width))
     fig.patch.set_color("black")
@@ -66,23 +158,34 @@ def main(config_filename):
     ax_symbols = fig.add_subplot(312, polar=True)
     ax_text = fig.add_subplot(313)
     ax_skycam.set_position((0.01, 0.02, 0.73, 0.96))
-    
-    wx,wy = 1.0, 1.01
-    cx = 0.347
-    cy = 0.487
-    x, y = cx - wx/2, cy - wy/2
-    ax_symbols.set_position((x, y, wx, wy))
     ax_text.set_position((0.75, 0.02, 0.2, 0.96))
+    
+    # Place the Axes of the symbols over the skycam image, following the calibration of
+    # the lens, again whenever the window is resized
+    Camera = CameraHandler(ax_skycam, config)
+    try:
+        projection = SkyProjection(config, Camera.size)
+    except ValueError as e:
+        log.warning("No skycam calibration: %s", e)
+        projection = None
+        ax_symbols.set_position(ax_skycam.get_position())
+        ax_symbols.set_ylim(0, 90)
+        ax_symbols.set_theta_offset(config["skycam"]["north_offset"] * pi/180)
+    if projection is not None:
+        Camera.set_projection(projection)
+        set_projection(ax_symbols, projection)
+        size = Camera.size or (round(2*projection.center_x + 1),
+                               round(2*projection.center_y + 1))
+        align = lambda event=None: align_overlay(ax_skycam, ax_symbols, projection, size)
+        align()
+        fig.canvas.mpl_connect("resize_event", align)
 
     # Set up the Axes object for the skycam
     ax_skycam.patch.set_color("black")
-    ax_symbols.set_axis_bgcolor("red")
+    ax_symbols.set_facecolor("red")
     ax_symbols.patch.set_alpha(0.0)
 
     # Set up the Axes object for planes, satellites and scope
-    north_offset = config["skycam"]["north_offset"] * pi/180
-    ax_symbols.set_ylim(0, 90)
-    ax_symbols.set_theta_offset(north_offset)
     ax_symbols.tick_params(axis='x', colors='white')
     ax_symbols.tick_params(axis='y', colors='white')
     ax_symbols.set_xticklabels(['N','NE','E','SE','S','SW','W','NW'])
@@ -95,8 +198,8 @@ def main(config_filename):
     
     horizon_ring = config["skycam"]["draw_horizon"]
     if horizon_ring > 0.0:
-        ax_symbols.add_artist(Circle((0,0), 90 - horizon_ring, 
-                transform=ax_symbols.transData._b, color="white", fill=False))
+        ax_symbols.plot(linspace(0, 2*pi, 361), full(361, 90 - horizon_ring),
+                        color="white", linewidth=1)
         ax_symbols.text(-1.5, 89-horizon_ring, "{}°".format(horizon_ring), color="white")
     
     # Set up the Axes for texts
@@ -104,42 +207,121 @@ def main(config_filename):
     ax_text.set_xticks([])
     ax_text.set_yticks([])
     
-    # Download orbital elements
-    if config["satellite"]["get_orbits_on_startup"]:
-        SR = SatelliteRetriever(config)
-        SR.download_data()
+    # When replaying a recording, the handlers take the time from the replay
+    recorder_settings = config.get("recorder", {})
+    replay = None
+    clock = time.time
+    if recorder_settings.get("replay_file"):
+        replay = Replay(config)
+        clock = replay.clock
     
     # Set up the handler objects for the different drawings
-    data_lock = threading.Lock()
-    Camera = CameraHandler(ax_skycam, config)
-    Satellites = SatelliteHandler(ax_symbols, ax_text, config)
+    Satellites = SatelliteHandler(ax_symbols, ax_text, config, clock)
     if config["main"]["show_aircraft"]:
-        Aircraft = AircraftHandler(ax_symbols, config, data_lock)
+        Aircraft = AircraftHandler(ax_symbols, config, clock)
+        # One listener for each receiver, all giving their messages to the handler
+        PlaneListeners = [AircraftListener(config, Aircraft, source)
+                          for source in aircraft_sources(config)]
     else:
         Aircraft = None
-    Scope = TelescopeHandler(ax_symbols, config)
+        PlaneListeners = []
+    Scope = TelescopeHandler(ax_symbols, config, clock)
+    proximity = ProximityMonitor(config, clock)
+    Satellites.proximity = proximity
+    if Aircraft is not None:
+        Aircraft.proximity = proximity
+    
+    # Analyze the clouds of each new skycam image in the background
+    analyzer = None
+    if config.get("analysis", {}).get("enabled", False) and config["main"]["show_skycam"]:
+        if projection is None:
+            log.warning("The sky analysis needs the skycam calibration.")
+        else:
+            analyzer = SkyAnalyzer(config, projection, clock)
+            analyzer.pointing = lambda t: Scope.position_at(t) if Scope.online else None
+            Camera.set_analyzer(analyzer)
     
-    animator = Animator(config, Aircraft, Camera, Satellites, Scope)
+    blit = config["main"].get("blit", True)
+    blitter = BlitManager(fig.canvas, config) if blit else None
+    animator = Animator(config, Aircraft, Camera, Satellites, Scope, blitter, proximity)
     
-    # Create the thread that listens for aircraft updates
+    # All network and file input runs in the IOCore thread
     end_signal = threading.Event()
-    if config["main"]["show_aircraft"]:
-        DEBUG(1, "Main: Creating AircraftListener thread...")
-        PlaneListener = AircraftListener(config, Aircraft, end_signal)
-        thread_AircraftListener = threading.Thread(target=PlaneListener.listen)
-        thread_AircraftListener.start()
+    io = IOCore(config, end_signal)
+    recorder = None
+    if replay is not None:
+        log.info("Adding Replay...")
+        replay.listeners = {listener.name: listener for listener in PlaneListeners}
+        replay.scope = Scope if config["main"]["show_scope"] else None
+        replay.camera = Camera if config["main"]["show_skycam"] else None
+        io.add("Replay", replay.run, reconnect=False)
+    else:
+        if recorder_settings.get("record_file"):
+            recorder = Recorder(config)
+        for listener in PlaneListeners:
+            log.info("Adding AircraftListener for %s...", listener.name)
+            listener.recorder = recorder
+            io.add("AircraftListener." + listener.name, listener.listen)
+        if config["main"]["show_scope"]:
+            Scope.recorder = recorder
+            io.add("TelescopeHandler", Scope.poll)
+        if config["main"]["show_skycam"]:
+            Camera.recorder = recorder
+            io.add("CameraHandler", Camera.watch)
+    
+    # Download orbital elements in the background, reloading the satellites when done.
+    # A replay uses the elements already in the store.
+    refresh_interval = config["satellite"].get("orbit_refresh_interval", 0) * 3600
+    if replay is None and (config["satellite"]["get_orbits_on_startup"] or
+                           refresh_interval > 0):
+        log.info("Adding SatelliteRetriever...")
+        SR = SatelliteRetriever(config)
+        startup = config["satellite"]["get_orbits_on_startup"]
+        if refresh_interval <= 0:
+            refresh_interval = None
+        io.add("SatelliteRetriever", lambda: SR.refresh(refresh_interval,
+                Satellites.reload.set, startup), reconnect=False)
+    io.start()
+    
+    metrics_server = None
+    if config.get("metrics", {}).get("port", 0) > 0:
+        metrics_server = MetricsServer(config)
+        metrics_server.start()
     
     frame_interval = int(config["main"]["update_interval"] * 1000)
     
-    DEBUG(1, "Main: Creating view animator...")
-    anim = FuncAnimation(fig, animator, init_func=animator.init, 
-                         blit=False, interval=frame_interval)
+    if headless:
+        log.info("Starting headless rendering...")
+        run_headless(config, fig, animator, blitter)
+        log.info("Stopped rendering.")
+    else:
+        if blit:
+            # Drive the frames with a timer, the BlitManager draws them
+            log.info("Creating blitted view animator...")
+            animator.init()
+            frames = itertools.count()
+            timer = fig.canvas.new_timer(interval=frame_interval)
+            timer.add_callback(lambda: animator(next(frames)))
+            timer.start()
+        else:
+            log.info("Creating view animator...")
+            anim = FuncAnimation(fig, animator, init_func=animator.init, 
+                                 blit=False, interval=frame_interval)
 
-    DEBUG(1, "Main: Starting up view...")
-    plt.show()
-    DEBUG(1, "Main: Closed view.")
-    DEBUG(1, "Main: Telling other threads to shut down...")
+        log.info("Starting up view...")
+        plt.show()
+        log.info("Closed view.")
+    log.info("Telling other threads to shut down...")
     end_signal.set()
+    if metrics_server is not None:
+        metrics_server.close()
+    io.join()
+    Satellites.close()
+    proximity.close()
+    if analyzer is not None:
+        analyzer.close()
+    if recorder is not None:
+        recorder.close()
     
 
 
@@ -0,0 +1,235 @@
+import json
+import time
+import logging
+import threading
+from bisect import bisect_right
+from math import sqrt
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# The metrics are measurements taken all over the program: how long each layer took to
+# draw in a frame, how many aircraft and satellites were drawn, how many messages came in
+# from the aircraft stream, how long received aircraft data waited before it was drawn,
+# how long a skycam image took to decode and how long the telescope took to answer.
+#
+# Every measured quantity has a histogram of a fixed size, with logarithmic buckets from
+# 1e-6 to 1e6 (in seconds, or in the units of a count), ten buckets per decade, so taking
+# a measurement is only a bisection and an increment, and the memory used never grows.
+# Counted events (like received messages) keep their counts for each of the last 60
+# seconds, for the rate per second over the last minute.
+#
+# The measurements go into one registry for the whole program, through the functions of
+# this module: observe() and add(). They can be printed as a summary line every
+# summary_interval seconds, and served as JSON at /metrics, by a MetricsServer or (in
+# headless mode) by the FrameServer.
+
+BOUNDS = [10**(e / 10) for e in range(-60, 61)]
+WINDOW = 60 # seconds
+
+
+class Histogram:
+    def __init__(self, unit):
+        self.unit = unit
+        self.counts = [0] * (len(BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = float("inf")
+        self.max = float("-inf")
+
+    def observe(self, value):
+        self.counts[bisect_right(BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q):
+        """Estimate the value below which the fraction q of the measurements are, from
+        the middle of the bucket it falls into."""
+        if not self.count:
+            return None
+        target = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= target and n:
+                break
+        low = BOUNDS[i-1] if i > 0 else self.min
+        high = BOUNDS[i] if i < len(BOUNDS) else self.max
+        value = sqrt(low * high) if low > 0 else high
+        return min(max(value, self.min), self.max)
+
+    def snapshot(self):
+        if not self.count:
+            return {"unit": self.unit, "count": 0}
+        return {"unit": self.unit, "count": self.count, "mean": self.total / self.count,
+                "min": self.min, "max": self.max, "p50": self.percentile(0.5),
+                "p90": self.percentile(0.9), "p99": self.percentile(0.99)}
+
+
+class Counter:
+    def __init__(self, start):
+        self.start = start
+        self.total = 0
+        self.seconds = [0] * WINDOW
+        self.stamps = [0] * WINDOW
+
+    def add(self, n, now):
+        second = int(now)
+        i = second % WINDOW
+        if self.stamps[i] != second:
+            self.stamps[i] = second
+            self.seconds[i] = 0
+        self.seconds[i] += n
+        self.total += n
+
+    def rate(self, now):
+        """Events per second over the last minute (or since the start)."""
+        second = int(now)
+        recent = sum(n for n, stamp in zip(self.seconds, self.stamps)
+                      if 0 <= second - stamp < WINDOW)
+        return recent / max(1.0, min(WINDOW, now - self.start))
+
+    def snapshot(self, now):
+        return {"total": self.total, "rate": self.rate(now)}
+
+
+class Metrics:
+    def __init__(self):
+        self.enabled = True
+        self.start = time.monotonic()
+        self.histograms = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def observe(self, name, value, unit="s"):
+        if not self.enabled:
+            return
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(unit)
+            histogram.observe(value)
+
+    def add(self, name, n=1):
+        if not self.enabled:
+            return
+        now = time.monotonic()
+        with self.lock:
+            counter = self.counters.get(name)
+            if counter is None:
+                counter = self.counters[name] = Counter(now)
+            counter.add(n, now)
+
+    def snapshot(self):
+        now = time.monotonic()
+        with self.lock:
+            return {
+                "uptime": now - self.start,
+                "histograms": {name: histogram.snapshot() for name, histogram
+                               in sorted(self.histograms.items())},
+                "counters": {name: counter.snapshot(now) for name, counter
+                             in sorted(self.counters.items())},
+            }
+
+    def summary(self):
+        """Return one line with the median and 99th percentile of each quantity and the
+        rate of each counter."""
+        snapshot = self.snapshot()
+        parts = []
+        for name, h in snapshot["histograms"].items():
+            if not h["count"]:
+                continue
+            if h["unit"] == "s":
+                parts.append("{} {:.1f}/{:.1f} ms".format(name, 1000*h["p50"],
+                                                          1000*h["p99"]))
+            else:
+                parts.append("{} {:.0f}/{:.0f}".format(name, h["p50"], h["p99"]))
+        for name, c in snapshot["counters"].items():
+            parts.append("{} {:.1f}/s".format(name, c["rate"]))
+        return ", ".join(parts)
+
+
+_metrics = Metrics()
+log = logging.getLogger("skycam.Metrics")
+
+
+def configure(config):
+    _metrics.enabled = config.get("metrics", {}).get("enabled", True)
+
+
+def enabled():
+    return _metrics.enabled
+
+
+def observe(name, value, unit="s"):
+    """Add a measurement to the histogram of the named quantity. The unit is "s" for
+    durations in seconds, or "" for counts."""
+    _metrics.observe(name, value, unit)
+
+
+def add(name, n=1):
+    """Count n events of the named kind."""
+    _metrics.add(name, n)
+
+
+def snapshot():
+    """Return the statistics of all quantities, as a dict that can be saved as JSON."""
+    return _metrics.snapshot()
+
+
+def summary():
+    return _metrics.summary()
+
+
+def log_summary():
+    """Print the summary line. Meant to be run as a job of the FrameScheduler."""
+    log.info("%s", summary())
+    return []
+
+
+class MetricsServer:
+    """Serves the snapshot of the metrics as JSON at http://address:port/metrics."""
+
+    def __init__(self, config):
+        self.log = logging.getLogger("skycam.MetricsServer")
+        settings = config.get("metrics", {})
+        self.address = settings.get("address", "127.0.0.1")
+        self.port = settings.get("port", 0)
+        self.server = ThreadingHTTPServer((self.address, self.port), MetricsRequestHandler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+    def start(self):
+        self.log.info("Serving on http://%s:%s/metrics", self.address, self.port)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.thread is not None:
+            self.thread.join()
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        send_metrics(self)
+
+
+def send_metrics(request):
+    """Send the snapshot of the metrics as the reply to an HTTP request."""
+    data = json.dumps(snapshot()).encode("utf-8")
+    request.send_response(200)
+    request.send_header("Content-Type", "application/json")
+    request.send_header("Content-Length", str(len(data)))
+    request.send_header("Cache-Control", "no-cache")
+    request.end_headers()
+    request.wfile.write(data)
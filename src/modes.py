@@ -0,0 +1,118 @@
+import re
+import time
+
+# The ModeSDecoder extracts aircraft messages from the XML stream of the AirNav RadarBox.
+# The stream is a sequence of flat <MODESMESSAGE> elements, so instead of running a
+# general XML parser, the decoder finds the message boundaries in a reusable byte buffer
+# and picks out only the fields we use with one regular expression per message. Messages
+# split across reads stay in the buffer until the rest arrives.
+
+# The data fields we want to read for each aircraft
+USED_DATA_FIELDS = [
+    "DATETIME", "MODES", "CALLSIGN", "ALTITUDE", "VRATE",
+    "GROUNDSPEED", "TRACK", "LATITUDE","LONGITUDE"
+]
+CRITICAL_FIELDS = ["DATETIME", "ALTITUDE", "LATITUDE", "LONGITUDE"]
+
+START = b"<MODESMESSAGE>"
+END = b"</MODESMESSAGE>"
+FIELD = re.compile(b"<(" + b"|".join(f.encode("ascii") for f in USED_DATA_FIELDS)
+                   + b")>([^<]+)</\\1>")
+
+def verify_fields(data):
+    for field in CRITICAL_FIELDS:
+        if not field in data:
+            return False
+    return True
+
+
+_hour_cache = {}
+
+def parse_timestamp(text):
+    """Convert a RadarBox timestamp (YYYYmmddHHMMSS, local time) to POSIX time.
+    The start of each hour is computed once and cached, so this is much cheaper than
+    datetime.strptime. Raises ValueError for a malformed timestamp."""
+    if len(text) != 14:
+        raise ValueError("Bad timestamp '{}'".format(text))
+    hour = text[:10]
+    base = _hour_cache.get(hour)
+    if base is None:
+        if len(_hour_cache) > 1000:
+            _hour_cache.clear()
+        base = time.mktime((int(text[:4]), int(text[4:6]), int(text[6:8]),
+                            int(text[8:10]), 0, 0, 0, 0, -1))
+        _hour_cache[hour] = base
+    return base + int(text[10:12]) * 60 + int(text[12:14])
+
+
+class ModeSDecoder:
+    def __init__(self, size=65536):
+        self.buffer = bytearray(size)
+        self.length = 0 # number of bytes of data in the buffer
+        self.messages = 0
+        self.malformed = 0
+
+    def reserve(self, size):
+        """Make sure there is room for at least the given number of new bytes."""
+        if self.length + size > len(self.buffer):
+            self.buffer.extend(bytes(max(size, len(self.buffer))))
+
+    def space(self, size=16384):
+        """Return a view of free space in the buffer, for reading data directly into
+        it. Call advance() with the number of bytes read."""
+        self.reserve(size)
+        return memoryview(self.buffer)[self.length:self.length + size]
+
+    def advance(self, n):
+        self.length += n
+
+    def recv_into(self, sock, size=16384):
+        """Read from the socket directly into the buffer. Returns the number of bytes
+        read, which is 0 when the stream has ended."""
+        n = sock.recv_into(self.space(size))
+        self.advance(n)
+        return n
+
+    def feed(self, data):
+        """Add data to the buffer (for sources other than sockets)."""
+        self.reserve(len(data))
+        self.buffer[self.length:self.length + len(data)] = data
+        self.length += len(data)
+
+    def decode(self):
+        """Extract all complete messages from the buffer and return them as a list of
+        dicts of the used fields. Incomplete messages are kept for the next call, and
+        malformed ones (missing critical fields) are counted and skipped."""
+        buf = self.buffer
+        output = []
+        pos = 0
+        while True:
+            start = buf.find(START, pos, self.length)
+            if start < 0:
+                # Keep a possible partial start tag at the end of the buffer
+                pos = max(pos, self.length - len(START) + 1)
+                break
+            end = buf.find(END, start, self.length)
+            if end < 0:
+                pos = start
+                break
+            # A new message starting before this one ends means this one was cut off
+            restart = buf.find(START, start + len(START), end)
+            if restart >= 0:
+                self.malformed += 1
+                pos = restart
+                continue
+            pos = end + len(END)
+            data = {tag.decode("ascii"): value.decode("utf-8", "replace")
+                    for tag, value in FIELD.findall(buf, start, end)}
+            if "MODES" in data and verify_fields(data):
+                output.append(data)
+            else:
+                self.malformed += 1
+        # Move the remaining partial data to the start of the buffer
+        remaining = self.length - pos
+        if remaining > 0 and pos > 0:
+            buf[:remaining] = buf[pos:self.length]
+        self.length = max(remaining, 0)
+        self.messages += len(output)
+        return output
@@ -0,0 +1,263 @@
+# coding: utf8
+import time
+import logging
+import datetime
+import toml
+from sys import argv
+from numpy import (pi, inf, arange, array, zeros, argsort, unique, concatenate, int64,
+                   float64)
+from propagator import Propagator, unix_time
+from tlecache import load_tles
+from tlestore import ElementStore
+
+# The PassIndex predicts when each satellite in the Propagator catalog is above the
+# minimum altitude and within the maximum range, for some hours ahead. The pass windows
+# are kept in sorted arrays, so finding the satellites that are up at a given time (or
+# during a given interval) does not require computing their positions.
+#
+# Windows are computed from positions sampled every `pass_step` seconds, and widened by
+# one step on both sides so that the edges of the passes are not cut off. Passes shorter
+# than one step can be missed. The windows of a satellite start trace_backward samples
+# of the traces before the time they are first computed, so that the traces of the
+# satellites that set just before can be drawn as well.
+#
+# The windows are extended before they run out, when less than half the horizon is left,
+# by extend() a few satellites at a time, or by computing the positions elsewhere (e.g.
+# in the TracePool) for the blocks given by pending() and giving them to add(). Neither
+# query() nor passes() computes anything, and neither does reload(), which only forgets
+# the windows of the element sets no longer in the catalog. If the clock goes back
+# before the windows of a satellite, or forward past them, they are computed again from
+# scratch.
+
+
+class PassIndex:
+    def __init__(self, propagator, config):
+        self.log = logging.getLogger("skycam.PassIndex")
+        self.propagator = propagator
+        self.horizon = config["satellite"].get("pass_horizon", 24.0) * 3600
+        self.step = float(config["satellite"].get("pass_step", 60.0))
+        self.min_altitude = config["satellite"]["min_altitude"] * pi/180
+        self.max_range = config["satellite"]["max_range"] * 1000.0
+        self.backward = max(self.step, config["satellite"]["trace_backward"] *
+                                       config["satellite"]["trace_interval"])
+        # Windows for each element set, keyed by the TLE lines, so that satellites whose
+        # elements did not change keep their windows when the catalog is reloaded, and
+        # the times from which and until which they have been computed
+        self.windows = {}
+        self.since = {}
+        self.until = {}
+        self.valid_until = 0.0
+        self.valid_from = 0.0
+        self.complete = True
+        # Catalog indices of the satellites without windows yet
+        self.unknown = zeros(0, dtype=int64)
+        # Changes whenever windows are discarded, so that positions computed elsewhere
+        # for them can be recognized
+        self.generation = 0
+        self.starts = zeros(0)
+        self.ends = zeros(0)
+        self.index = zeros(0, dtype=int64)
+
+    def keys(self):
+        return [(line1, line2) for name, line1, line2 in self.propagator.tles]
+
+    def discard(self, now):
+        """Forget the windows of satellites no longer in the catalog, and of those
+        whose windows do not reach back to the given time or have already ended."""
+        current = set(self.keys())
+        t = now - self.backward
+        stale = [key for key in self.windows if key not in current or
+                 self.since[key] > t + self.step or self.until[key] < t]
+        for key in stale:
+            del self.windows[key]
+            del self.since[key]
+            del self.until[key]
+        if stale:
+            self.generation += 1
+        return bool(stale)
+
+    def pending(self, now):
+        """Return the satellites whose windows must be computed or extended until now
+        plus the horizon: a list of the catalog indices of the satellites without
+        windows, which start from now minus trace_backward, and a list of (catalog
+        index, time until which computed) pairs of the others."""
+        new, old = [], []
+        for i, key in enumerate(self.keys()):
+            if key not in self.until:
+                new.append(i)
+            elif self.until[key] < now + self.horizon / 2:
+                old.append((i, self.until[key]))
+        return new, old
+
+    def due(self, now):
+        """Tell if extend() has anything to do at the given POSIX time."""
+        t = now - self.backward
+        return (not self.complete or now + self.horizon / 2 > self.valid_until or
+                self.valid_from > t + self.step)
+
+    def reload(self, now=None):
+        """Index the windows again after the catalog has changed. The satellites that
+        are new in it are left for extend()."""
+        t = time.time() if now is None else unix_time(now)[0]
+        self.discard(t)
+        self.update(t)
+
+    def rebuild(self, now=None):
+        """Compute all the windows that are missing or about to run out."""
+        self.extend(now)
+
+    def extend(self, now=None, limit=None):
+        """Compute the windows of at most limit of the satellites returned by
+        pending(). Returns the number of satellites left to do."""
+        t = time.time() if now is None else unix_time(now)[0]
+        changed = self.discard(t)
+        new, old = self.pending(t)
+        pending = [(i, t - self.backward) for i in new] + old
+        todo = pending[:limit] if limit is not None else pending
+        # Satellites are grouped by the time from which they are computed, so each group
+        # can be propagated in one call
+        groups = {}
+        for i, t0 in todo:
+            groups.setdefault(t0, []).append(i)
+        for t0, index in groups.items():
+            self.compute(index, t0, t + self.horizon)
+        if groups or changed:
+            self.update(t)
+        return len(pending) - len(todo)
+
+    def compute(self, index, t0, t1):
+        """Sample the given satellites from t0 to t1 and add their pass windows."""
+        self.log.debug("Predicting passes for %d satellites.", len(index))
+        times = arange(t0, t1 + self.step, self.step)
+        alt, az, rng, eclipsed = self.propagator.compute(times, index)
+        keys = self.keys()
+        self.add([keys[i] for i in index], times, alt, rng)
+
+    def add(self, keys, times, alt, rng):
+        """Add the pass windows found in the positions of the satellites with the given
+        keys (TLE lines) at the given times. Positions that do not continue from where
+        the windows of a satellite end are ignored. Call update() afterwards."""
+        up = (alt > self.min_altitude) & (rng < self.max_range)
+        # Widen by one sample on each side and find the start and end of each run
+        wide = up.copy()
+        wide[:,1:] |= up[:,:-1]
+        wide[:,:-1] |= up[:,1:]
+        edges = zeros((len(keys), len(times) + 1), dtype=int)
+        edges[:,:-1] += wide
+        edges[:,1:] -= wide
+        rise_sat, rise = (edges == 1).nonzero()
+        set_sat, setting = (edges == -1).nonzero()
+        accepted = []
+        for key in keys:
+            until = self.until.get(key)
+            accepted.append(until is None or until == times[0])
+            if not accepted[-1]:
+                continue
+            if until is None:
+                self.windows[key] = []
+                self.since[key] = times[0]
+            self.until[key] = times[-1]
+        for k, start, end in zip(rise_sat, rise, setting):
+            if not accepted[k]:
+                continue
+            windows = self.windows[keys[k]]
+            start, end = times[start], times[end - 1]
+            # Join with a window that was open at the end of the previous computation
+            if windows and windows[-1][1] >= start - self.step:
+                windows[-1][1] = max(end, windows[-1][1])
+            else:
+                windows.append([start, end])
+
+    def update(self, now):
+        """Forget the windows that have ended and index the others."""
+        self.prune(now)
+        self.build_index()
+        keys = [key for key in self.keys() if key in self.until]
+        self.complete = len(keys) == len(self.propagator.tles)
+        self.unknown = array([i for i, key in enumerate(self.keys())
+                              if key not in self.until], dtype=int64)
+        self.valid_until = min((self.until[key] for key in keys), default=inf)
+        self.valid_from = max((self.since[key] for key in keys), default=-inf)
+
+    def prune(self, t):
+        """Forget windows that have ended before the window of the traces around the
+        given time."""
+        t = t - self.backward
+        for key, windows in self.windows.items():
+            self.windows[key] = [w for w in windows if w[1] >= t]
+            self.since[key] = max(self.since[key], t)
+
+    def build_index(self):
+        """Collect the windows of all satellites into arrays sorted by start time."""
+        starts, ends, index = [], [], []
+        for i, key in enumerate(self.keys()):
+            for start, end in self.windows.get(key, []):
+                starts.append(start)
+                ends.append(end)
+                index.append(i)
+        order = argsort(starts, kind="stable")
+        self.starts = array(starts, dtype=float64)[order]
+        self.ends = array(ends, dtype=float64)[order]
+        self.index = array(index, dtype=int64)[order]
+
+    def query(self, t0, t1=None, unknown=False):
+        """Return the catalog indices of the satellites that are up at some point
+        between the times t0 and t1 (datetimes or POSIX timestamps), and if unknown is
+        set, those whose windows have not been computed yet."""
+        t0 = unix_time(t0)[0]
+        t1 = t0 if t1 is None else unix_time(t1)[0]
+        n = self.starts.searchsorted(t1, side="right")
+        index = self.index[:n][self.ends[:n] >= t0]
+        if unknown:
+            index = concatenate([index, self.unknown])
+        return unique(index)
+
+    def passes(self, t0, t1):
+        """Return a list of (name, start, end) tuples for the passes between the times
+        t0 and t1, sorted by start time. Times are POSIX timestamps."""
+        t0 = unix_time(t0)[0]
+        t1 = unix_time(t1)[0]
+        n = self.starts.searchsorted(t1, side="right")
+        names = self.propagator.names
+        return [(names[i], start, end) for i, start, end
+                in zip(self.index[:n], self.starts[:n], self.ends[:n]) if end >= t0]
+
+
+if __name__=="__main__":
+    # Print the upcoming passes of all satellites in the configured lists
+    config = toml.loads(open(argv[1]).read())
+    hours = float(argv[2]) if len(argv) > 2 else 12.0
+    horizon = config["satellite"].get("pass_horizon", 24.0)
+    config["satellite"]["pass_horizon"] = max(hours, horizon)
+    P = Propagator(config)
+    store = ElementStore(config)
+    now = time.time()
+    tles = []
+    elements = []
+    # Lists with satellite numbers are in the element store, the others in their files
+    for listname, sat_list in config["satellite"]["list"].items():
+        numbers = sat_list.get("numbers")
+        try:
+            if numbers is None:
+                new_tles, new_elements = load_tles("{}.txt".format(listname))
+            else:
+                new_tles, new_elements = store.select(numbers, now)
+        except IOError:
+            print("Unable to open '{}.txt'.".format(listname))
+            continue
+        if not new_tles:
+            print("No elements for list '{}'.".format(listname))
+            continue
+        tles += new_tles
+        elements.append(new_elements)
+    if any(e is None for e in elements):
+        elements = None
+    elif elements:
+        elements = concatenate(elements)
+    P.load(tles, elements)
+    index = PassIndex(P, config)
+    index.rebuild(now)
+    for name, start, end in index.passes(now, now + hours * 3600):
+        start = datetime.datetime.fromtimestamp(start).strftime("%Y-%m-%d %H:%M")
+        end = datetime.datetime.fromtimestamp(end).strftime("%H:%M")
+        print("{:<24} {} - {}".format(name, start, end))
@@ -0,0 +1,252 @@
+import json
+import hashlib
+import logging
+from os import path, replace
+from numpy import (sin, cos, tan, arctan2, sqrt, pi, sign, abs, interp, linspace, arange,
+                   indices, float32, rint, load, savez, zeros, newaxis, broadcast_arrays)
+
+# The SkyProjection is the calibrated model of the all-sky camera's fisheye lens: where
+# on the image (in pixels of the full-size image, x to the right and y down) each
+# direction of the sky (zenith angle and azimuth) is seen. The distance of a pixel from
+# the center (center_x, center_y) grows with the zenith angle according to the lens
+# projection (equidistant, equisolid, stereographic or orthographic), corrected by the
+# polynomial distortion terms, so that the horizon is radius pixels from the center.
+# North is north_offset degrees counterclockwise from the right of the image, and the
+# azimuth grows counterclockwise (direction 1, as seen from below) or clockwise (-1).
+#
+# The polar Axes of the symbols is given a radial scale following the projection by
+# set_projection(), and is placed over the image by align_overlay(), so that the
+# aircraft and satellites are drawn on the exact pixels where the camera sees them.
+#
+# For work on every pixel, lut() gives a SkyLUT with the zenith angle and azimuth of
+# every pixel of an image, computed once and kept in a cache file next to the images,
+# keyed by the calibration and the image size. With it, masking the image below the
+# horizon, statistics of a region of the sky and reprojecting the image onto a
+# rectangular altitude/azimuth map are all array lookups.
+
+RAD = pi/180
+
+# Radius as a function of the zenith angle for each kind of lens, up to a scale
+PROJECTIONS = {
+    "equidistant": lambda z: z,
+    "equisolid": lambda z: 2*sin(z/2),
+    "stereographic": lambda z: 2*tan(z/2),
+    "orthographic": lambda z: sin(z),
+}
+
+# Largest zenith angle of the inverse table, in radians
+MAX_ZENITH = 100 * RAD
+
+log = logging.getLogger("skycam.SkyProjection")
+
+
+class SkyProjection:
+    def __init__(self, config, size=None):
+        """The calibration is read from the [skycam] section. Without center_x,
+        center_y and radius, the lens is assumed to fill the height of an image of the
+        given (width, height)."""
+        settings = config["skycam"]
+        self.center_x = settings.get("center_x")
+        self.center_y = settings.get("center_y")
+        self.radius = settings.get("radius")
+        if size is not None:
+            width, height = size
+            if self.center_x is None:
+                self.center_x = (width - 1) / 2
+            if self.center_y is None:
+                self.center_y = (height - 1) / 2
+            if self.radius is None:
+                self.radius = min(size) / 2
+        if None in (self.center_x, self.center_y, self.radius):
+            raise ValueError("Without an image, center_x, center_y and radius are needed")
+        self.north_offset = settings.get("north_offset", 0.0) * RAD
+        self.direction = 1 if settings.get("direction", 1) >= 0 else -1
+        self.projection = settings.get("projection", "equidistant")
+        if self.projection not in PROJECTIONS:
+            raise ValueError("Unknown projection '{}'".format(self.projection))
+        self.distortion = list(settings.get("distortion", []))
+        self.cache_dir = settings.get("image_path", ".")
+        self.scale = self.radius / self.normalized(pi/2)
+        # Table for the inverse of the radius function
+        self.table_zenith = linspace(0.0, MAX_ZENITH, 4096)
+        self.table_radius = self.radius_of(self.table_zenith)
+        self.luts = {}
+
+    def normalized(self, zenith):
+        g = PROJECTIONS[self.projection]
+        u = g(zenith) / g(pi/2)
+        correction = 1.0
+        for k, coefficient in enumerate(self.distortion):
+            correction = correction + coefficient * u**(2*k + 2)
+        return u * correction
+
+    def radius_of(self, zenith):
+        """Distance in pixels from the center of the image of the given zenith angles
+        (radians)."""
+        return sign(zenith) * self.scale * self.normalized(abs(zenith))
+
+    def zenith_of(self, radius):
+        """Zenith angles (radians) seen at the given distances from the center."""
+        return sign(radius) * interp(abs(radius), self.table_radius, self.table_zenith)
+
+    def pixels(self, zenith, az):
+        """Return the pixel coordinates (x, y) of the given directions."""
+        r = self.radius_of(zenith)
+        angle = self.north_offset + self.direction * az
+        return self.center_x + r*cos(angle), self.center_y - r*sin(angle)
+
+    def sky(self, x, y):
+        """Return the zenith angles and azimuths (radians) seen at the given pixel
+        coordinates."""
+        dx = x - self.center_x
+        dy = self.center_y - y
+        zenith = self.zenith_of(sqrt(dx**2 + dy**2))
+        az = self.direction * (arctan2(dy, dx) - self.north_offset) % (2*pi)
+        return zenith, az
+
+    def calibration(self):
+        return {"center_x": self.center_x, "center_y": self.center_y,
+                "radius": self.radius, "north_offset": self.north_offset,
+                "direction": self.direction, "projection": self.projection,
+                "distortion": self.distortion}
+
+    def key(self, shape, size):
+        """Hash of the calibration, the shape of the image array and the full size of
+        the image, naming the cache file of the lookup table."""
+        text = json.dumps([self.calibration(), list(shape), list(size)], sort_keys=True)
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+
+    def lut(self, shape, size=None):
+        """Return the SkyLUT of an image array of the given shape (height, width), which
+        may be downscaled from the full size (width, height) of the image. The table is
+        read from its cache file, or computed and saved there."""
+        shape = tuple(shape[:2])
+        size = tuple(size) if size is not None else (shape[1], shape[0])
+        key = self.key(shape, size)
+        lut = self.luts.get(key)
+        if lut is not None:
+            return lut
+        cachefile = path.join(self.cache_dir, ".skycam-lut-{}.npz".format(key))
+        try:
+            with load(cachefile) as cache:
+                lut = SkyLUT(cache["zenith"], cache["az"])
+            log.debug("Using the lookup table in '%s'.", cachefile)
+        except (IOError, ValueError, KeyError):
+            lut = self.compute_lut(shape, size)
+            try:
+                temp = cachefile + ".tmp"
+                with open(temp, "wb") as f:
+                    savez(f, zenith=lut.zenith, az=lut.az)
+                replace(temp, cachefile)
+            except IOError as e:
+                log.warning("Unable to write '%s': %s", cachefile, e)
+        self.luts[key] = lut
+        return lut
+
+    def compute_lut(self, shape, size):
+        log.debug("Computing the lookup table for %dx%d pixels.", shape[1], shape[0])
+        y, x = indices(shape[:2], dtype=float32)
+        # Pixel centers of a downscaled image in the coordinates of the full image
+        sx, sy = size[0] / shape[1], size[1] / shape[0]
+        zenith, az = self.sky((x + 0.5)*sx - 0.5, (y + 0.5)*sy - 0.5)
+        return SkyLUT(zenith.astype(float32), az.astype(float32))
+
+    def sky_grid(self, step=1.0, min_altitude=0.0):
+        """Return the zenith angles and azimuths of a rectangular altitude/azimuth grid
+        with the given step in degrees: one row per altitude, from the zenith down to
+        min_altitude, and one column per azimuth."""
+        alt = arange(90.0, min_altitude - 1e-9, -step) * RAD
+        az = arange(0.0, 360.0, step) * RAD
+        return broadcast_arrays((pi/2 - alt)[:,newaxis], az)
+
+    def reproject(self, image, size=None, step=1.0, min_altitude=0.0):
+        """Return the image (an array, possibly downscaled from the full size) as a
+        rectangular altitude/azimuth map with the given step in degrees, from the zenith
+        (first row) down to min_altitude, azimuth 0 (north) in the first column. The
+        nearest pixel is taken, and directions outside the image are black."""
+        height, width = image.shape[:2]
+        size = size if size is not None else (width, height)
+        zenith, az = self.sky_grid(step, min_altitude)
+        x, y = self.pixels(zenith, az)
+        # Nearest pixel of the image array
+        col = rint((x + 0.5) * width / size[0] - 0.5).astype(int)
+        row = rint((y + 0.5) * height / size[1] - 0.5).astype(int)
+        inside = (col >= 0) & (col < width) & (row >= 0) & (row < height)
+        result = zeros(zenith.shape + image.shape[2:], dtype=image.dtype)
+        result[inside] = image[row[inside], col[inside]]
+        return result
+
+
+class SkyLUT:
+    """The zenith angle and azimuth (radians, float32) of every pixel of an image."""
+
+    def __init__(self, zenith, az):
+        self.zenith = zenith
+        self.az = az
+        self.masks = {}
+
+    def below(self, altitude):
+        """Boolean mask of the pixels below the given altitude in degrees (including
+        those outside the lens)."""
+        mask = self.masks.get(altitude)
+        if mask is None:
+            mask = self.masks[altitude] = self.zenith > (90 - altitude) * RAD
+        return mask
+
+    def mask(self, image, altitude=0.0):
+        """Black out the pixels of the image below the given altitude, in place."""
+        image[self.below(altitude)] = 0
+        return image
+
+    def region(self, min_altitude, max_altitude=90.0, az_range=None):
+        """Boolean mask of the pixels between the given altitudes (degrees) and, if
+        given, within the azimuth range (degrees from north, from az_range[0] to
+        az_range[1], possibly across north)."""
+        selected = ((self.zenith >= (90 - max_altitude) * RAD)
+                    & (self.zenith <= (90 - min_altitude) * RAD))
+        if az_range is not None:
+            a0, a1 = az_range[0] * RAD % (2*pi), az_range[1] * RAD % (2*pi)
+            if a0 <= a1:
+                selected &= (self.az >= a0) & (self.az <= a1)
+            else:
+                selected &= (self.az >= a0) | (self.az <= a1)
+        return selected
+
+    def statistics(self, image, region):
+        """Return the number of pixels in the region (a mask from region()) and the mean
+        and standard deviation of their values, for each channel of the image."""
+        values = image[region].astype(float32)
+        n = len(values)
+        if not n:
+            return {"pixels": 0, "mean": None, "std": None}
+        mean = values.mean(axis=0)
+        std = values.std(axis=0)
+        return {"pixels": n, "mean": mean.tolist(), "std": std.tolist()}
+
+
+def set_projection(ax_polar, projection):
+    """Make the radial scale (zenith angle in degrees) of the polar Axes follow the
+    projection, and turn it to the north of the image. This resets the ticks."""
+    ax_polar.set_rscale("function", functions=(
+        lambda z: projection.radius_of(z * RAD),
+        lambda r: projection.zenith_of(r) / RAD))
+    ax_polar.set_theta_offset(projection.north_offset)
+    ax_polar.set_theta_direction(projection.direction)
+    ax_polar.set_ylim(0, 90)
+
+
+def align_overlay(ax_image, ax_polar, projection, size):
+    """Place the polar Axes over the image Axes so that the zenith and the horizon of
+    the projection fall on their pixels of an image of the given full size. Must be
+    done again when the size of the figure changes."""
+    width, height = size
+    ax_image.set_xlim(-0.5, width - 0.5)
+    ax_image.set_ylim(height - 0.5, -0.5)
+    ax_image.set_aspect("equal")
+    ax_image.apply_aspect()
+    # The polar Axes is a square around the circle of the horizon
+    cx, cy, R = projection.center_x, projection.center_y, projection.radius
+    corners = ax_image.transData.transform([(cx - R, cy + R), (cx + R, cy - R)])
+    figure = ax_image.figure
+    (x0, y0), (x1, y1) = figure.transFigure.inverted().transform(corners)
+    ax_polar.set_position((x0, y0, x1 - x0, y1 - y0))
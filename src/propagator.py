@@ -0,0 +1,258 @@
+# coding: utf8
+import datetime
+import logging
+import ephem
+from numpy import (pi, sin, cos, sqrt, arcsin, arctan2, array, asarray, zeros, floor,
+                   full, nan, float64, atleast_1d, radians, tan, dtype)
+try:
+    from sgp4.api import Satrec, SatrecArray, WGS72
+except ImportError:
+    Satrec = None
+
+# The Propagator keeps a whole catalog of satellites and computes their topocentric
+# positions for many satellites and many times in one call. If the sgp4 package is
+# installed, its vectorized SatrecArray is used and the rest of the computation is done
+# with NumPy on the whole catalog at once. Otherwise we fall back to PyEphem, looping
+# over the satellites but still returning the same arrays.
+
+EPOCH_UNIX_JD = 2440587.5 # Julian date of 1970-01-01 00:00 UTC
+J2000 = 2451545.0
+
+# WGS84 ellipsoid
+EARTH_RADIUS = 6378.137 # km
+FLATTENING = 1 / 298.257223563
+ECC2 = FLATTENING * (2 - FLATTENING)
+
+
+def unix_time(times):
+    """Convert a datetime, or a list of (naive UTC) datetimes, into an array of POSIX
+    timestamps. Numbers are assumed to already be timestamps."""
+    if isinstance(times, (datetime.datetime, int, float)):
+        times = [times]
+    times = list(times) if not hasattr(times, "dtype") else times
+    if len(times) and isinstance(times[0], datetime.datetime):
+        utc = datetime.timezone.utc
+        times = [t.replace(tzinfo=utc).timestamp() for t in times]
+    return asarray(times, dtype=float64)
+
+
+def read_tles(filename):
+    """Read a file of three-line element sets, as saved by spacetrack.py, into a list of
+    (name, line1, line2) tuples."""
+    tles = []
+    with open(filename) as f:
+        while True:
+            name = f.readline()
+            if name == "":
+                break
+            name = name[2:].strip()
+            line1 = f.readline().strip()
+            line2 = f.readline().strip()
+            tles.append((name, line1, line2))
+    return tles
+
+
+def element_epoch(line1):
+    """Epoch of an element set as a (naive UTC) datetime."""
+    year = int(line1[18:20])
+    year += 1900 if year >= 57 else 2000
+    day = float(line1[20:32])
+    return datetime.datetime(year, 1, 1) + datetime.timedelta(days=day - 1)
+
+
+# The mean elements needed to initialize SGP4, as stored in the cache
+ELEMENTS = dtype([
+    ("satnum", "i8"), ("epoch", "f8"), ("bstar", "f8"), ("ndot", "f8"), ("nddot", "f8"),
+    ("ecco", "f8"), ("argpo", "f8"), ("inclo", "f8"), ("mo", "f8"), ("no_kozai", "f8"),
+    ("nodeo", "f8")
+])
+
+# SGP4 epochs are counted in days from 1949 December 31 00:00 UT
+SGP4_EPOCH_JD = 2433281.5
+
+
+def parse_elements(tles):
+    """Parse the element sets into an array of ELEMENTS, or None if sgp4 is missing."""
+    if Satrec is None:
+        return None
+    elements = []
+    for name, line1, line2 in tles:
+        s = Satrec.twoline2rv(line1, line2)
+        elements.append((s.satnum, s.jdsatepoch - SGP4_EPOCH_JD + s.jdsatepochF,
+                         s.bstar, s.ndot, s.nddot, s.ecco, s.argpo, s.inclo, s.mo,
+                         s.no_kozai, s.nodeo))
+    return array(elements, dtype=ELEMENTS)
+
+
+def make_satrec(element):
+    """Initialize an SGP4 satellite record from one row of ELEMENTS."""
+    sat = Satrec()
+    sat.sgp4init(WGS72, "i", int(element["satnum"]), *[float(element[field])
+                 for field in ELEMENTS.names[1:]])
+    return sat
+
+
+def julian_date(unix):
+    """Split POSIX timestamps into the (jd, fraction) pair used by SGP4."""
+    jd = unix / 86400.0 + EPOCH_UNIX_JD
+    whole = floor(jd - 0.5) + 0.5
+    return whole, jd - whole
+
+
+def gmst(jd, fr):
+    """Greenwich mean sidereal time in radians (IAU 1982 model, UT1 = UTC)."""
+    t = ((jd - J2000) + fr) / 36525.0
+    seconds = (67310.54841 + (876600.0 * 3600 + 8640184.812866) * t
+               + 0.093104 * t**2 - 6.2e-6 * t**3)
+    return (seconds % 86400.0) / 86400.0 * 2 * pi
+
+
+def sun_direction(jd, fr):
+    """Unit vector towards the Sun in the equatorial system of date, from the low
+    precision formulae of the Astronomical Almanac. Good to about 0.01 degrees,
+    which is plenty for an eclipse test."""
+    n = (jd - J2000) + fr
+    L = radians(280.460 + 0.9856474 * n)
+    g = radians(357.528 + 0.9856003 * n)
+    lam = L + radians(1.915) * sin(g) + radians(0.020) * sin(2*g)
+    eps = radians(23.439 - 0.0000004 * n)
+    return array([cos(lam), cos(eps) * sin(lam), sin(eps) * sin(lam)])
+
+
+def refraction(alt):
+    """Atmospheric refraction in radians for a true altitude in radians, using the
+    formula of Saemundsson for standard pressure and temperature (the PyEphem defaults).
+    Like PyEphem, no correction is applied well below the horizon."""
+    h = alt * 180/pi
+    h[~(h > -1.0)] = -1.0
+    R = radians(1.02 / tan(radians(h + 10.3 / (h + 5.11))) / 60)
+    R[h == -1.0] = 0.0
+    return R
+
+
+def observer_position(lat, lon, elevation):
+    """Earth-fixed position of the observer in km, and the rows of the rotation matrix
+    from the Earth-fixed system to local east, north and up."""
+    lat = lat * pi/180
+    lon = lon * pi/180
+    h = elevation / 1000.0
+    N = EARTH_RADIUS / sqrt(1 - ECC2 * sin(lat)**2)
+    position = array([
+        (N + h) * cos(lat) * cos(lon),
+        (N + h) * cos(lat) * sin(lon),
+        (N * (1 - ECC2) + h) * sin(lat)
+    ])
+    enu = array([
+        [-sin(lon), cos(lon), 0.0],
+        [-sin(lat)*cos(lon), -sin(lat)*sin(lon), cos(lat)],
+        [cos(lat)*cos(lon), cos(lat)*sin(lon), sin(lat)]
+    ])
+    return position, enu
+
+
+class Propagator:
+    def __init__(self, config):
+        self.log = logging.getLogger("skycam.Propagator")
+        self.lat = config["location"]["latitude"]
+        self.lon = config["location"]["longitude"]
+        self.elevation = config["location"]["elevation"]
+        self.position, self.enu = observer_position(self.lat, self.lon, self.elevation)
+        self.observer = ephem.Observer()
+        self.observer.lat = str(self.lat)
+        self.observer.lon = str(self.lon)
+        self.observer.elevation = self.elevation
+        self.vectorized = Satrec is not None
+        self.names = []
+        self.tles = []
+        self.satrecs = []
+        self.bodies = []
+        self._subset = (None, None)
+
+    def __len__(self):
+        return len(self.names)
+
+    def load(self, tles, elements=None):
+        """Replace the catalog with the given list of (name, line1, line2) tuples. If the
+        parsed elements of the satellites are given, the lines are not parsed again."""
+        self.names = [name for name, line1, line2 in tles]
+        self.tles = list(tles)
+        if self.vectorized and elements is not None:
+            self.satrecs = [make_satrec(element) for element in elements]
+        elif self.vectorized:
+            self.satrecs = [Satrec.twoline2rv(line1, line2) for _, line1, line2 in tles]
+        else:
+            self.bodies = [ephem.readtle(*tle) for tle in tles]
+        self._subset = (None, None)
+        self.log.debug("Loaded %d satellites (%s).", len(tles),
+                       "sgp4" if self.vectorized else "PyEphem")
+
+    def _array(self, index):
+        """Return a SatrecArray for the given subset of the catalog, reusing the last
+        one if the subset did not change."""
+        key = None if index is None else tuple(index)
+        if self._subset[0] != key or self._subset[1] is None:
+            sats = self.satrecs if index is None else [self.satrecs[i] for i in index]
+            self._subset = (key, SatrecArray(sats))
+        return self._subset[1]
+
+    def compute(self, times, index=None):
+        """Compute alt, az (radians), range (m) and eclipse status for the satellites
+        in the catalog (or the subset given by index) at the given times.
+        Returns four arrays of shape (satellites, times). Satellites that could not
+        be propagated get NaN coordinates."""
+        unix = atleast_1d(unix_time(times))
+        if index is not None:
+            index = [int(i) for i in index]
+        count = len(self.names) if index is None else len(index)
+        if count == 0 or len(unix) == 0:
+            shape = (count, len(unix))
+            return zeros(shape), zeros(shape), zeros(shape), zeros(shape, dtype=bool)
+        if self.vectorized:
+            return self._compute_sgp4(unix, index)
+        return self._compute_ephem(unix, index)
+
+    def _compute_sgp4(self, unix, index):
+        jd, fr = julian_date(unix)
+        error, r, v = self._array(index).sgp4(jd, fr)
+        # r has shape (satellites, times, 3) in the TEME frame, in km
+        x, y, z = r[..., 0], r[..., 1], r[..., 2]
+        theta = gmst(jd, fr)
+        xe = cos(theta) * x + sin(theta) * y
+        ye = -sin(theta) * x + cos(theta) * y
+        dx = xe - self.position[0]
+        dy = ye - self.position[1]
+        dz = z - self.position[2]
+        east = self.enu[0, 0]*dx + self.enu[0, 1]*dy
+        north = self.enu[1, 0]*dx + self.enu[1, 1]*dy + self.enu[1, 2]*dz
+        up = self.enu[2, 0]*dx + self.enu[2, 1]*dy + self.enu[2, 2]*dz
+        rng = sqrt(dx**2 + dy**2 + dz**2)
+        alt = arcsin(up / rng)
+        alt += refraction(alt)
+        az = arctan2(east, north) % (2*pi)
+        # Cylindrical shadow: behind the Earth as seen from the Sun
+        sun = sun_direction(jd, fr)
+        s = x * sun[0] + y * sun[1] + z * sun[2]
+        eclipsed = (s < 0) & (x**2 + y**2 + z**2 - s**2 < EARTH_RADIUS**2)
+        failed = error != 0
+        alt[failed] = nan
+        az[failed] = nan
+        rng[failed] = nan
+        return alt, az, rng * 1000.0, eclipsed
+
+    def _compute_ephem(self, unix, index):
+        bodies = self.bodies if index is None else [self.bodies[i] for i in index]
+        shape = (len(bodies), len(unix))
+        alt, az, rng = full(shape, nan), full(shape, nan), full(shape, nan)
+        eclipsed = zeros(shape, dtype=bool)
+        for j, t in enumerate(unix):
+            self.observer.date = datetime.datetime.utcfromtimestamp(t)
+            for i, sat in enumerate(bodies):
+                try:
+                    sat.compute(self.observer)
+                except RuntimeError:
+                    continue
+                alt[i, j] = float(sat.alt)
+                az[i, j] = float(sat.az)
+                rng[i, j] = sat.range
+                eclipsed[i, j] = sat.eclipsed
+        return alt, az, rng, eclipsed
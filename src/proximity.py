@@ -0,0 +1,173 @@
+import json
+import time
+import logging
+from collections import deque
+from numpy import sin, cos, sqrt, arcsin, minimum, where, full, inf, pi
+import metrics
+
+# The ProximityMonitor warns when an aircraft (or, optionally, a satellite) comes near
+# the pointing direction of the telescope, or when an aircraft is close to the zenith.
+# The handlers give it the sky positions they are about to draw, and it computes the
+# angular separations of all of them from the telescope in one vectorized pass; for the
+# aircraft, the tip of the velocity vector counts as well, so that an aircraft heading
+# into the beam is warned about before it gets there. With a row of predicted positions
+# of each aircraft instead, the warning is raised when any of them is inside the cone,
+# and the alert tells how many seconds ahead it enters. The aircraft and satellites
+# warned about are drawn in their color_warning, and so is the telescope while any of
+# them is near it.
+#
+# A warning is raised as soon as an object is inside its cone (scope_radius degrees
+# around the telescope, or zenith_radius degrees around the zenith), but it is only
+# cleared once the object is clear_margin degrees farther out and the warning has lasted
+# at least hold seconds, so that the colors do not flicker at the edge of the cone.
+#
+# Every raised and cleared warning is an alert: a JSON object on its own line, e.g.
+#   {"time": 1700000000.0, "state": "raised", "kind": "aircraft", "id": "461E1F",
+#    "reason": "scope", "separation": 4.2, "eta": 10.0}
+# written into the alert_file (if set). The latest alerts are also kept in events, and
+# the warnings in effect are given by alerts().
+
+RAD = pi/180
+
+# Reasons of the warnings
+SCOPE = "scope"
+ZENITH = "zenith"
+
+
+def separation(alt0, az0, alt, az):
+    """Angular distance in radians between the direction (alt0, az0) and the directions
+    in the arrays alt and az, all in radians. Accurate for small angles as well."""
+    h = sin((alt - alt0)/2)**2 + cos(alt0)*cos(alt)*sin((az - az0)/2)**2
+    return 2 * arcsin(sqrt(minimum(h, 1.0)))
+
+
+class ProximityMonitor:
+    def __init__(self, config, clock=time.time):
+        self.log = logging.getLogger("skycam.ProximityMonitor")
+        settings = config.get("proximity", {})
+        self.margin = settings.get("clear_margin", 2.0) * RAD
+        self.hold = settings.get("hold", 2.0)
+        self.clock = clock
+        # Cones of each kind of object, in radians, None if not warned about
+        aircraft = config["aircraft"]
+        satellite = config["satellite"]
+        self.cones = {
+            ("aircraft", SCOPE): aircraft.get("scope_radius", 10.0) * RAD
+                                 if aircraft.get("warn_scope", False) else None,
+            ("aircraft", ZENITH): aircraft.get("zenith_radius", 10.0) * RAD
+                                  if aircraft.get("warn_zenith", False) else None,
+            ("satellite", SCOPE): satellite.get("scope_radius", 2.0) * RAD
+                                  if satellite.get("warn_scope", False) else None,
+        }
+        # Telescope pointing as (elevation, azimuth) in radians, None if not known
+        self.scope = None
+        # Active warnings: (kind, id, reason): time raised
+        self.active = {}
+        self.events = deque(maxlen=settings.get("history", 100))
+        self.file = None
+        filename = settings.get("alert_file", "")
+        if filename:
+            self.file = open(filename, "a")
+            self.log.info("Writing alerts into '%s'.", filename)
+
+    def set_scope(self, position):
+        """Set the telescope pointing as (elevation, azimuth) in radians, or None when
+        it is not known."""
+        self.scope = position
+
+    def check(self, kind, ids, zenith, az, vzenith=None, vaz=None, ahead=None):
+        """Check the objects of one kind with the given ids, at the given zenith angles
+        and azimuths in radians, and with the optional tips of their velocity vectors.
+        Instead of the tips, vzenith and vaz can have a row of predicted positions for
+        each object, at the given seconds ahead. Warnings of this kind for objects no
+        longer given are cleared. Returns a boolean array telling which objects are
+        warned about."""
+        now = self.clock()
+        n = len(ids)
+        warned = full(n, False)
+        distances = {}
+        scope_cone = self.cones.get((kind, SCOPE))
+        if scope_cone is not None and self.scope is not None:
+            alt0, az0 = self.scope
+            d = separation(alt0, az0, pi/2 - zenith, az)
+            path = None
+            if vzenith is not None:
+                path = separation(alt0, az0, pi/2 - vzenith, vaz)
+            distances[SCOPE] = (d, path, scope_cone)
+        zenith_cone = self.cones.get((kind, ZENITH))
+        if zenith_cone is not None:
+            distances[ZENITH] = (zenith, vzenith, zenith_cone)
+        seen = set()
+        for reason, (d, path, cone) in distances.items():
+            eta = None
+            if path is not None and path.ndim > 1:
+                # Seconds until the first predicted position inside the cone
+                inside = path <= cone
+                eta = where(inside.any(axis=1), ahead[inside.argmax(axis=1)], inf)
+                eta = where(d <= cone, 0.0, eta)
+                path = path.min(axis=1)
+            if path is not None:
+                d = minimum(d, path)
+            # Only the objects inside the cone or already warned about need a look
+            candidates = set((d <= cone).nonzero()[0].tolist())
+            active = {key[1] for key in self.active
+                      if key[0] == kind and key[2] == reason}
+            if active:
+                candidates.update(k for k in range(n) if ids[k] in active)
+            for k in sorted(candidates):
+                key = (kind, ids[k], reason)
+                raised = self.active.get(key)
+                if raised is None:
+                    self.raise_alert(key, now, d[k], None if eta is None else eta[k])
+                elif d[k] > cone + self.margin and now - raised >= self.hold:
+                    self.clear_alert(key, now, d[k])
+                    continue
+                warned[k] = True
+                seen.add(key)
+        # The objects that went away, and the reasons no longer checked
+        for key in [key for key in self.active if key[0] == kind and key not in seen]:
+            if key[2] not in distances or now - self.active[key] >= self.hold:
+                self.clear_alert(key, now, inf)
+        return warned
+
+    def scope_warning(self):
+        """Tell if anything is near the telescope pointing."""
+        return any(reason == SCOPE for kind, ID, reason in self.active)
+
+    def alerts(self):
+        """Return the active warnings as a list of (kind, id, reason) tuples."""
+        return list(self.active)
+
+    def raise_alert(self, key, now, distance, eta=None):
+        self.active[key] = now
+        metrics.add("proximity.alerts")
+        target = "telescope pointing" if key[2] == SCOPE else "zenith"
+        if eta:
+            self.log.warning("%s %s will be near the %s in %.0f s.", key[0].capitalize(),
+                             key[1], target, eta)
+        else:
+            self.log.warning("%s %s is %.1f° from the %s.", key[0].capitalize(), key[1],
+                             distance/RAD, target)
+        self.emit("raised", key, now, distance, eta)
+
+    def clear_alert(self, key, now, distance):
+        del self.active[key]
+        self.log.info("%s %s is clear of the %s.", key[0].capitalize(), key[1],
+                      "telescope pointing" if key[2] == SCOPE else "zenith")
+        self.emit("cleared", key, now, distance)
+
+    def emit(self, state, key, now, distance, eta=None):
+        kind, ID, reason = key
+        event = {"time": now, "state": state, "kind": kind, "id": ID, "reason": reason,
+                 "separation": None if distance == inf else round(float(distance/RAD), 3)}
+        if eta is not None:
+            event["eta"] = float(eta)
+        self.events.append(event)
+        if self.file is not None:
+            self.file.write(json.dumps(event) + "\n")
+            self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
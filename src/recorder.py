@@ -0,0 +1,195 @@
+import io
+import time
+import struct
+import asyncio
+import logging
+import threading
+
+# The Recorder writes everything that comes in from the live sources into an append-only
+# log: the chunks of the aircraft XML stream as they are received, the replies of the
+# telescope control computer and the skycam image changes (with the image itself, or only
+# the time of the change). Every record is a small header with the POSIX time it arrived,
+# its kind and its length, followed by the data as it was received. The chunks of the
+# aircraft streams are recorded with the name of their receiver in front, so that the
+# streams of several receivers can be told apart.
+#
+# The Replay reads a log back and feeds the records to the AircraftListeners, the
+# TelescopeHandler and the CameraHandler in place of the sockets and files, at the
+# recorded pace, at a multiple of it, or as fast as possible (speed 0). Its clock()
+# gives the recorded time of the replay, and is given to the handlers instead of
+# time.time, so that e.g. the satellites are drawn where they were when the data was
+# recorded. Quiet gaps in the log (e.g. between two recording sessions) are skipped.
+
+MAGIC = b"SKYCAMLOG1\n"
+HEADER = struct.Struct("<dBI") # time, kind, length of data
+
+# Kinds of records
+AIRCRAFT = 1   # chunk of the aircraft XML stream
+TELESCOPE = 2  # reply of the telescope control computer
+IMAGE = 3      # skycam image file contents
+IMAGE_FILE = 4 # skycam image changed, data is the file name
+AIRCRAFT_SOURCE = 5 # chunk of the aircraft XML stream of a named receiver
+
+NAMES = {AIRCRAFT: "aircraft", TELESCOPE: "telescope", IMAGE: "image",
+         IMAGE_FILE: "image file", AIRCRAFT_SOURCE: "aircraft source"}
+
+
+def read_log(filename):
+    """Read the records of a log, yielding (time, kind, data) tuples. A record cut short
+    at the end of the log (e.g. by a crash while recording) is left out."""
+    with open(filename, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("'{}' is not a recording".format(filename))
+        while True:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return
+            t, kind, length = HEADER.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                return
+            yield t, kind, data
+
+
+class Recorder:
+    def __init__(self, config, clock=time.time):
+        self.log = logging.getLogger("skycam.Recorder")
+        settings = config.get("recorder", {})
+        self.filename = settings["record_file"]
+        self.images = settings.get("record_images", True)
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.records = 0
+        self.last_flush = time.monotonic()
+        self.file = open(self.filename, "ab")
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+        self.log.info("Recording into '%s'.", self.filename)
+
+    def write(self, kind, data):
+        """Append a record of the given kind, stamped with the current time. The log is
+        flushed to disk at most once a second."""
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.write(HEADER.pack(self.clock(), kind, len(data)))
+            self.file.write(data)
+            self.records += 1
+            now = time.monotonic()
+            if now - self.last_flush > 1.0:
+                self.file.flush()
+                self.last_flush = now
+
+    def write_source(self, name, data):
+        """Append a chunk of the aircraft stream of the named receiver."""
+        self.write(AIRCRAFT_SOURCE, name.encode("utf-8") + b"\n" + data)
+
+    def image(self, filename, data):
+        """Record an image change, with the image data if record_images is on."""
+        if self.images and data is not None:
+            self.write(IMAGE, data)
+        else:
+            self.write(IMAGE_FILE, filename.encode("utf-8"))
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+        self.log.info("Wrote %d records.", self.records)
+
+
+class Replay:
+    def __init__(self, config, listeners=None, scope=None, camera=None):
+        self.log = logging.getLogger("skycam.Replay")
+        settings = config.get("recorder", {})
+        self.filename = settings["replay_file"]
+        self.speed = settings.get("replay_speed", 1.0)
+        self.max_gap = settings.get("replay_max_gap", 10.0)
+        # AircraftListeners by the name of their receiver, the first also takes the
+        # chunks recorded without a name
+        self.listeners = listeners or {}
+        self.scope = scope
+        self.camera = camera
+        first = next(read_log(self.filename), None)
+        # Recorded time of the last record replayed
+        self.time = time.time() if first is None else first[0]
+        # The recorded time self.base was replayed at the monotonic time self.origin
+        self.base = self.time
+        self.origin = None
+        self.finished = False
+        self.counts = dict.fromkeys(NAMES, 0)
+
+    def clock(self):
+        """Return the recorded POSIX time that the replay has reached. Can be called
+        from any thread."""
+        origin, base = self.origin, self.base
+        if self.speed > 0 and origin is not None and not self.finished:
+            return base + (time.monotonic() - origin) * self.speed
+        return self.time
+
+    async def run(self):
+        """Feed the records of the log to the handlers. Meant to be run as a source of
+        the IOCore, without reconnecting."""
+        self.log.info("Replaying '%s' at speed %s.", self.filename, self.speed)
+        start = time.monotonic()
+        self.base, self.origin = self.time, start
+        for t, kind, data in read_log(self.filename):
+            if self.speed > 0:
+                if t - self.clock() > self.max_gap:
+                    # Skip the gap, continuing from this record
+                    self.base, self.origin = t, time.monotonic()
+                delay = (t - self.clock()) / self.speed
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            self.time = t
+            await self.dispatch(kind, data)
+            if self.speed <= 0:
+                # Let the other tasks run
+                await asyncio.sleep(0)
+        self.finished = True
+        self.log.info("Finished in %.1f s: %s.", time.monotonic() - start,
+                      ", ".join("{} {}".format(n, NAMES[kind])
+                                for kind, n in self.counts.items()))
+
+    async def dispatch(self, kind, data):
+        if kind not in NAMES:
+            return
+        self.counts[kind] += 1
+        if kind == AIRCRAFT and self.listeners:
+            next(iter(self.listeners.values())).feed(data)
+        elif kind == AIRCRAFT_SOURCE:
+            name, sep, data = data.partition(b"\n")
+            listener = self.listeners.get(name.decode("utf-8", "replace"))
+            if listener is not None:
+                listener.feed(data)
+        elif kind == TELESCOPE and self.scope is not None:
+            self.scope.replay(data)
+        elif kind in (IMAGE, IMAGE_FILE) and self.camera is not None:
+            # Like the live source, wait until the last image has been taken
+            while self.camera.pending is not None:
+                await asyncio.sleep(0.05)
+            source = io.BytesIO(data) if kind == IMAGE else data.decode("utf-8")
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self.camera.replay, source)
+
+
+if __name__=="__main__":
+    # Print a summary of a recording
+    from sys import argv
+    counts = dict.fromkeys(NAMES, 0)
+    sizes = dict.fromkeys(NAMES, 0)
+    first = last = None
+    for t, kind, data in read_log(argv[1]):
+        first = t if first is None else first
+        last = t
+        if kind in NAMES:
+            counts[kind] += 1
+            sizes[kind] += len(data)
+    if first is None:
+        print("No records.")
+    else:
+        print("{:.0f} s from {}".format(last - first, time.ctime(first)))
+        for kind in NAMES:
+            print("{:>10}: {} records, {} bytes".format(NAMES[kind], counts[kind],
+                                                       sizes[kind]))
@@ -0,0 +1,140 @@
+import logging
+from numpy import empty, column_stack
+from matplotlib.collections import LineCollection
+from matplotlib.colors import to_rgba_array
+from logs import TRACE
+
+# The BlitManager draws the moving symbols (aircraft, satellites, traces and telescope)
+# without redrawing the whole figure. Everything else in the figure (the skycam image,
+# the grid, the horizon ring and the tick labels) changes rarely, so it is drawn once and
+# copied as a background. On each frame the background is restored, the moving artists
+# are drawn on top of it and only the result is copied to the screen.
+#
+# The moving artists are set as animated, so that full draws of the figure leave them
+# out of the background. A full draw (for example when the window is resized, or when
+# refresh() is called after the skycam image changed) copies the new background.
+#
+# A SymbolLayer draws all objects of one kind (e.g. the aircraft) with a fixed set of
+# artists: one scatter collection for the markers, one LineCollection for the lines and
+# a pool of text labels, which only grows to the largest number of labels shown at once.
+# The objects are updated through arrays, so objects coming and going do not create or
+# remove artists. A TrailLayer draws the fading trails behind moving objects in the same
+# way, as one LineCollection of short segments with a color and an alpha for each.
+
+class BlitManager:
+    def __init__(self, canvas, config):
+        self.log = logging.getLogger("skycam.BlitManager")
+        self.canvas = canvas
+        self.background = None
+        self.artists = []
+        self.known = set()
+        self.blits = 0
+        self.full_draws = 0
+        self.cid = canvas.mpl_connect("draw_event", self.on_draw)
+
+    def add(self, artists):
+        """Start managing the given artists. Returns True if any of them was new."""
+        new = False
+        for artist in artists:
+            if artist in self.known:
+                continue
+            artist.set_animated(True)
+            self.known.add(artist)
+            self.artists.append(artist)
+            new = True
+        if new:
+            self.artists.sort(key=lambda artist: artist.get_zorder())
+        return new
+
+    def on_draw(self, event):
+        """After a full draw, copy the background and draw the moving artists."""
+        if event is not None and event.canvas is not self.canvas:
+            return
+        self.full_draws += 1
+        self.background = self.canvas.copy_from_bbox(self.canvas.figure.bbox)
+        self.draw_artists()
+
+    def draw_artists(self):
+        figure = self.canvas.figure
+        for artist in self.artists:
+            figure.draw_artist(artist)
+
+    def refresh(self):
+        """Ask for a full draw, e.g. after a change in the static layers."""
+        self.canvas.draw_idle()
+
+    def update(self, changed):
+        """Show the changes in the given artists on the screen."""
+        if self.add(changed) or self.background is None:
+            # New artists may be in the old background, so draw everything once
+            self.refresh()
+            return
+        if not changed:
+            return
+        self.canvas.restore_region(self.background)
+        self.draw_artists()
+        self.canvas.blit(self.canvas.figure.bbox)
+        self.canvas.flush_events()
+        self.blits += 1
+        self.log.log(TRACE, "Blitted %d artists.", len(self.artists))
+
+
+class SymbolLayer:
+    def __init__(self, ax, marker="o", size=6, linewidth=1.5, line_alpha=1.0,
+                 fontsize="small"):
+        self.ax = ax
+        self.fontsize = fontsize
+        self.lines = LineCollection([], linewidths=linewidth, alpha=line_alpha, zorder=2)
+        ax.add_collection(self.lines, autolim=False)
+        self.points = ax.scatter([], [], s=size**2, marker=marker, linewidths=0, zorder=2)
+        self.labels = []
+
+    def set_points(self, x, y, colors):
+        """Show markers at the given data coordinates, with one color for each."""
+        if len(x):
+            self.points.set_offsets(column_stack([x, y]))
+            self.points.set_facecolors(colors)
+        else:
+            self.points.set_offsets(empty((0, 2)))
+
+    def set_lines(self, segments, colors):
+        """Show the given lines, each an array of (x, y) points. The colors are given
+        for each line or as one color for all of them."""
+        self.lines.set_segments(segments)
+        self.lines.set_color(colors)
+
+    def set_labels(self, x, y, texts, colors):
+        """Show the given texts at the given data coordinates, hiding the rest of the
+        labels in the pool."""
+        while len(self.labels) < len(texts):
+            label = self.ax.text(0.0, 0.0, "", fontsize=self.fontsize)
+            label.set_visible(False)
+            self.labels.append(label)
+        for k, label in enumerate(self.labels):
+            if k < len(texts):
+                label.set_text(texts[k])
+                label.set_position((x[k], y[k]))
+                label.set_color(colors[k])
+                label.set_visible(True)
+            elif label.get_visible():
+                label.set_visible(False)
+
+    def artists(self):
+        return [self.lines, self.points] + self.labels
+
+
+class TrailLayer:
+    def __init__(self, ax, linewidth=1.5):
+        self.lines = LineCollection([], linewidths=linewidth, zorder=1)
+        ax.add_collection(self.lines, autolim=False)
+
+    def set_trails(self, segments, colors, alpha):
+        """Show the given line segments, each an array of two (x, y) points, with a
+        color and an alpha for each."""
+        rgba = to_rgba_array(colors) if len(colors) else empty((0, 4))
+        rgba[:,3] = alpha
+        self.lines.set_segments(segments)
+        self.lines.set_color(rgba)
+
+    def artists(self):
+        return [self.lines]
@@ -1,20 +1,44 @@
-# coding: utf8 
-import ephem
+# coding: utf8
+import time
+import logging
 import datetime
-from numpy import pi
+import threading
+from concurrent.futures.process import BrokenProcessPool
+from os import path
+from numpy import pi, array, arange, concatenate, insert, isin, column_stack
+from propagator import Propagator
+from tlecache import load_tles
+from tlestore import ElementStore
+from ephemeris import EphemerisCache
+from passes import PassIndex
+from render import SymbolLayer
+from tracepool import TracePool
+from logs import TRACE
+import metrics
 
-# The SatelliteHandler maintains a list of satellites and their locations, and draws them
-# on the given Axes object when requested.
+# The SatelliteHandler maintains a list of satellites and their locations, and draws
+# them on the given Axes object when requested. The positions of the whole catalog are
+# computed in one vectorized call by the Propagator, and the traces are drawn from an
+# EphemerisCache which only computes the samples that enter the trace window. Only the
+# satellites that the PassIndex predicts to be up are computed at all, and its windows
+# are extended by the extend_passes() job, in the TracePool if there is one. All
+# satellites are drawn with the few artists of one SymbolLayer. With trace_workers, the
+# samples of the traces are computed in a TracePool, one job per list, and the old
+# traces are kept on the screen until the new samples have arrived. The current time is
+# taken from the given clock, which a Replay sets to the time of the recording. The
+# metrics record how many satellites are computed for the positions and for the traces.
+# With a ProximityMonitor, the satellites near the telescope pointing are drawn in
+# color_warning.
 
 class SatelliteHandler:
-    def __init__(self, ax, ax_text, config):
-        self.DEBUG = config["main"]["debug_level"]
-        if self.DEBUG >= 1:
-            print("SatelliteHandler: Initializing...")
+    def __init__(self, ax, ax_text, config, clock=time.time):
+        self.log = logging.getLogger("skycam.SatelliteHandler")
+        self.log.info("Initializing...")
         self.ax = ax
         self.ax_text = ax_text
         self.lists = config["satellite"]["list"]
         self.color = config["satellite"]["color"]
+        self.color_warn = config["satellite"].get("color_warning", "red")
         self.show_label = config["satellite"]["show_names"]
         self.show_trace = config["satellite"]["show_traces"]
         self.trace_interval = config["satellite"]["trace_interval"]
@@ -23,118 +47,288 @@ class SatelliteHandler:
         self.min_altitude = config["satellite"]["min_altitude"] * pi/180
         self.show_eclipsed = config["satellite"]["show_eclipsed"]
         self.max_range = config["satellite"]["max_range"] * 1000.0
-        self.observer = ephem.Observer()
-        self.observer.lat = str(config["location"]["latitude"])
-        self.observer.lon = str(config["location"]["longitude"])
-        self.observer.elevation = config["location"]["elevation"]
-        self.observer.date = datetime.datetime.utcnow()
+        self.interpolate = config["satellite"].get("interpolate_positions", False)
+        self.clock = clock
+        self.proximity = None
+        self.store = ElementStore(config)
+        self.propagator = Propagator(config)
+        self.cache = EphemerisCache(self.propagator, self.trace_interval,
+                                    self.trace_backward, self.trace_forward)
+        self.passes = PassIndex(self.propagator, config)
+        self.pass_batch = config["satellite"].get("pass_batch", 20)
+        workers = config["satellite"].get("trace_workers", 0)
+        self.pool = TracePool(config, workers) if workers > 0 else None
+        self.trace_level = 0
+        self.catalog = {} # list name: element sets and parsed elements
+        self.layer = SymbolLayer(ax, marker="o", size=8, fontsize="x-small")
+        # Label positions (az, zenith, color) of the drawn satellites and, for those not
+        # visible themselves, of the first visible point of their trace
+        self.point_labels = {}
+        self.trace_labels = {}
+        # Set from other threads when new elements have been downloaded
+        self.reload = threading.Event()
         self.update()
-        
-    def update(self):
-        """Loads satellite orbit details from files."""
+
+    def load_list(self, listname, when):
+        """Return the element sets and parsed elements of one list. Lists with satellite
+        numbers are read from the element store, picking the elements closest in time.
+        Element files from older versions are imported into the store the first time.
+        Lists without numbers are read directly from their files."""
+        filename = "{}.txt".format(listname)
+        numbers = self.lists[listname].get("numbers")
+        if numbers is None:
+            self.log.debug("Updating satellite list from '%s'.", filename)
+            return load_tles(filename)
+        self.log.debug("Updating satellite list '%s'.", listname)
+        tles, elements = self.store.select(numbers, when)
+        if not tles and path.exists(filename):
+            self.log.info("Importing '%s' into the element store.", filename)
+            self.store.import_file(filename)
+            tles, elements = self.store.select(numbers, when)
+        if not tles:
+            raise IOError("No elements for list '{}'".format(listname))
+        return tles, elements
+
+    def now(self):
+        """Return the current UTC time of the clock."""
+        return datetime.datetime.utcfromtimestamp(self.clock())
+
+    def update(self, when=None):
+        """Loads satellite orbit details from the element store, using the elements
+        closest to the given time (default now)."""
+        if when is None:
+            when = self.now()
+        tles = []
+        elements = []
+        self.catalog = {}
         for listname in self.lists:
-            filename = "{}.txt".format(listname)
-            self.lists[listname]["satellites"] = {}
-            if self.DEBUG >= 2:
-                print("SatelliteHandler: Updating satellite list from '{}'.".format(filename))
-            output = {}
+            self.lists[listname]["index"] = array([], dtype=int)
             try:
-                f = open(filename)
-            except IOError:
-                print("SatelliteHandler: Unable to open '{}'.".format(filename))
+                new_tles, new_elements = self.load_list(listname, when)
+            except IOError as e:
+                self.log.warning("Unable to load list: %s", e)
                 continue
-            while True:
-                name = f.readline()
-                if name == "":
-                    break
-                name = name[2:].strip()
-                line1 = f.readline().strip()
-                line2 = f.readline().strip()
-                sat = ephem.readtle(name, line1, line2)
-                point = self.ax.plot([],[], "o")[0]
-                trace = self.ax.plot([],[], "-")[0]
-                label = self.ax.text(0.0, 0.0, "  " + name)
-                label.set_visible(False)
-                point.set_color(self.color)
-                point.set_markersize(8)
-                label.set_color(self.color)
-                label.set_fontsize("x-small")
-                trace.set_color(self.color)
-                output[name] = (sat, point, label, trace)
-            f.close()
-            self.lists[listname]["satellites"] = output
-            if self.DEBUG >= 2:
-                sats = ", ".join(sorted(output.keys()))
-                print("SatelliteHandler: added these satellites: {}".format(sats))
-    
+            first = len(tles)
+            self.catalog[listname] = (new_tles, new_elements)
+            tles += new_tles
+            elements.append(new_elements)
+            self.lists[listname]["index"] = array(range(first, len(tles)), dtype=int)
+            if self.log.isEnabledFor(logging.DEBUG):
+                names = [name for name, line1, line2 in new_tles]
+                self.log.debug("added these satellites: %s", ", ".join(sorted(names)))
+        # The catalog indices change, so nothing drawn so far is valid
+        self.point_labels = {}
+        self.trace_labels = {}
+        self.layer.set_points([], [], [])
+        self.layer.set_lines([], self.color)
+        self.layer.set_labels([], [], [], [])
+        if any(e is None for e in elements):
+            elements = None
+        elif elements:
+            elements = concatenate(elements)
+        self.propagator.load(tles, elements)
+        self.cache.reset()
+        self.passes.reload(when)
+
+    def shown(self):
+        """Return the catalog indices of the satellites in the lists that are shown."""
+        index = [sat_list["index"] for sat_list in self.lists.values() if sat_list["show"]]
+        if not index:
+            return array([], dtype=int)
+        return concatenate(index)
+
+    def up(self, t0, t1, unknown=False):
+        """Return the catalog indices of the shown satellites that have a pass between
+        the times t0 and t1, and if unknown is set, those whose passes have not been
+        predicted yet (e.g. right after a reload)."""
+        index = self.shown()
+        return index[isin(index, self.passes.query(t0, t1, unknown))]
+
+    def visible(self, alt, rng, eclipsed):
+        """Mask of the positions that pass the altitude, range and eclipse filters.
+        Satellites that failed to propagate have NaN positions and are never visible."""
+        show = self.show_eclipsed | ~eclipsed
+        return show & (alt > self.min_altitude) & (rng < self.max_range)
+
+    def draw_labels(self):
+        """Draw the names of the satellites next to them, or at their traces."""
+        labels = {}
+        if self.show_label:
+            if self.show_trace:
+                labels.update(self.trace_labels)
+            labels.update(self.point_labels)
+        index = list(labels)
+        self.layer.set_labels([labels[i][0] for i in index], [labels[i][1] for i in index],
+                              ["  " + self.propagator.names[i] for i in index],
+                              [labels[i][2] for i in index])
+
     def draw(self):
-        """Draw the satellites onto the Axes."""
-        if self.DEBUG >= 3:
-            print("SatelliteHandler: Drawing satellites...")
-        self.observer.date = datetime.datetime.utcnow()
-        for list_name, sat_list in self.lists.items():
-            if not sat_list["show"]:
+        """Draw the satellites onto the Axes. Returns the artists that were changed."""
+        self.log.log(TRACE, "Drawing satellites...")
+        now = self.now()
+        # Until their passes are predicted, the satellites are computed to see if they
+        # are up
+        index = self.up(now, now, unknown=True)
+        metrics.observe("satellites.count", len(index), unit="")
+        if self.interpolate:
+            alt, az, rng, eclipsed = self.cache.interpolate(now, index)
+        else:
+            alt, az, rng, eclipsed = self.propagator.compute(now, index)
+            alt, az, rng, eclipsed = alt[:,0], az[:,0], rng[:,0], eclipsed[:,0]
+        visible = self.visible(alt, rng, eclipsed)
+        index, az, eclipsed = index[visible], az[visible], eclipsed[visible]
+        zenith = 90 - alt[visible]*180/pi
+        colors = ["gray" if e else self.color for e in eclipsed]
+        if self.proximity is not None:
+            warned = self.proximity.check("satellite",
+                                          [self.propagator.names[i] for i in index],
+                                          pi/2 - alt[visible], az)
+            colors = [self.color_warn if w else c for w, c in zip(warned, colors)]
+        self.layer.set_points(az, zenith, colors)
+        self.point_labels = {i: (az[k], zenith[k], colors[k]) for k, i in enumerate(index)}
+        self.draw_labels()
+        return self.layer.artists()
+
+    def request_traces(self, now, index):
+        """Start computing the missing trace samples of the given satellites in the
+        TracePool. Returns True if any samples are still missing."""
+        self.collect_traces()
+        keys = self.cache.grid(now)[:self.trace_backward + self.trace_forward + 1]
+        rows, keys = self.cache.missing(keys, self.cache.rows(index))
+        if not len(rows):
+            return False
+        for listname, sat_list in self.lists.items():
+            first = sat_list["index"][0] if len(sat_list["index"]) else 0
+            shard = rows[isin(rows, sat_list["index"])]
+            if not len(shard) or self.pool.busy(listname):
+                continue
+            tles, elements = self.catalog[listname]
+            tag = ("traces", self.cache.generation, shard, keys)
+            try:
+                self.pool.submit(listname, tles, elements, keys * self.cache.step,
+                                 shard - first, tag)
+            except BrokenProcessPool as e:
+                self.log.warning("Computing the traces here instead: %s", e)
+                self.pool = None
+                return False
+        return True
+
+    def traces_ready(self):
+        return self.pool is not None and self.pool.ready()
+
+    def collect_traces(self):
+        """Store the trace samples and the pass windows computed in the TracePool."""
+        passes = False
+        for tag, (alt, az, rng, eclipsed) in self.pool.collect():
+            if tag[0] == "passes":
+                kind, generation, tle_keys, times = tag
+                # Windows discarded since are not extended
+                if generation == self.passes.generation:
+                    self.passes.add(tle_keys, times, alt, rng)
+                    passes = True
+                continue
+            kind, generation, rows, keys = tag
+            # Samples from before a reload or a reset are no longer valid
+            if generation == self.cache.generation:
+                self.cache.merge(rows, keys, alt, az, rng, eclipsed)
+        if passes:
+            self.passes.update(self.clock())
+
+    def passes_due(self):
+        return self.passes.due(self.clock())
+
+    def extend_passes(self):
+        """Extend the pass windows before they run out. The satellites without windows
+        are computed here, pass_batch at a time, and the windows of the others are
+        extended in the TracePool if there is one. Meant to be run as a job of the
+        FrameScheduler."""
+        now = self.clock()
+        if self.pool is None:
+            self.passes.extend(now, self.pass_batch)
+            return []
+        self.collect_traces()
+        if self.passes.discard(now):
+            self.passes.update(now)
+        new, old = self.passes.pending(now)
+        if new:
+            self.passes.extend(now, self.pass_batch)
+            return []
+        tles = self.propagator.tles
+        end = now + self.passes.horizon
+        for listname, sat_list in self.lists.items():
+            name = "passes." + listname
+            index = sat_list["index"]
+            if not len(index):
                 continue
-            if self.DEBUG >= 4:
-                print("SatelliteHandler: ... {}.".format(list_name))
-            for sat, point, label, trace in sat_list["satellites"].values():
-                sat.compute(self.observer)
-                alt = float(sat.alt)
-                az = float(sat.az)
-                show = self.show_eclipsed or not sat.eclipsed
-                if show and alt > self.min_altitude and sat.range < self.max_range:
-                    point.set_data([az], [90 - alt*180/pi])
-                    if self.show_label:
-                        label.set_visible(True)
-                        label.set_position([az, 90 - alt*180/pi])
-                else:
-                    point.set_data([], [])
-                    continue
-                if sat.eclipsed:
-                    point.set_color = "gray"
-                    label.set_color = "gray"
-                else:
-                    point.set_color = self.color
-                    label.set_color = self.color
-            
-
-    def draw_traces(self):
-        """Compute and draw the satellite traces."""
-        if self.DEBUG >= 3:
-            print("SatelliteHandler: Drawing satellite traces.")
-        now = datetime.datetime.utcnow()
-        a = -self.trace_backward
-        b = self.trace_forward + 1
-        dt = self.trace_interval
-        times = [now + datetime.timedelta(seconds=i*dt) for i in range(a, b)]
-        sat_idx = -a-1 # index corresponding to actual satellite location below
-        for sat_list in self.lists.values():
-            if not sat_list["show"]:
+            shard = [(i, t0) for i, t0 in old if index[0] <= i <= index[-1]]
+            if not shard or self.pool.busy(name):
                 continue
-            for sat, point, label, trace in sat_list["satellites"].values():
-                X = []
-                Y = []
-                draw_label_later = False
-                for i, time in enumerate(times):
-                    self.observer.date = time
-                    sat.compute(self.observer)
-                    alt = float(sat.alt)
-                    az = float(sat.az)
-                    show_eclipse = self.show_eclipsed or not sat.eclipsed
-                    visible = (alt > self.min_altitude and sat.range < self.max_range 
-                               and show_eclipse)
-                    if visible:
-                        X.append(az)
-                        Y.append(90 - alt*180/pi)
-                    # Is the satellite itself below minimum altitude
-                    if i == sat_idx and not visible:
-                        draw_label_later = True
-                    # Draw the label at first visible point
-                    if (draw_label_later and visible and self.show_label):
-                        label.set_visible(True)
-                        label.set_position([az, 90 - alt*180/pi])
-                        draw_label_later = False
-                if draw_label_later:
-                    label.set_visible(False)
-                trace.set_data(X,Y)
-                    
+            # One block of the satellites computed until the same time
+            t0 = min(t0 for i, t0 in shard)
+            rows = array([i for i, t in shard if t == t0], dtype=int)
+            times = arange(t0, end + self.passes.step, self.passes.step)
+            keys = [(tles[i][1], tles[i][2]) for i in rows]
+            first = index[0]
+            catalog_tles, elements = self.catalog[listname]
+            tag = ("passes", self.passes.generation, keys, times)
+            try:
+                self.pool.submit(name, catalog_tles, elements, times, rows - first, tag)
+            except BrokenProcessPool as e:
+                self.log.warning("Computing the passes here instead: %s", e)
+                self.pool = None
+                break
+        return []
+
+    def update_traces(self):
+        """Draw the traces once new samples have arrived from the TracePool."""
+        return self.draw_traces(self.trace_level)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+
+    def draw_traces(self, level=0):
+        """Compute and draw the satellite traces. A higher level draws them with fewer
+        points: every 2**level-th sample. Returns the artists that were changed."""
+        self.log.log(TRACE, "Drawing satellite traces.")
+        now = self.now()
+        span = datetime.timedelta(seconds=self.trace_interval)
+        index = self.up(now - self.trace_backward * span, now + self.trace_forward * span)
+        self.trace_level = level
+        if self.pool is not None and self.request_traces(now, index):
+            # Keep the old traces until the new samples arrive
+            return []
+        metrics.observe("traces.count", len(index), unit="")
+        times, alt, az, rng, eclipsed = self.cache.window(now, index)
+        # Insert the current position between the cached samples, so the trace passes
+        # through the satellite
+        sat_idx = self.trace_backward + 1 # index of the satellite location below
+        current = self.cache.interpolate(now, index)
+        alt = insert(alt, sat_idx, current[0], axis=1)
+        az = insert(az, sat_idx, current[1], axis=1)
+        rng = insert(rng, sat_idx, current[2], axis=1)
+        eclipsed = insert(eclipsed, sat_idx, current[3], axis=1)
+        if level > 0:
+            # Keep the current position among the samples
+            step = 2**level
+            columns = arange(sat_idx % step, alt.shape[1], step)
+            alt, az, rng = alt[:,columns], az[:,columns], rng[:,columns]
+            eclipsed = eclipsed[:,columns]
+            sat_idx = sat_idx // step
+        visible = self.visible(alt, rng, eclipsed)
+        zenith = 90 - alt*180/pi
+        traces = []
+        self.trace_labels = {}
+        for k, i in enumerate(index):
+            if visible[k].any():
+                traces.append(column_stack([az[k][visible[k]], zenith[k][visible[k]]]))
+            # If the satellite itself is not visible, draw the label at the first
+            # visible point after it
+            if not visible[k, sat_idx]:
+                later = visible[k, sat_idx:].nonzero()[0]
+                if len(later):
+                    j = sat_idx + later[0]
+                    self.trace_labels[i] = (az[k, j], zenith[k, j], self.color)
+        self.layer.set_lines(traces, self.color)
+        self.draw_labels()
+        return self.layer.artists()
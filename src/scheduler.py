@@ -0,0 +1,114 @@
+import time
+import logging
+import metrics
+
+# The FrameScheduler decides which drawing jobs run in each frame of the Animator. Every
+# job has its own period in seconds of wall-clock time, and runs when its deadline has
+# passed, so a slow frame delays the jobs but does not change their cadence.
+#
+# Expensive jobs (e.g. the satellite traces or a new skycam image) are staggered: at most
+# one of them runs in a frame, the one whose deadline passed first, and the others wait
+# for the following frames. The expensive job runs after all the cheap jobs of the frame,
+# whatever order the jobs were added in, and if the cheap jobs have already used up the
+# frame budget, it waits as well, unless it is already late by a whole period.
+#
+# Jobs can also have a time budget. A degradable job that goes over its budget is asked
+# to do less work (e.g. draw the traces with fewer points) by calling it with a higher
+# level, and the level is lowered again once the job runs well within its budget.
+#
+# The duration of every job is recorded in the metrics, as "frame.<job name>".
+
+MAX_LEVEL = 3
+
+
+class Job:
+    def __init__(self, name, function, period, budget, expensive, degradable, ready):
+        self.name = name
+        self.function = function
+        self.period = period
+        self.budget = budget
+        self.expensive = expensive
+        self.degradable = degradable
+        self.ready = ready
+        self.metric = "frame." + name
+        self.deadline = None
+        self.level = 0
+        self.runs = 0
+        self.overruns = 0
+        self.postponed = 0
+        self.duration = 0.0
+
+    def due(self, now):
+        if self.deadline is not None and now < self.deadline:
+            return False
+        return self.ready is None or self.ready()
+
+
+class FrameScheduler:
+    def __init__(self, config, clock=time.monotonic):
+        self.log = logging.getLogger("skycam.FrameScheduler")
+        interval = config["main"]["update_interval"]
+        self.frame_budget = config["main"].get("frame_budget", interval / 2)
+        self.clock = clock
+        self.jobs = []
+
+    def add(self, name, function, period=0.0, budget=None, expensive=False,
+            degradable=False, ready=None):
+        """Add a job that runs every period seconds (0 for every frame). The optional
+        ready function can tell that the job has nothing to do even if it is due."""
+        self.jobs.append(Job(name, function, period, budget, expensive, degradable, ready))
+
+    def run(self):
+        """Run the cheap jobs that are due in this frame, in the order they were added,
+        and then the expensive one whose turn it is, if there is time left. Returns the
+        concatenated lists returned by the jobs."""
+        start = self.clock()
+        due = [job for job in self.jobs if job.due(start)]
+        results = []
+        for job in due:
+            if not job.expensive:
+                results += self.execute(job, start) or []
+        # Pick the expensive job that has waited the longest
+        expensive = [job for job in due if job.expensive]
+        chosen = min(expensive, key=lambda job: job.deadline or 0.0, default=None)
+        for job in expensive:
+            if job is not chosen:
+                job.postponed += 1
+        if chosen is not None:
+            late = start - (chosen.deadline or start)
+            if self.clock() - start > self.frame_budget and late < chosen.period:
+                chosen.postponed += 1
+            else:
+                results += self.execute(chosen, start) or []
+        return results
+
+    def execute(self, job, start):
+        t0 = self.clock()
+        if job.degradable:
+            result = job.function(job.level)
+        else:
+            result = job.function()
+        job.duration = self.clock() - t0
+        job.runs += 1
+        metrics.observe(job.metric, job.duration)
+        # Keep the phase of the job, unless it has fallen behind by a whole period
+        if job.deadline is None or start - job.deadline >= job.period:
+            job.deadline = start + job.period
+        else:
+            job.deadline += job.period
+        if job.budget is not None:
+            if job.duration > job.budget:
+                job.overruns += 1
+                if job.degradable and job.level < MAX_LEVEL:
+                    job.level += 1
+                    self.log.debug("%s took %.0f ms, degrading to level %d.",
+                                   job.name, 1000*job.duration, job.level)
+            elif job.duration < job.budget / 4 and job.level > 0:
+                job.level -= 1
+        return result
+
+    def summary(self):
+        """Return a line of statistics for each job."""
+        return ["{}: {} runs, {} postponed, {} over budget, {:.1f} ms last, level {}"
+                .format(job.name, job.runs, job.postponed, job.overruns,
+                        1000*job.duration, job.level) for job in self.jobs]
@@ -1,19 +1,44 @@
-import socket
+import time
+import asyncio
+import logging
+from collections import deque
 from math import pi
+from recorder import TELESCOPE
+from logs import TRACE
+import metrics
+
+# The TelescopeHandler polls the SLR telescope control computer for the pointing of the
+# telescope and draws it on the given Axes object. The polling runs as a source in the
+# IOCore over one persistent connection, which is only opened again after it fails. The
+# received positions are kept with their timestamps, so that between polls draw() can
+# interpolate (or for a short while, extrapolate) the pointing of a slewing telescope
+# without asking the control computer more often. With a Recorder, the replies are also
+# written into its log, and a Replay gives recorded replies to replay() instead. The
+# metrics measure how long the control computer takes to answer.
+
+REQUEST = b"#cybioms.telescope.data\n"
 
 class TelescopeHandler:
-    def __init__(self, ax, config):
-        self.DEBUG = config["main"]["debug_level"]
-        if self.DEBUG >= 1:
-            print("TelescopeHandler: Initializing...")
+    def __init__(self, ax, config, clock=time.time):
+        self.log = logging.getLogger("skycam.TelescopeHandler")
+        self.log.info("Initializing...")
         self.address = config["telescope"]["address"]
         self.port = int(config["telescope"]["port"])
         self.color_normal = config["telescope"]["color_normal"]
         self.color_warn = config["telescope"]["color_warning"]
+        self.interval = config["telescope"].get("poll_interval",
+                                                config["main"]["update_interval"])
+        self.timeout = config["telescope"].get("timeout", 1.0)
+        self.max_extrapolation = config["telescope"].get("max_extrapolation", self.interval)
         self.active = False
         self.ax = ax
         self.position = (1.570796327, 0.0)
         self.visible = False
+        # Received positions as (time, elevation, azimuth), oldest first
+        self.history = deque(maxlen=config["telescope"].get("history", 10))
+        self.online = False
+        self.clock = clock
+        self.recorder = None
         self.circle = self.ax.plot([],[], "o")[0]
         self.cross = self.ax.plot([],[], "+")[0]
         self.circle.set_markersize(20)
@@ -23,36 +48,107 @@ class TelescopeHandler:
         self.cross.set_color(self.color_normal)
         self.cross.set_markersize(20)
         self.warn = False
-    
-    def update_position(self):
-        """Poll control computer for telescope pointing direction."""
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.visible = True
+
+    def parse(self, line, fields):
+        """Store the elevation or azimuth given on a reply line in the fields dict, in
+        radians. Raises ValueError if the value is not a number."""
+        key, sep, value = line.decode("utf-8", "replace").partition("=")
+        key = key.strip()
+        if sep and key in ("elevation", "azimuth"):
+            fields[key] = float(value) * pi/180
+
+    async def query(self, reader, writer):
+        """Ask the control computer for the telescope pointing direction and read the
+        reply line by line until it has both the elevation and the azimuth.
+        Returns (elevation from horizon, azimuth), both in radians, and the reply."""
+        writer.write(REQUEST)
+        await writer.drain()
+        fields = {}
+        reply = []
+        while not ("elevation" in fields and "azimuth" in fields):
+            line = await reader.readline()
+            if not line:
+                raise EOFError("Connection closed by the control computer")
+            reply.append(line)
+            self.parse(line, fields)
+        return (fields["elevation"], fields["azimuth"]), b"".join(reply)
+
+    def replay(self, reply):
+        """Take a recorded reply of the control computer, as if it had just arrived."""
+        fields = {}
         try:
-            sock.connect((self.address, self.port))
-            sock.sendall(bytes("#cybioms.telescope.data\n", encoding="utf-8"))
-            data = sock.recv(2048).decode("utf-8")
-            self.visible = True
-            if self.DEBUG >= 3:
-                print("TelescopeHandler: Received position..")
-        except Exception as e:
-            if self.DEBUG >= 3:
-                print("TelescopeHandler: Unable to get position.")
-                print(e)
-            self.visible = False
-            data = ""
-        elevation = 0.0
-        azimuth = 0.0
-        for line in data.split("\n"):
-            if "elevation" in line:
-                elevation = float(line.split("=")[1]) * pi/180
-            if "azimuth" in line:
-                azimuth = float(line.split("=")[1]) * pi/180
-        # Elevation from horizon; both angles in radians
-        self.position = (elevation, azimuth)
+            for line in reply.splitlines():
+                self.parse(line, fields)
+            position = (fields["elevation"], fields["azimuth"])
+        except (ValueError, KeyError):
+            return
+        self.history.append((self.clock(),) + position)
+        self.online = True
+
+    async def poll(self):
+        """Connect to the control computer and poll it every poll_interval seconds until
+        the connection fails. Every step must finish within the timeout. Returns True
+        if any position was received, so the IOCore knows to reconnect quickly."""
+        self.log.debug("Connecting to %s:%s...", self.address, self.port)
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(self.address, self.port), self.timeout)
+        received = False
+        try:
+            while True:
+                start = time.monotonic()
+                try:
+                    position, reply = await asyncio.wait_for(self.query(reader, writer),
+                                                             self.timeout)
+                except ValueError as e:
+                    raise EOFError("Bad reply from the control computer: {}".format(e))
+                metrics.observe("telescope.poll", time.monotonic() - start)
+                if self.recorder is not None:
+                    self.recorder.write(TELESCOPE, reply)
+                self.history.append((self.clock(),) + position)
+                self.online = True
+                received = True
+                self.log.log(TRACE, "Received position..")
+                await asyncio.sleep(max(0.0, self.interval - (time.monotonic() - start)))
+        finally:
+            # Positions from before the break would spoil the interpolation
+            self.online = False
+            self.history.clear()
+            writer.close()
+        return received
+
+    def position_at(self, t):
+        """Interpolate the pointing direction at the given POSIX time from the received
+        positions, or extrapolate it from the last two, at most max_extrapolation seconds
+        ahead. Returns (elevation, azimuth), or None if there are no positions."""
+        history = list(self.history)
+        if not history:
+            return None
+        if len(history) == 1 or t <= history[0][0]:
+            return history[0][1:]
+        # Interpolate between the positions around t, or extrapolate from the last two
+        i = next((i for i in range(1, len(history)) if history[i][0] >= t), None)
+        if i is None:
+            i = len(history) - 1
+            t = min(t, history[-1][0] + self.max_extrapolation)
+        t0, el0, az0 = history[i-1]
+        t1, el1, az1 = history[i]
+        if t1 <= t0:
+            return (el1, az1)
+        f = (t - t0) / (t1 - t0)
+        # Go the short way round in azimuth
+        daz = (az1 - az0 + pi) % (2*pi) - pi
+        return (el0 + f*(el1 - el0), (az0 + f*daz) % (2*pi))
+
+    def update_position(self, now=None):
+        """Estimate the current telescope pointing direction from the positions received
+        from the control computer. This does not wait for the network."""
+        position = self.position_at(self.clock() if now is None else now)
+        self.visible = self.online and position is not None
+        if self.visible:
+            self.position = position
     
     def draw(self):
-        """Draw symbol for telescope pointing onto axes."""
+        """Draw symbol for telescope pointing onto axes. Returns the artists."""
         if self.visible:
             if self.warn:
                 self.circle.set_color(self.color_warn)
@@ -63,11 +159,9 @@ class TelescopeHandler:
             alt, az = self.position
             # Convert alt into zenith angle in degrees
             alt = 90 - alt*180/pi
-            if self.DEBUG >= 2:
-                print("TelescopeHandler: Drawing scope at alt={:.2f}°, az={:.2f}°.".format(
-                    90-alt, az*180/pi))
+            self.log.debug("Drawing scope at alt=%.2f°, az=%.2f°.", 90-alt, az*180/pi)
             self.circle.set_data([az], [alt])
             self.cross.set_data([az], [alt])
         self.warn = False
+        return [self.circle, self.cross]
 
-    
\ No newline at end of file
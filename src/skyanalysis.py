@@ -0,0 +1,265 @@
+import json
+import time
+import logging
+import threading
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from numpy import (float32, intp, pi, bincount, argsort, flatnonzero, searchsorted,
+                   asarray, array, full, nan, minimum)
+import metrics
+from proximity import separation
+
+# The SkyAnalyzer tells how cloudy and how bright the sky is in each new skycam image,
+# to help decide whether the sky is clear enough to range. The CameraHandler gives it
+# every new image it has read, and the analysis runs in a worker thread of its own, so
+# neither the drawing nor the reading of the next image waits for it.
+#
+# Only the sky above min_altitude is looked at, and only every stride-th pixel in both
+# directions. The pixels of that region, their sector and their zenith angles are
+# found once from the lookup table of the SkyProjection (for each image size), so each
+# image is then a gather of those pixels and a few vectorized passes over them. A pixel
+# is counted as cloud when its red is at least cloud_ratio times its blue (clear sky is
+# blue, clouds are white or grey) and it is not darker than dark_level (the night sky).
+# The brightness is the mean luminance, from 0 to 255.
+#
+# The sky is divided into azimuth_sectors sectors of azimuth, and each of them into
+# bands of altitude at the altitude_bands edges. The cone of scope_radius degrees
+# around the telescope pointing at the time of the image is analyzed as well; the
+# pixels are kept sorted by zenith angle, so only the ring of zenith angles the cone
+# can reach is searched.
+#
+# The results of each image are kept by the file stamp of the image, so an image read
+# again is not analyzed again, and the latest history results form a time series. Each
+# result is also written as a JSON line into the output_file (if set), e.g.
+#   {"time": 1700000000.0, "duration": 0.004, "pixels": 270000, "cloud_fraction": 0.41,
+#    "brightness": 93.2, "sectors": [...], "scope": {...}}
+
+RAD = pi/180
+
+# Weights of the channels in the luminance
+LUMINANCE = array([0.299, 0.587, 0.114], dtype=float32)
+
+
+class Layout:
+    """The pixels of the analyzed region of images of one shape: their flat indices,
+    sorted by zenith angle, their zenith angles and azimuths, and their sectors."""
+
+    def __init__(self, lut, stride, edges, sectors):
+        zenith = lut.zenith[::stride, ::stride]
+        az = lut.az[::stride, ::stride]
+        self.shape = zenith.shape
+        index = flatnonzero(zenith <= (90 - edges[0]) * RAD)
+        order = argsort(zenith.flat[index], kind="stable")
+        self.index = index[order]
+        self.zenith = zenith.flat[self.index]
+        self.az = az.flat[self.index]
+        # Band of altitude and sector of azimuth of each pixel
+        altitude = 90 - self.zenith / RAD
+        band = searchsorted(asarray(edges[1:-1], dtype=float32), altitude, side="right")
+        sector = minimum((self.az / (2*pi) * sectors).astype(intp), sectors - 1)
+        self.labels = band * sectors + sector
+        self.count = len(edges) - 1
+        self.size = self.count * sectors
+        self.pixels = bincount(self.labels, minlength=self.size)
+
+
+class SkyAnalyzer:
+    def __init__(self, config, projection, clock=time.time):
+        self.log = logging.getLogger("skycam.SkyAnalyzer")
+        settings = config.get("analysis", {})
+        self.projection = projection
+        self.clock = clock
+        self.min_altitude = settings.get("min_altitude", 20.0)
+        self.sectors = settings.get("azimuth_sectors", 8)
+        bands = [b for b in settings.get("altitude_bands", [45, 70])
+                 if self.min_altitude < b < 90]
+        self.edges = [self.min_altitude] + sorted(bands) + [90.0]
+        self.cloud_ratio = settings.get("cloud_ratio", 0.62)
+        self.dark_level = settings.get("dark_level", 30)
+        self.scope_radius = settings.get("scope_radius", 5.0) * RAD
+        self.stride = max(1, settings.get("stride", 2))
+        # Function giving the telescope pointing (elevation, azimuth) in radians at a
+        # given time, or None when it is not known
+        self.pointing = None
+        self.layouts = {}
+        self.results = deque(maxlen=settings.get("history", 1000))
+        # Results by the stamp of their image
+        self.cache = OrderedDict()
+        self.cache_size = settings.get("cache_size", 16)
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix="SkyAnalyzer")
+        self.future = None
+        self.file = None
+        filename = settings.get("output_file", "")
+        if filename:
+            self.file = open(filename, "a")
+            self.log.info("Writing the analysis into '%s'.", filename)
+
+    def submit(self, image, size, stamp=None):
+        """Start analyzing an image array, downscaled from the given full size (width,
+        height). The image is copied, so it can be changed as soon as this returns. The
+        stamp (e.g. the modification time and size of the file) identifies the image;
+        an image already analyzed is not analyzed again. Returns False if the image was
+        skipped."""
+        if stamp is not None:
+            with self.lock:
+                if stamp in self.cache:
+                    metrics.add("skyanalysis.cached")
+                    return False
+        if self.future is not None and not self.future.done():
+            # Still busy with the last image
+            metrics.add("skyanalysis.skipped")
+            return False
+        now = self.clock()
+        pointing = self.pointing(now) if self.pointing is not None else None
+        data = image[::self.stride, ::self.stride].copy()
+        self.future = self.executor.submit(self.run, data, image.shape, size, stamp, now,
+                                           pointing)
+        return True
+
+    def layout(self, shape, size):
+        key = (shape[:2], tuple(size))
+        layout = self.layouts.get(key)
+        if layout is None:
+            lut = self.projection.lut(shape, size)
+            layout = self.layouts[key] = Layout(lut, self.stride, self.edges, self.sectors)
+            self.log.debug("%d pixels to analyze in images of %dx%d pixels.",
+                           len(layout.index), shape[1], shape[0])
+        return layout
+
+    def run(self, data, shape, size, stamp, now, pointing):
+        try:
+            result = self.analyze(data, shape, size, now, pointing)
+        except Exception:
+            self.log.exception("Analyzing the image failed.")
+            return None
+        with self.lock:
+            if stamp is not None:
+                self.cache[stamp] = result
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+            self.results.append(result)
+        metrics.add("skyanalysis.images")
+        metrics.observe("skyanalysis.analyze", result["duration"])
+        if result["pixels"]:
+            self.log.debug("Clouds %.0f %%, brightness %.0f.",
+                           100*result["cloud_fraction"], result["brightness"])
+        if self.file is not None:
+            self.file.write(json.dumps(result) + "\n")
+            self.file.flush()
+        return result
+
+    def analyze(self, data, shape, size, now=None, pointing=None):
+        """Analyze an image array taken with the stride from an image of the given
+        shape and full size. The pointing is the (elevation, azimuth) of the telescope
+        in radians, or None. Returns the result as a dict."""
+        layout = self.layout(shape, size)
+        start = time.perf_counter()
+        pixels = data.reshape(-1, data.shape[2])[layout.index]
+        rgb = pixels.astype(float32)
+        luminance = rgb @ LUMINANCE
+        cloudy = ((rgb[:,0] >= self.cloud_ratio * rgb[:,2])
+                  & (luminance >= self.dark_level)).astype(float32)
+        # Sums of each sector
+        clouds = bincount(layout.labels, cloudy, minlength=layout.size)
+        light = bincount(layout.labels, luminance, minlength=layout.size)
+        n = len(pixels)
+        result = {
+            "time": self.clock() if now is None else now,
+            "pixels": n,
+            "cloud_fraction": float(clouds.sum() / n) if n else None,
+            "brightness": float(light.sum() / n) if n else None,
+            "sectors": self.sector_results(layout, clouds, light),
+            "scope": None,
+        }
+        if pointing is not None:
+            result["scope"] = self.scope_result(layout, cloudy, luminance, pointing)
+        result["duration"] = time.perf_counter() - start
+        return result
+
+    def sector_results(self, layout, clouds, light):
+        sectors = []
+        width = 360 / self.sectors
+        for label, pixels in enumerate(layout.pixels.tolist()):
+            band, sector = divmod(label, self.sectors)
+            sectors.append({
+                "altitude": [self.edges[band], self.edges[band+1]],
+                "azimuth": [sector * width, (sector + 1) * width],
+                "pixels": pixels,
+                "cloud_fraction": float(clouds[label] / pixels) if pixels else None,
+                "brightness": float(light[label] / pixels) if pixels else None,
+            })
+        return sectors
+
+    def scope_result(self, layout, cloudy, luminance, pointing):
+        """Analyze the cone around the telescope pointing."""
+        elevation, az = pointing
+        zenith = pi/2 - elevation
+        lo, hi = searchsorted(layout.zenith, [zenith - self.scope_radius,
+                                              zenith + self.scope_radius])
+        d = separation(elevation, az, pi/2 - layout.zenith[lo:hi], layout.az[lo:hi])
+        inside = d <= self.scope_radius
+        n = int(inside.sum())
+        return {
+            "elevation": elevation / RAD, "azimuth": az / RAD, "pixels": n,
+            "cloud_fraction": float(cloudy[lo:hi][inside].mean()) if n else None,
+            "brightness": float(luminance[lo:hi][inside].mean()) if n else None,
+        }
+
+    def result(self, stamp):
+        """Return the result of the image with the given stamp, or None."""
+        with self.lock:
+            return self.cache.get(stamp)
+
+    def latest(self):
+        """Return the result of the latest image analyzed, or None."""
+        with self.lock:
+            return self.results[-1] if self.results else None
+
+    def series(self, name, sector=None):
+        """Return the times of the results and the named quantity of each (e.g.
+        "cloud_fraction", "brightness" or "duration") as arrays, for the whole sky, for
+        the sector with the given index, or for the cone of the telescope ("scope").
+        Missing values are NaN."""
+        with self.lock:
+            results = list(self.results)
+        times = array([r["time"] for r in results])
+        values = full(len(results), nan)
+        for k, r in enumerate(results):
+            part = r
+            if sector == "scope":
+                part = r["scope"]
+            elif sector is not None:
+                part = r["sectors"][sector]
+            if part is not None and part.get(name) is not None:
+                values[k] = part[name]
+        return times, values
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+if __name__=="__main__":
+    # Analyze images: python skyanalysis.py config.toml image.jpg ...
+    from sys import argv
+    from PIL import Image
+    import toml
+    from projection import SkyProjection
+    config = toml.loads(open(argv[1]).read())
+    for filename in argv[2:]:
+        with Image.open(filename) as image:
+            data = asarray(image.convert("RGB"))
+        analyzer = SkyAnalyzer(config, SkyProjection(config, (data.shape[1], data.shape[0])))
+        s = analyzer.stride
+        result = analyzer.analyze(data[::s, ::s], data.shape, (data.shape[1], data.shape[0]))
+        print("{}: clouds {:.0f} %, brightness {:.0f} ({:.1f} ms)".format(filename,
+              100*result["cloud_fraction"], result["brightness"], 1000*result["duration"]))
+        for part in result["sectors"]:
+            if part["pixels"]:
+                print("  alt {:>2.0f}-{:<2.0f} az {:>3.0f}-{:<3.0f}: clouds {:3.0f} %, "
+                      "brightness {:3.0f}".format(*part["altitude"], *part["azimuth"],
+                      100*part["cloud_fraction"], part["brightness"]))
+        analyzer.close()
@@ -1,8 +1,103 @@
-import urllib
+import time
+import queue
+import asyncio
+import logging
+import urllib.parse
+import http.client
 import toml
 from sys import argv
 from datetime import datetime
-from http.cookiejar import CookieJar
+from http.cookies import SimpleCookie
+from concurrent.futures import ThreadPoolExecutor
+from tlestore import ElementStore
+import logs
+
+# The SatelliteRetriever downloads orbital elements from Space-Track for all of the
+# satellite lists in the config. Satellites are only requested once even if they appear
+# in several lists, the requests are made concurrently over a small pool of persistent
+# connections, and lists whose elements are still fresh are not downloaded at all. The
+# elements are saved in the ElementStore, which keeps the older element sets as well.
+
+# Maximum number of satellites to request in one query
+CHUNK_SIZE = 100
+
+
+class ConnectionPool:
+    """A pool of persistent HTTP(S) connections to one host, shared by the download
+    threads. Also keeps the session cookies of the host."""
+
+    def __init__(self, url, size, timeout):
+        parts = urllib.parse.urlsplit(url)
+        self.https = parts.scheme == "https"
+        self.host = parts.netloc
+        self.prefix = parts.path.rstrip("/")
+        self.timeout = timeout
+        self.idle = queue.LifoQueue(size)
+        self.cookies = SimpleCookie()
+        self.opened = 0
+
+    def connect(self):
+        self.opened += 1
+        if self.https:
+            return http.client.HTTPSConnection(self.host, timeout=self.timeout)
+        return http.client.HTTPConnection(self.host, timeout=self.timeout)
+
+    def request(self, method, path, body=None, headers={}):
+        """Make a request, reusing an idle connection if there is one.
+        Returns the response status and body."""
+        headers = dict(headers)
+        cookie = "; ".join("{}={}".format(k, v.value) for k, v in self.cookies.items())
+        if cookie:
+            headers["Cookie"] = cookie
+        try:
+            connection = self.idle.get_nowait()
+            fresh = False
+        except queue.Empty:
+            connection = self.connect()
+            fresh = True
+        try:
+            connection.request(method, self.prefix + path, body, headers)
+            response = connection.getresponse()
+            data = response.read()
+        except (http.client.HTTPException, OSError):
+            connection.close()
+            if fresh:
+                raise
+            # The server may have closed an idle connection; try once with a new one
+            connection = self.connect()
+            connection.request(method, self.prefix + path, body, headers)
+            response = connection.getresponse()
+            data = response.read()
+        for header in response.headers.get_all("Set-Cookie", []):
+            self.cookies.load(header)
+        if response.will_close:
+            connection.close()
+        else:
+            try:
+                self.idle.put_nowait(connection)
+            except queue.Full:
+                connection.close()
+        return response.status, data
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+def parse_3le(data):
+    """Split a 3le-format response into a dict of (name line, line1, line2) tuples keyed
+    by NORAD catalog number."""
+    lines = [line for line in data.replace("\r", "").split("\n") if line.strip()]
+    elements = {}
+    for i in range(0, len(lines) - 2, 3):
+        name, line1, line2 = lines[i:i+3]
+        if not (line1.startswith("1 ") and line2.startswith("2 ")):
+            continue
+        elements[int(line1[2:7])] = (name, line1, line2)
+    return elements
 
 
 class SatelliteRetriever:
@@ -13,75 +108,122 @@ class SatelliteRetriever:
             "password" : config["satellite"]["spacetrack_password"]
         }
         self.lists = config["satellite"]["list"]
-        self.DEBUG = config["main"]["debug_level"]
-        self.CJ = CookieJar()
-        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(self.CJ))
+        self.log = logging.getLogger("skycam.SatelliteRetriever")
+        url = config["satellite"].get("spacetrack_url", "https://www.space-track.org")
+        self.workers = config["satellite"].get("download_threads", 4)
+        self.max_age = config["satellite"].get("max_element_age", 12) * 3600
+        self.store = ElementStore(config)
+        self.pool = ConnectionPool(url, self.workers, timeout=30)
 
     def log_in(self):
         """Log in to space-track.org and store the cookie (expired in ~2 hours).
         Returns True is the log-in succeeded and False if it failed."""
-        
-        if self.DEBUG >= 2:
-            print("SatelliteRetriever: Logging in...")
-            
+
+        self.log.debug("Logging in...")
+
         data = urllib.parse.urlencode(self.credentials).encode("ascii")
+        headers = {"Content-Type": "application/x-www-form-urlencoded"}
         try:
-            response = self.opener.open("https://www.space-track.org/ajaxauth/login", data)
-        except urllib.error.HTTPError as e:
-            print("SatelliteRetriever: {}".format(str(e)))
+            status, result = self.pool.request("POST", "/ajaxauth/login", data, headers)
+        except (http.client.HTTPException, OSError) as e:
+            self.log.warning("%s", e)
             return False
-        except urllib.error.URLError as e:
-            print("SatelliteRetriever: {}".format(str(e)))
+        if status != 200:
+            self.log.warning("Login failed with HTTP status %s.", status)
             return False
-            
-        result = response.read().decode("utf-8")
-        if "Failed" in result:
-            print("SatelliteRetriever: Login failed!")
+        if "Failed" in result.decode("utf-8"):
+            self.log.warning("Login failed!")
             return False
         self.last_login = datetime.now()
         return True
 
-    def download_data(self):
-        """Go through all satellite lists and download the orbital elements."""
-        
-        if self.DEBUG >= 1:
-            print("SatelliteRetriever: Downloading data...")
-        
+    def is_fresh(self, listname):
+        """Check if the latest stored elements of a list are all younger than
+        max_element_age."""
+        numbers = self.lists[listname]["numbers"]
+        latest = self.store.latest(numbers)
+        if not all(ID in latest for ID in numbers):
+            return False
+        oldest = min([latest[ID] for ID in numbers], default=time.time())
+        return time.time() - oldest < self.max_age
+
+    def fetch(self, IDs):
+        """Download the latest elements of the given satellites.
+        Returns a dict of elements keyed by catalog number, or None on failure."""
+        query = "/".join([
+            "/basicspacedata/query",
+            "class/tle_latest/ORDINAL/1",
+            "NORAD_CAT_ID/{}".format(",".join([str(id) for id in IDs])),
+            "format/3le"
+        ])
+        try:
+            status, data = self.pool.request("GET", query)
+        except (http.client.HTTPException, OSError) as e:
+            self.log.warning("%s", e)
+            return None
+        if status != 200:
+            self.log.warning("Query failed with HTTP status %s.", status)
+            return None
+        return parse_3le(data.decode("utf-8"))
+
+    def download_data(self, force=False):
+        """Go through all satellite lists and download the orbital elements of the lists
+        that are not fresh (or of all lists, if force is True)."""
+
+        self.log.info("Downloading data...")
+        lists = [name for name in self.lists if force or not self.is_fresh(name)]
+        if not lists:
+            self.log.debug("All elements are fresh.")
+            return True
+
         delta = datetime.now() - self.last_login
-        if delta.seconds > 5400:
-            if self.DEBUG >= 2:
-                print("SatelliteRetriever: Log-in expired, retrying...")
+        if delta.total_seconds() > 5400:
+            self.log.debug("Log-in expired, retrying...")
             ok = self.log_in()
             if not ok:
-                print("SatelliteRetriever: Log-in failed.")
-                return False
-        for listname in self.lists:
-            IDs = self.lists[listname]["numbers"]
-            filename = "{}.txt".format(listname)
-            query = "/".join([
-                "https://www.space-track.org/basicspacedata/query",
-                "class/tle_latest/ORDINAL/1",
-                "NORAD_CAT_ID/{}".format(",".join([str(id) for id in IDs])),
-                "format/3le"
-            ])
-            if self.DEBUG >= 2:
-                print("SatelliteRetriever: Requesting elements for '{}'...".format(listname))
-            try:
-                response = self.opener.open(query)
-            except urllib.error.HTTPError as e:
-                print("SatelliteRetriever: {}".format(str(e)))
+                self.log.warning("Log-in failed.")
                 return False
-            data = response.read().decode("utf-8")
-            data = data.replace("\r", "")
-            with open(filename, "w") as f:
-                if self.DEBUG >= 2:
-                    print("SatelliteRetriever: Saving to {}...".format(filename))
-                f.write(data)
+        IDs = sorted(set(ID for name in lists for ID in self.lists[name]["numbers"]))
+        chunks = [IDs[i:i+CHUNK_SIZE] for i in range(0, len(IDs), CHUNK_SIZE)]
+        self.log.debug("Requesting %d satellites for %s...", len(IDs), ", ".join(lists))
+        with ThreadPoolExecutor(self.workers) as executor:
+            results = list(executor.map(self.fetch, chunks))
+        if None in results:
+            return False
+        elements = {}
+        for result in results:
+            elements.update(result)
+        for listname in lists:
+            missing = [ID for ID in self.lists[listname]["numbers"] if ID not in elements]
+            if missing:
+                self.log.warning("No elements for %s in '%s'.",
+                                 ", ".join(str(ID) for ID in missing), listname)
+        self.log.debug("Saving to %s...", self.store.filename)
+        self.store.add(list(elements.values()))
         return True
-                
+
+    async def refresh(self, interval, callback, immediately=True):
+        """Download the elements every `interval` seconds (or only until the first
+        success, if it is None), calling callback after each successful download. Meant
+        to be run as a source of the IOCore; the download itself runs in a thread."""
+        loop = asyncio.get_running_loop()
+        wait = 0 if immediately else interval
+        try:
+            while wait is not None:
+                await asyncio.sleep(wait)
+                if await loop.run_in_executor(None, self.download_data):
+                    callback()
+                    wait = interval
+                else:
+                    # Try again sooner after a failure
+                    wait = 600 if interval is None else min(interval, 600)
+        finally:
+            self.pool.close()
+            self.log.info("Shutting down.")
 
 if __name__=="__main__":
     config = toml.loads(open(argv[1]).read())
+    logs.setup(config)
     S = SatelliteRetriever(config)
     #print(S.log_in())
-    print(S.download_data())
+    print(S.download_data(force=True))
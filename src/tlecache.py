@@ -0,0 +1,71 @@
+# coding: utf8
+import hashlib
+import logging
+from os import path, replace
+from numpy import array, load, savez
+from propagator import Satrec, ELEMENTS, read_tles, parse_elements
+
+# Parsing the text element files is slow for large catalogs, so the parsed orbital
+# elements of each file are kept in a compiled cache file next to it. The cache is valid
+# as long as the modification time and size of the text file match; if they don't, the
+# file contents are hashed and the cache is still used if the hash matches.
+
+log = logging.getLogger("skycam.TLE cache")
+
+
+def cache_filename(filename):
+    directory, name = path.split(filename)
+    return path.join(directory, ".{}.npz".format(name))
+
+
+def file_hash(filename):
+    with open(filename, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def load_tles(filename):
+    """Read the element sets in the given file, using the compiled cache if it is up to
+    date. Returns a list of (name, line1, line2) tuples and an array of ELEMENTS (or
+    None if sgp4 is not installed)."""
+    stat = path.getmtime(filename), path.getsize(filename)
+    cachefile = cache_filename(filename)
+    digest = None
+    try:
+        with load(cachefile) as cache:
+            valid = (float(cache["mtime"]), int(cache["size"])) == stat
+            if not valid:
+                digest = file_hash(filename)
+                valid = str(cache["sha1"]) == digest
+            if valid and (cache["elements"].dtype == ELEMENTS or Satrec is None):
+                log.debug("Using compiled elements for '%s'.", filename)
+                tles = list(zip(cache["names"].tolist(), cache["line1"].tolist(),
+                                cache["line2"].tolist()))
+                elements = cache["elements"] if Satrec is not None else None
+                if digest is not None:
+                    save_cache(cachefile, stat, digest, tles, elements)
+                return tles, elements
+    except (IOError, ValueError, KeyError):
+        pass
+    tles = read_tles(filename)
+    elements = parse_elements(tles)
+    if digest is None:
+        digest = file_hash(filename)
+    try:
+        save_cache(cachefile, stat, digest, tles, elements)
+    except IOError as e:
+        log.warning("Unable to write '%s': %s", cachefile, e)
+    return tles, elements
+
+
+def save_cache(cachefile, stat, digest, tles, elements):
+    """Write the compiled cache, replacing the old one atomically."""
+    if elements is None:
+        elements = array([], dtype="f8")
+    temp = cachefile + ".tmp"
+    with open(temp, "wb") as f:
+        savez(f, mtime=stat[0], size=stat[1], sha1=digest,
+              names=array([tle[0] for tle in tles], dtype="U"),
+              line1=array([tle[1] for tle in tles], dtype="U69"),
+              line2=array([tle[2] for tle in tles], dtype="U69"),
+              elements=elements)
+    replace(temp, cachefile)
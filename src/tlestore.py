@@ -0,0 +1,120 @@
+# coding: utf8
+import sqlite3
+import time
+import logging
+import toml
+from sys import argv
+from contextlib import closing
+from numpy import frombuffer
+from propagator import ELEMENTS, parse_elements, element_epoch, unix_time
+from tlecache import load_tles
+
+# The ElementStore is the local database of orbital elements. Every element set that has
+# been downloaded is kept, indexed by NORAD catalog number and epoch, so that for any
+# time the element set with the closest epoch can be picked (for example when replaying
+# a past night). The parsed mean elements are stored alongside the text lines, so loading
+# the catalog does not need to parse the TLEs again.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS elements (
+    norad INTEGER NOT NULL,
+    epoch REAL NOT NULL,
+    name TEXT NOT NULL,
+    line1 TEXT NOT NULL,
+    line2 TEXT NOT NULL,
+    parsed BLOB,
+    PRIMARY KEY (norad, epoch)
+) WITHOUT ROWID
+"""
+
+# SQLite limits the number of parameters in one statement
+QUERY_CHUNK = 500
+
+
+class ElementStore:
+    def __init__(self, config):
+        self.log = logging.getLogger("skycam.ElementStore")
+        self.filename = config["satellite"].get("element_store", "elements.sqlite")
+        with closing(self.connect()) as db:
+            with db:
+                db.execute(SCHEMA)
+
+    def connect(self):
+        # A new connection is made for every operation, so the store can be used from
+        # the download thread and the main thread at the same time.
+        return sqlite3.connect(self.filename, timeout=30)
+
+    def add(self, tles, elements=None):
+        """Store the given (name, line1, line2) element sets. Element sets that are
+        already in the store are ignored. Returns the number of new element sets."""
+        if elements is None:
+            elements = parse_elements(tles)
+        rows = []
+        for i, (name, line1, line2) in enumerate(tles):
+            epoch = unix_time(element_epoch(line1))[0]
+            parsed = None if elements is None else elements[i].tobytes()
+            if name.startswith("0 "):
+                name = name[2:]
+            rows.append((int(line1[2:7]), epoch, name.strip(), line1, line2, parsed))
+        with closing(self.connect()) as db:
+            with db:
+                before = db.total_changes
+                db.executemany("INSERT OR IGNORE INTO elements VALUES (?,?,?,?,?,?)", rows)
+                added = db.total_changes - before
+        self.log.debug("Added %d new element sets.", added)
+        return added
+
+    def import_file(self, filename):
+        """Add the element sets in a text file, e.g. from an older version."""
+        tles, elements = load_tles(filename)
+        return self.add(tles, elements)
+
+    def latest(self, numbers):
+        """Return a dict of the latest stored epoch (POSIX time) of each satellite."""
+        epochs = {}
+        with closing(self.connect()) as db:
+            for chunk in chunks(numbers):
+                query = "SELECT norad, MAX(epoch) FROM elements WHERE norad IN ({}) "\
+                        "GROUP BY norad".format(",".join("?" * len(chunk)))
+                epochs.update(db.execute(query, chunk))
+        return epochs
+
+    def select(self, numbers, when=None):
+        """For each of the given satellites, find the element set whose epoch is closest
+        to the given time (default now). Returns a list of (name, line1, line2) tuples
+        and an array of ELEMENTS (or None if they are not all available), in the order
+        of the given numbers. Satellites without elements are left out."""
+        t = time.time() if when is None else unix_time(when)[0]
+        found = {}
+        with closing(self.connect()) as db:
+            for chunk in chunks(numbers):
+                query = """
+                    SELECT norad, name, line1, line2, parsed FROM (
+                        SELECT *, ROW_NUMBER() OVER (
+                            PARTITION BY norad ORDER BY ABS(epoch - ?)) AS n
+                        FROM elements WHERE norad IN ({}))
+                    WHERE n = 1""".format(",".join("?" * len(chunk)))
+                for norad, name, line1, line2, parsed in db.execute(query, [t] + chunk):
+                    found[norad] = ((name, line1, line2), parsed)
+        rows = [found[ID] for ID in numbers if ID in found]
+        tles = [tle for tle, parsed in rows]
+        if rows and all(parsed is not None for tle, parsed in rows):
+            elements = frombuffer(b"".join(parsed for tle, parsed in rows), dtype=ELEMENTS)
+        elif rows:
+            elements = None
+        else:
+            elements = parse_elements([])
+        return tles, elements
+
+
+def chunks(numbers):
+    numbers = [int(ID) for ID in numbers]
+    return [numbers[i:i+QUERY_CHUNK] for i in range(0, len(numbers), QUERY_CHUNK)]
+
+
+if __name__=="__main__":
+    # Import element files into the store: python tlestore.py config.toml file.txt ...
+    config = toml.loads(open(argv[1]).read())
+    store = ElementStore(config)
+    for filename in argv[2:]:
+        print("{}: {} new element sets.".format(filename, store.import_file(filename)))
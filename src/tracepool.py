@@ -0,0 +1,72 @@
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from numpy import float32
+from propagator import Propagator
+
+# The TracePool computes satellite positions for the traces in worker processes, so that
+# the drawing thread is not held up (threads would not help, as the propagation holds the
+# GIL). A job is the element sets of one satellite list, the satellites in it and the
+# times to compute; the worker returns the alt, az and range as compact float32 arrays,
+# and the eclipse flags. Each worker keeps the Propagator of the lists it has seen, so
+# the elements are only parsed again after they change. Only one job per list runs at a
+# time.
+
+# Propagators of the worker process, keyed by the element sets
+_propagators = {}
+
+
+def propagate(config, tles, elements, times, index):
+    """Compute the positions of the satellites with the given indices in the list of
+    element sets, at the given POSIX times. Runs in a worker process."""
+    key = tuple(line1 + line2 for name, line1, line2 in tles)
+    propagator = _propagators.get(key)
+    if propagator is None:
+        if len(_propagators) > 16:
+            _propagators.clear()
+        propagator = Propagator(config)
+        propagator.load(tles, elements)
+        _propagators[key] = propagator
+    alt, az, rng, eclipsed = propagator.compute(times, index)
+    return alt.astype(float32), az.astype(float32), rng.astype(float32), eclipsed
+
+
+class TracePool:
+    def __init__(self, config, workers):
+        self.log = logging.getLogger("skycam.TracePool")
+        # The workers only need the location
+        self.config = {"main": config["main"], "location": config["location"]}
+        # Forking a process that already runs other threads (e.g. the IOCore) is not
+        # safe, so the workers are started as new interpreters
+        self.executor = ProcessPoolExecutor(workers, multiprocessing.get_context("spawn"))
+        self.jobs = {} # list name: (future, tag)
+
+    def busy(self, name):
+        return name in self.jobs
+
+    def submit(self, name, tles, elements, times, index, tag=None):
+        """Start computing the positions of the given satellites of one list. The tag is
+        given back with the results."""
+        future = self.executor.submit(propagate, self.config, tles, elements, times, index)
+        self.jobs[name] = (future, tag)
+
+    def ready(self):
+        """Check if any of the jobs has finished."""
+        return any(future.done() for future, tag in self.jobs.values())
+
+    def collect(self):
+        """Return the tags and results of the finished jobs, as a list of
+        (tag, (alt, az, range, eclipsed)) tuples. Failed jobs are left out."""
+        results = []
+        for name, (future, tag) in list(self.jobs.items()):
+            if not future.done():
+                continue
+            del self.jobs[name]
+            try:
+                results.append((tag, future.result()))
+            except Exception as e:
+                self.log.warning("Computing the traces of '%s' failed: %s", name, e)
+        return results
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
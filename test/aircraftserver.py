@@ -1,12 +1,20 @@
 import socket
-from sys import exit
+import threading
+from sys import exit, argv
 import time
+from collections import deque
 from datetime import datetime
 from math import sin, pi
 
 # This program starts a server on port 7879, sending the same piece of XML
 # flight date every second. This can be used as a simple test server for
 # aircraft.py
+#
+# Given several ports (python test/aircraftserver.py 7879 7880 7881), it emulates a
+# receiver on each of them, for the aircraft.sources option. Every receiver sends the
+# same aircraft at the same positions, each one later than the one before (by 0.5 s
+# more), so the later copies are dropped as repeats, and one aircraft that only it can
+# see.
 
 Hlat = 60.217165
 Hlon = 24.394562
@@ -16,38 +24,71 @@ DATA2 = "<MODESMESSAGE><DATETIME>{}</DATETIME><MODES>400F2C</MODES><CALLSIGN>OVW
 
 
 
-def position(T0):
-    dT = time.monotonic() - T0
-    T = (dT % 15.0) / 15.0
+# Start of the flight paths, shared by all the receivers, so that they all report the
+# same positions at the same time and differ only in their lag
+T0 = int(time.time())
+
+
+def position(t):
+    """The timestamp and position at the given whole second."""
+    T = ((t - T0) % 15.0) / 15.0
     lat = Hlat - 0.02
     lon = Hlon + 0.02 * sin(2*pi*T)
-    timestamp = datetime.utcnow().strftime("%Y%m%d%H%M%S")
+    timestamp = datetime.utcfromtimestamp(t).strftime("%Y%m%d%H%M%S")
     return timestamp, lat, lon
 
-def serve():
+def own_aircraft(t, k):
+    """The aircraft that only receiver k sees, flying north across the sky."""
+    timestamp, lat, lon = position(t)
+    lat = Hlat - 0.2 + 0.4 * (((t - T0) / 120.0 + 0.25 * k) % 1.0)
+    lon = Hlon + 0.05 * (k - 1)
+    message = DATA1.format(timestamp, lat, lon)
+    return message.replace("400F2B", "4{:05X}".format(0xF30 + k)).replace(
+        "OVW84", "RX{}".format(k))
+
+def serve(port=7879, k=None):
+    """Serve the aircraft on the given port. With k, emulate the k:th of several
+    receivers."""
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.bind(("localhost", 7879))
+    sock.bind(("localhost", port))
     sock.listen(5)
-    print("Listening")
-    try:
+    print("Listening on port {}".format(port))
+    while True:
+        (clientsocket, address) = sock.accept()
+        print("Connection from {} on port {}".format(address, port))
+        last = None
+        # Messages waiting for the lag of the receiver, as (time to send, message)
+        queue = deque()
         while True:
-            (clientsocket, address) = sock.accept()
-            print("Connection from {}".format(address))
-            T0 = time.monotonic()
-            while True:
+            t = int(time.time())
+            if t != last:
+                last = t
                 timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-                message1 = bytes(DATA1.format(*position(T0)), "utf-8")
+                message1 = bytes(DATA1.format(*position(t)), "utf-8")
                 message2 = bytes(DATA2.format(timestamp), "utf-8")
-                try:
-                    clientsocket.send(message1)
+                if k is not None:
+                    message1 += bytes(own_aircraft(t, k), "utf-8")
+                queue.append((time.monotonic() + 0.5 * (k or 0), message1))
+            try:
+                while queue and queue[0][0] <= time.monotonic():
+                    clientsocket.send(queue.popleft()[1])
                     #clientsocket.send(message2)
-                except BrokenPipeError:
-                    print("Lost connection")
-                    break
-                time.sleep(0.2)
-    except KeyboardInterrupt:
-        sock.close()
-        exit()
+            except BrokenPipeError:
+                print("Lost connection on port {}".format(port))
+                break
+            time.sleep(0.1)
 
 if __name__=="__main__":
-    serve()
+    ports = [int(port) for port in argv[1:]]
+    if len(ports) <= 1:
+        try:
+            serve(*ports)
+        except KeyboardInterrupt:
+            exit()
+    for k, port in enumerate(ports):
+        threading.Thread(target=serve, args=(port, k), daemon=True).start()
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        exit()
@@ -0,0 +1,467 @@
+import sys
+import gc
+import json
+import time
+import random
+import shutil
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+from datetime import datetime
+from os import path, chdir, getcwd, remove
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), "..", "src"))
+import toml
+import matplotlib
+matplotlib.use("Agg")
+from matplotlib import pyplot as plt
+from numpy import median
+from modes import ModeSDecoder
+from aircraft import AircraftHandler, AircraftListener, AircraftSnapshot
+from satellite import SatelliteHandler
+from camera import CameraHandler
+from projection import SkyProjection, set_projection, align_overlay
+from skyanalysis import SkyAnalyzer
+from scope import TelescopeHandler
+from tlecache import load_tles, cache_filename
+from render import BlitManager
+from main import Animator
+from aircraftserver import DATA1, Hlat, Hlon
+from benchmark_modes import make_stream
+
+# This program measures the hot paths of the skycam view one at a time, with synthetic
+# data in the style of the real inputs:
+#
+#   modes       decoding the aircraft stream (AircraftListener and AircraftHandler.update)
+#   aircraft    projecting and drawing the aircraft, for different numbers of tracks
+#   satellites  drawing the satellites and their traces, for different catalog sizes and
+#               trace lengths
+#   tles        loading element files, with and without the compiled cache
+#   camera      reading and drawing the skycam image, the memory used over many image
+#               changes, the lookup table of the lens projection and the analysis of
+#               the clouds
+#   animator    whole frames of the Animator with the Agg backend, with and without
+#               blitting
+#
+# The results are printed as JSON, so that the runs of different versions can be
+# compared. Times are in milliseconds; for repeated measurements the minimum, median and
+# maximum are given.
+#
+# Usage: python test/benchmark.py [--quick] [section ...] > results.json
+
+HERE = path.dirname(path.abspath(__file__))
+ROOT = path.join(HERE, "..")
+
+SIZES = {
+    "messages": 20000,
+    "tracks": [10, 100, 1000],
+    "catalog": [100, 1000, 5000],
+    "trace_steps": [8, 32],
+    "tle_files": [1000, 10000],
+    "camera_cycles": 40,
+    "frames": 30,
+}
+
+QUICK_SIZES = {
+    "messages": 5000,
+    "tracks": [10, 100],
+    "catalog": [100, 1000],
+    "trace_steps": [8],
+    "tle_files": [1000],
+    "camera_cycles": 10,
+    "frames": 10,
+}
+
+
+def log(message):
+    print(message, file=sys.stderr)
+
+
+def stats(times):
+    """Summarize a list of durations in seconds, in milliseconds."""
+    return {"min_ms": 1000*min(times), "median_ms": 1000*float(median(times)),
+            "max_ms": 1000*max(times), "runs": len(times)}
+
+
+def measure(function, repeat):
+    """Call the function repeat times and summarize the durations."""
+    times = []
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - t0)
+    return stats(times)
+
+
+class StepClock:
+    """A clock for the handlers that advances by a fixed step each time step() is
+    called, so that every run sees the same sequence of times."""
+
+    def __init__(self, start, step):
+        self.t = start
+        self.step_size = step
+
+    def __call__(self):
+        return self.t
+
+    def step(self):
+        self.t += self.step_size
+
+
+def checksum(line):
+    total = sum(int(c) if c.isdigit() else c == "-" for c in line[:68])
+    return line[:68] + str(total % 10)
+
+
+def make_tles(count, seed=1):
+    """Return a list of (name, line1, line2) element sets with the epoch of today, in
+    orbits from low Earth orbit to navigation satellite altitudes."""
+    rng = random.Random(seed)
+    now = datetime.utcnow()
+    epoch = "{:02d}{:012.8f}".format(now.year % 100, now.timetuple().tm_yday)
+    tles = []
+    for k in range(count):
+        number = 10000 + k
+        motion = rng.choice([15.5, 14.2, 13.0, 12.5, 2.0056, 1.7])
+        line1 = "1 {:05d}U 00000A   {} .00000000  00000-0  00000-0 0  999".format(
+            number, epoch)
+        line2 = "2 {:05d} {:8.4f} {:8.4f} {:07d} {:8.4f} {:8.4f} {:11.8f}    1".format(
+            number, rng.uniform(0.0, 100.0), rng.uniform(0.0, 360.0),
+            rng.randint(1, 20000), rng.uniform(0.0, 360.0), rng.uniform(0.0, 360.0),
+            motion + rng.uniform(-0.01, 0.01))
+        tles.append(("SAT {}".format(number), checksum(line1.ljust(68)),
+                     checksum(line2.ljust(68))))
+    return tles
+
+
+def write_tles(filename, tles):
+    with open(filename, "w") as f:
+        for name, line1, line2 in tles:
+            f.write("0 {}\n{}\n{}\n".format(name, line1, line2))
+
+
+def make_messages(count, start):
+    """Return messages from count aircraft within 50 km, all updated at start."""
+    rng = random.Random(count)
+    timestamp = datetime.fromtimestamp(start).strftime("%Y%m%d%H%M%S")
+    decoder = ModeSDecoder()
+    stream = "".join(
+        DATA1.format(timestamp, Hlat + rng.uniform(-0.4, 0.4),
+                     Hlon + rng.uniform(-0.8, 0.8)).replace(
+            "400F2B", "{:06X}".format(0x400000 + k)) for k in range(count))
+    decoder.feed(stream.encode("utf-8"))
+    return decoder.decode()
+
+
+def make_config(workdir):
+    """The example configuration, with the files in the work directory."""
+    with open(path.join(ROOT, "config.toml")) as f:
+        config = toml.loads(f.read())
+    config["main"]["debug_level"] = 0
+    config["skycam"]["image_path"] = workdir
+    config["satellite"]["element_store"] = path.join(workdir, "elements.sqlite")
+    config["satellite"]["trace_workers"] = 0
+    config["satellite"]["list"] = {}
+    config.pop("recorder", None)
+    for name in (config["skycam"]["image_name"], config["skycam"]["default_image"]):
+        shutil.copy(path.join(HERE, name), workdir)
+    return config
+
+
+def catalog_config(config, size, steps):
+    """Use one list with a synthetic catalog of the given size, and traces of the given
+    number of steps."""
+    listname = "catalog{}".format(size)
+    if not path.exists(listname + ".txt"):
+        write_tles(listname + ".txt", make_tles(size))
+    config["satellite"]["list"] = {listname: {"show": True}}
+    config["satellite"]["trace_backward"] = steps // 4
+    config["satellite"]["trace_forward"] = steps - steps // 4
+    return config
+
+
+def bench_modes(config, sizes):
+    chunks, total = make_stream(sizes["messages"], 50)
+    size = sum(len(chunk) for chunk in chunks)
+
+    def run():
+        handler = AircraftHandler(None, config)
+        listener = AircraftListener(config, handler)
+        for chunk in chunks:
+            listener.feed(chunk)
+        if len(handler.table.slots) != 50:
+            raise RuntimeError("Decoded {} aircraft".format(len(handler.table.slots)))
+
+    result = measure(run, 3)
+    seconds = result["min_ms"] / 1000
+    return {"messages": total, "bytes": size, "messages_per_s": total / seconds,
+            "bytes_per_s": size / seconds, "time": result}
+
+
+def bench_aircraft(config, sizes):
+    results = {}
+    start = time.time()
+    config["aircraft"]["max_distance"] = 1000
+    config["aircraft"]["min_altitude"] = 0
+    for tracks in sizes["tracks"]:
+        fig = plt.figure(figsize=(8, 8))
+        ax = fig.add_subplot(111, polar=True)
+        ax.set_ylim(0, 90)
+        fig.canvas.draw()
+        handler = AircraftHandler(ax, config, clock=lambda: start)
+        handler.update(make_messages(tracks, start))
+        snapshot = handler.snapshot
+
+        def render():
+            for artist in handler.draw():
+                fig.draw_artist(artist)
+
+        handler.draw()
+        results[str(tracks)] = {
+            "snapshot": measure(lambda: AircraftSnapshot(handler.table), 50),
+            "project": measure(lambda: handler.sky_positions(snapshot), 50),
+            "draw": measure(handler.draw, 50),
+            "render": measure(render, 20),
+        }
+        plt.close(fig)
+        log("  {} tracks".format(tracks))
+    return results
+
+
+def bench_satellites(config, sizes):
+    results = {}
+    interval = config["main"]["update_interval"]
+    trace_interval = config["satellite"]["trace_interval"]
+    for size in sizes["catalog"]:
+        for steps in sizes["trace_steps"]:
+            catalog_config(config, size, steps)
+            fig = plt.figure(figsize=(8, 8))
+            ax = fig.add_subplot(211, polar=True)
+            ax_text = fig.add_subplot(212)
+            clock = StepClock(time.time(), interval)
+            t0 = time.perf_counter()
+            handler = SatelliteHandler(ax, ax_text, config, clock)
+            load = time.perf_counter() - t0
+            # The passes are predicted by a job of the Animator after loading
+            t0 = time.perf_counter()
+            handler.passes.rebuild(clock())
+            passes = time.perf_counter() - t0
+
+            def draw():
+                clock.step()
+                handler.draw()
+
+            t0 = time.perf_counter()
+            handler.draw_traces()
+            cold = time.perf_counter() - t0
+            # In the steady state one new sample of each trace is computed per draw
+            clock.step_size = trace_interval
+
+            def draw_traces():
+                clock.step()
+                handler.draw_traces()
+
+            traces = measure(draw_traces, 10)
+            clock.step_size = interval
+            results["{}x{}".format(size, steps)] = {
+                "satellites": size, "trace_steps": steps,
+                "load_ms": 1000*load, "passes_ms": 1000*passes,
+                "draw": measure(draw, 20),
+                "traces_first_ms": 1000*cold, "traces": traces,
+            }
+            handler.close()
+            plt.close(fig)
+            log("  {} satellites, {} trace steps".format(size, steps))
+    return results
+
+
+def bench_tles(config, sizes):
+    results = {}
+    for size in sizes["tle_files"]:
+        filename = "tles{}.txt".format(size)
+        write_tles(filename, make_tles(size))
+
+        def cold():
+            if path.exists(cache_filename(filename)):
+                remove(cache_filename(filename))
+            load_tles(filename)
+
+        results[str(size)] = {"uncached": measure(cold, 3),
+                              "cached": measure(lambda: load_tles(filename), 5)}
+        log("  {} element sets".format(size))
+    return results
+
+
+def bench_camera(config, sizes):
+    results = {}
+    cycles = sizes["camera_cycles"]
+    for max_size in (0, 1024):
+        config["skycam"]["max_size"] = max_size
+        fig = plt.figure(figsize=(8, 8))
+        ax = fig.add_subplot(111)
+        camera = CameraHandler(ax, config)
+        camera.draw_image()
+        fig.canvas.draw()
+        reads, draws = [], []
+        memory = []
+        tracemalloc.start()
+        for i in range(cycles):
+            t0 = time.perf_counter()
+            result = camera.read_image()
+            t1 = time.perf_counter()
+            camera.stamp, camera.pending = result
+            camera.update_image()
+            camera.draw_image()
+            fig.canvas.draw()
+            t2 = time.perf_counter()
+            reads.append(t1 - t0)
+            draws.append(t2 - t1)
+            gc.collect()
+            memory.append(tracemalloc.get_traced_memory()[0])
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        # Leave out the first cycles, which allocate the buffers
+        settled = memory[min(2, len(memory) - 1)]
+        results["max_size_{}".format(max_size)] = {
+            "image_size": list(camera.size), "cycles": cycles,
+            "read": stats(reads), "draw": stats(draws),
+            "memory_growth_bytes": memory[-1] - settled, "memory_peak_bytes": peak,
+        }
+        plt.close(fig)
+        log("  max_size {}".format(max_size))
+    config["skycam"]["max_size"] = 0
+    # The lookup table of the lens projection, and the work on every pixel through it
+    image = camera.buffers[camera.shown]
+    projection = SkyProjection(config, camera.size)
+    lut = projection.lut(image.shape, camera.size)
+    results["projection"] = {
+        "lut_compute": measure(lambda: projection.compute_lut(image.shape, camera.size), 3),
+        "lut_load": measure(lambda: SkyProjection(config, camera.size).lut(image.shape,
+                                                                          camera.size), 3),
+        "mask": measure(lambda: lut.mask(image.copy(), 5.0), 10),
+        "region": measure(lambda: lut.statistics(image, lut.region(30, 60)), 10),
+        "reproject": measure(lambda: projection.reproject(image, camera.size), 10),
+    }
+    log("  projection")
+    # The analysis of the clouds of an image, from the copy for the worker to the result
+    for stride in (1, 2):
+        config["analysis"] = {"stride": stride}
+        analyzer = SkyAnalyzer(config, projection)
+        def analyze():
+            data = image[::stride, ::stride].copy()
+            analyzer.analyze(data, image.shape, camera.size, pointing=(1.0, 2.0))
+        analyze()
+        results["analysis_stride_{}".format(stride)] = measure(analyze, 10)
+        analyzer.close()
+    del config["analysis"]
+    log("  analysis")
+    return results
+
+
+def make_view(config):
+    """A figure with the Axes of the view, as set up by main()."""
+    fig = plt.figure(figsize=(16, 9))
+    fig.patch.set_color("black")
+    ax_skycam = fig.add_subplot(311)
+    ax_symbols = fig.add_subplot(312, polar=True)
+    ax_text = fig.add_subplot(313)
+    ax_skycam.set_position((0.01, 0.02, 0.73, 0.96))
+    ax_text.set_position((0.75, 0.02, 0.2, 0.96))
+    ax_symbols.patch.set_alpha(0.0)
+    projection = SkyProjection(config, (1600, 1200))
+    set_projection(ax_symbols, projection)
+    align_overlay(ax_skycam, ax_symbols, projection, (1600, 1200))
+    return fig, ax_skycam, ax_symbols, ax_text
+
+
+def bench_animator(config, sizes):
+    results = {}
+    catalog_config(config, sizes["catalog"][1], sizes["trace_steps"][0])
+    start = time.time()
+    for blit in (False, True):
+        fig, ax_skycam, ax_symbols, ax_text = make_view(config)
+        camera = CameraHandler(ax_skycam, config)
+        satellites = SatelliteHandler(ax_symbols, ax_text, config)
+        satellites.passes.rebuild()
+        aircraft = AircraftHandler(ax_symbols, config)
+        aircraft.update(make_messages(sizes["tracks"][1], start))
+        scope = TelescopeHandler(ax_symbols, config)
+        scope.history.append((start, 0.8, 1.0))
+        scope.online = True
+        blitter = BlitManager(fig.canvas, config) if blit else None
+        animator = Animator(config, aircraft, camera, satellites, scope, blitter)
+        animator.init()
+        fig.canvas.draw()
+        times = []
+        for i in range(sizes["frames"]):
+            t0 = time.perf_counter()
+            animator(i)
+            if blitter is None:
+                fig.canvas.draw()
+            times.append(time.perf_counter() - t0)
+        results["blit" if blit else "full"] = {
+            "first_frame_ms": 1000*times[0], "frames": stats(times[1:]),
+            "jobs_ms": {job.name: 1000*job.duration for job in animator.scheduler.jobs},
+        }
+        satellites.close()
+        plt.close(fig)
+        log("  {}".format("blitted" if blit else "full draws"))
+    return results
+
+
+SECTIONS = {
+    "modes": bench_modes,
+    "aircraft": bench_aircraft,
+    "satellites": bench_satellites,
+    "tles": bench_tles,
+    "camera": bench_camera,
+    "animator": bench_animator,
+}
+
+
+def version():
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"],
+                                       cwd=ROOT, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(sections, sizes):
+    report = {
+        "version": version(),
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "sizes": sizes,
+        "results": {},
+    }
+    cwd = getcwd()
+    workdir = tempfile.mkdtemp(prefix="skycam-benchmark-")
+    try:
+        chdir(workdir)
+        for name in sections:
+            log("{}...".format(name))
+            config = make_config(workdir)
+            report["results"][name] = SECTIONS[name](config, sizes)
+    finally:
+        chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+    return report
+
+
+if __name__=="__main__":
+    args = sys.argv[1:]
+    sizes = SIZES
+    if "--quick" in args:
+        args.remove("--quick")
+        sizes = QUICK_SIZES
+    unknown = [name for name in args if name not in SECTIONS]
+    if unknown:
+        print("Unknown sections: {}. The sections are: {}".format(
+            ", ".join(unknown), ", ".join(SECTIONS)), file=sys.stderr)
+        sys.exit(1)
+    report = run(args or list(SECTIONS), sizes)
+    json.dump(report, sys.stdout, indent=2)
+    print()
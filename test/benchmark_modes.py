@@ -0,0 +1,112 @@
+import sys
+import time
+import random
+import xml.etree.ElementTree as ET
+from datetime import datetime, timedelta
+from os import path
+
+sys.path.insert(0, path.join(path.dirname(path.abspath(__file__)), "..", "src"))
+from modes import ModeSDecoder, USED_DATA_FIELDS, verify_fields
+from aircraft import AircraftTable
+from aircraftserver import DATA1, Hlat, Hlon
+
+# This program measures the throughput of decoding the RadarBox ModeS stream, comparing
+# the XML pull parser that the AircraftListener used before with the ModeSDecoder. The
+# synthetic stream has messages from many aircraft in the style of aircraftserver.py,
+# cut into chunks of random size as they would arrive from a socket.
+#
+# Usage: python test/benchmark_modes.py [messages] [aircraft]
+
+
+def make_stream(count, aircraft, seed=1):
+    """Return the stream as a list of byte chunks, and the number of messages."""
+    rng = random.Random(seed)
+    start = datetime.now()
+    messages = []
+    for i in range(count):
+        timestamp = (start + timedelta(seconds=i // aircraft)).strftime("%Y%m%d%H%M%S")
+        lat = Hlat + rng.uniform(-0.5, 0.5)
+        lon = Hlon + rng.uniform(-1.0, 1.0)
+        message = DATA1.format(timestamp, lat, lon)
+        messages.append(message.replace("400F2B", "{:06X}".format(0x400000 + i % aircraft)))
+    data = "".join(messages).encode("utf-8")
+    chunks = []
+    pos = 0
+    while pos < len(data):
+        size = rng.randint(200, 8192)
+        chunks.append(data[pos:pos+size])
+        pos += size
+    return chunks, count
+
+
+def old_path(chunks, table):
+    """The XML pull parser, element events and strptime, as in the original code. The
+    field texts are read at the end events here, because at the start events they may
+    not have arrived yet when a message is split between chunks."""
+    parser = ET.XMLPullParser(["start", "end"])
+    parser.feed("<DATASTREAM>")
+    new_data = {}
+    count = 0
+    for chunk in chunks:
+        parser.feed(chunk)
+        for event_type, element in parser.read_events():
+            if event_type == "start":
+                if element.tag == "MODESMESSAGE":
+                    new_data = {}
+            elif element.tag in USED_DATA_FIELDS:
+                new_data[element.tag] = element.text
+            elif element.tag == "MODESMESSAGE":
+                if not verify_fields(new_data):
+                    continue
+                datetime.strptime(new_data["DATETIME"], "%Y%m%d%H%M%S")
+                if table is not None:
+                    table.update(new_data)
+                count += 1
+    return count
+
+
+def new_path(chunks, table):
+    """The ModeSDecoder, feeding the decoded messages to the table."""
+    decoder = ModeSDecoder()
+    count = 0
+    for chunk in chunks:
+        decoder.feed(chunk)
+        for data in decoder.decode():
+            if table is not None:
+                table.update(data)
+            count += 1
+    return count
+
+
+def measure(function, chunks, table, repeat=3):
+    best = float("inf")
+    for i in range(repeat):
+        T = None if table is None else AircraftTable()
+        t0 = time.perf_counter()
+        count = function(chunks, T)
+        best = min(best, time.perf_counter() - t0)
+    return count, best
+
+
+def run(count=20000, aircraft=50):
+    """Run the benchmark and return the results as a dict of messages per second."""
+    chunks, total = make_stream(count, aircraft)
+    results = {}
+    for name, function in [("xml", old_path), ("decoder", new_path)]:
+        for label, table in [("parse", None), ("parse_update", True)]:
+            n, elapsed = measure(function, chunks, table)
+            if n != total:
+                raise RuntimeError("{} decoded {} of {} messages".format(name, n, total))
+            results["{}_{}".format(name, label)] = total / elapsed
+    return results
+
+
+if __name__=="__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    aircraft = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    results = run(count, aircraft)
+    for name, rate in results.items():
+        print("{:<22} {:>10.0f} messages/s".format(name, rate))
+    print("Speed-up: {:.1f}x (parse), {:.1f}x (parse and update)".format(
+        results["decoder_parse"] / results["xml_parse"],
+        results["decoder_parse_update"] / results["xml_parse_update"]))
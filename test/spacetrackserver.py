@@ -0,0 +1,64 @@
+import sys
+import time
+from datetime import datetime
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+# This program starts a stub Space-Track server on port 7880, which answers log-ins and
+# element queries with made-up element sets for any requested catalog numbers. This can
+# be used to test spacetrack.py by setting spacetrack_url = "http://localhost:7880" in
+# the config file.
+
+def checksum(line):
+    total = sum(int(c) if c.isdigit() else (1 if c == "-" else 0) for c in line[:68])
+    return line[:68] + str(total % 10)
+
+def elements(ID):
+    """Return a made-up element set for the satellite, with the current epoch."""
+    now = datetime.utcnow()
+    day = now.timetuple().tm_yday + (now.hour + now.minute / 60) / 24
+    epoch = "{:02d}{:012.8f}".format(now.year % 100, day)
+    line1 = "1 {:05d}U 00000A   {}  .00000000  00000-0  00000-0 0  9990".format(ID, epoch)
+    line2 = "2 {:05d} {:8.4f} {:8.4f} 0010000 {:8.4f} {:8.4f}  2.00560000000010".format(
+        ID, 55.0, (ID * 7) % 360, 0.0, (ID * 13) % 360)
+    return "0 SAT {}\n{}\n{}\n".format(ID, checksum(line1), checksum(line2))
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def reply(self, body, cookie=None):
+        body = bytes(body, "utf-8")
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        if cookie:
+            self.send_header("Set-Cookie", cookie)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.rfile.read(length)
+        self.reply('""', cookie="chocolatechip=stub; path=/")
+
+    def do_GET(self):
+        if "chocolatechip=stub" not in self.headers.get("Cookie", ""):
+            self.reply('{"error":"You must be logged in"}')
+            return
+        parts = self.path.split("/")
+        IDs = parts[parts.index("NORAD_CAT_ID") + 1].split(",")
+        time.sleep(DELAY)
+        self.reply("".join(elements(int(ID)) for ID in IDs))
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+DELAY = 0.5 # seconds per query, to show the effect of concurrent requests
+
+if __name__=="__main__":
+    server = Server(("localhost", 7880), Handler)
+    print("Listening")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+        sys.exit()
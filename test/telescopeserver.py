@@ -0,0 +1,52 @@
+import socket
+import time
+from sys import argv, exit
+from math import sin, pi
+
+# This program starts a server on port 9092 that answers the position queries of the
+# TelescopeHandler like the SLR telescope control computer, over a persistent connection.
+# The telescope slews around the sky once a minute. An optional delay (in seconds) is
+# waited before each reply, for testing the timeouts of the handler.
+#
+# Usage: python test/telescopeserver.py [delay]
+
+REQUEST = "#cybioms.telescope.data"
+
+
+def position(T0):
+    T = ((time.monotonic() - T0) % 60.0) / 60.0
+    elevation = 45 + 30 * sin(2*pi*T)
+    azimuth = 360 * T
+    return elevation, azimuth
+
+def serve(delay=0.0):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("localhost", 9092))
+    sock.listen(5)
+    print("Listening")
+    T0 = time.monotonic()
+    try:
+        while True:
+            (clientsocket, address) = sock.accept()
+            print("Connection from {}".format(address))
+            requests = 0
+            with clientsocket, clientsocket.makefile("rwb") as stream:
+                try:
+                    for line in stream:
+                        if line.decode("utf-8").strip() != REQUEST:
+                            continue
+                        time.sleep(delay)
+                        reply = "elevation={:.4f}\nazimuth={:.4f}\n".format(*position(T0))
+                        stream.write(bytes(reply, "utf-8"))
+                        stream.flush()
+                        requests += 1
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+            print("Lost connection after {} requests".format(requests))
+    except KeyboardInterrupt:
+        sock.close()
+        exit()
+
+if __name__=="__main__":
+    serve(float(argv[1]) if len(argv) > 1 else 0.0)